@@ -0,0 +1,72 @@
+import math
+
+
+class Autoscaler():
+    """
+    Decides how many instances one stage should run, configured by `min_instances`, `max_instances` and
+    `target_latency` (seconds, default 1) in the stage's YAML entry.
+
+    The service time per item is measured from the stage's StageStats and smoothed over the ticks. A backlog
+    of `depth` items takes about depth * service_time / instances to drain, so the stage is grown to the
+    number of instances that keeps that under the target latency. It only shrinks while its input queue is
+    empty, one instance per tick, so a short pause between bursts does not tear everything down.
+    """
+    def __init__(self, stage_name, min_instances, max_instances, target_latency=1.0, smoothing=0.5):
+        if not 1 <= min_instances <= max_instances:
+            raise ValueError(f"Worker {stage_name} needs 1 <= min_instances <= max_instances")
+        if target_latency <= 0:
+            raise ValueError(f"Worker {stage_name} needs a positive target_latency")
+        self.stage_name = stage_name
+        self.min_instances = min_instances
+        self.max_instances = max_instances
+        self.target_latency = target_latency
+        self._smoothing = smoothing
+        self._service_time = None
+        self._last_items = 0
+        self._last_busy_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, worker):
+        """
+        Returns None for stages without min_instances/max_instances, those keep a fixed instance count
+        """
+        if 'min_instances' not in worker and 'max_instances' not in worker:
+            return None
+        instances = worker.get('instances', 1)
+        return cls(worker['name'],
+                   min_instances=worker.get('min_instances', 1),
+                   max_instances=worker.get('max_instances', max(instances, worker.get('min_instances', 1))),
+                   target_latency=worker.get('target_latency', 1.0))
+
+    def clamp(self, instances):
+        return min(self.max_instances, max(self.min_instances, instances))
+
+    @property
+    def service_time(self):
+        return self._service_time
+
+    def _update_service_time(self, items, busy_seconds):
+        new_items = items - self._last_items
+        new_busy_seconds = busy_seconds - self._last_busy_seconds
+        self._last_items = items
+        self._last_busy_seconds = busy_seconds
+        if new_items <= 0:
+            return
+        measured = new_busy_seconds / new_items
+        if self._service_time is None:
+            self._service_time = measured
+        else:
+            self._service_time = self._smoothing * measured + (1 - self._smoothing) * self._service_time
+
+    def desired_instances(self, instances, depth, items, busy_seconds):
+        """
+        `items` and `busy_seconds` are the stage's running totals, `depth` the size of its input queue
+        """
+        self._update_service_time(items, busy_seconds)
+        if depth == 0:
+            return self.clamp(instances - 1)
+        if self._service_time is None:
+            # Nothing measured yet, wait for the first items to come through
+            return self.clamp(instances)
+        needed = math.ceil(depth * self._service_time / self.target_latency)
+        return self.clamp(max(instances, needed))
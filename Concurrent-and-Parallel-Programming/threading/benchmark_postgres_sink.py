@@ -0,0 +1,98 @@
+"""
+Ingest throughput of the Postgres sink's insert methods against one round-trip per row.
+
+    python benchmark_postgres_sink.py                                   # SQLite stand-in in a temp dir
+    python benchmark_postgres_sink.py --url postgresql://user:pw@localhost/db
+
+A local Postgres for the second form: docker run -e POSTGRES_PASSWORD=pw -p 5432:5432 postgres
+The benchmark writes to its own table, prices_benchmark, which it drops and creates for every method.
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql import text
+
+from workers.PostgresWorker import PostgresWorker
+
+TABLE = 'prices_benchmark'
+
+
+def _rows(count):
+    now = datetime.datetime.utcnow()
+    return [(f'SYM{i % 500}', 100 + i * 0.01, now) for i in range(count)]
+
+
+def _reset_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS {TABLE}'))
+        conn.execute(text(f'CREATE TABLE {TABLE} (symbol VARCHAR(16), price DOUBLE PRECISION, '
+                          f'extracted_time TIMESTAMP)'))
+
+
+def _count_rows(engine):
+    with engine.connect() as conn:
+        return conn.execute(text(f'SELECT COUNT(*) FROM {TABLE}')).scalar()
+
+
+def per_row(url, rows, flush_rows):
+    # What the sink did before: a new engine, connection and transaction for every row
+    query = text(PostgresWorker._create_insert_query(TABLE))
+    for symbol, price, extracted_time in rows:
+        engine = create_engine(url)
+        with engine.begin() as conn:
+            conn.execute(query, {'symbol': symbol, 'price': price, 'extracted_time': str(extracted_time)})
+        engine.dispose()
+
+
+def batched(method):
+    def insert(url, rows, flush_rows):
+        engine = PostgresWorker.acquire_engine(url)
+        try:
+            for start in range(0, len(rows), flush_rows):
+                PostgresWorker.insert_many_into_db(engine, rows[start:start + flush_rows], table=TABLE, method=method)
+        finally:
+            PostgresWorker.release_engine(url)
+    return insert
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='database url, a SQLite file in a temp dir by default')
+    parser.add_argument('--rows', type=int, default=20000, help='rows written by each batched method')
+    parser.add_argument('--per-row-rows', type=int, default=500, help='rows written one round-trip at a time')
+    parser.add_argument('--flush-rows', type=int, default=1000, help='rows per flush of the batched methods')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        url = args.url or 'sqlite:///' + os.path.join(temp_dir, 'benchmark.sqlite3')
+        methods = [('per row', per_row, args.per_row_rows),
+                   ('executemany', batched('executemany'), args.rows),
+                   ('values', batched('values'), args.rows)]
+        if make_url(url).get_backend_name() == 'postgresql':
+            methods.append(('copy', batched('copy'), args.rows))
+
+        engine = create_engine(url)
+        print(f'{make_url(url).get_backend_name()}, {args.flush_rows} rows per flush')
+        baseline = None
+        for name, insert, count in methods:
+            _reset_table(engine)
+            rows = _rows(count)
+            started = time.perf_counter()
+            insert(url, rows, args.flush_rows)
+            elapsed = time.perf_counter() - started
+            assert _count_rows(engine) == count
+            rate = count / elapsed
+            baseline = baseline or rate
+            print(f'{name:>12}: {count:>7} rows in {elapsed:7.3f} s, {rate:>10.0f} rows/s, x{rate / baseline:.0f}')
+        with engine.begin() as conn:
+            conn.execute(text(f'DROP TABLE {TABLE}'))
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
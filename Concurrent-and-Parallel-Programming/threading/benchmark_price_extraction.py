@@ -0,0 +1,51 @@
+"""
+CPU time per quote of the price extraction: the fast path against parsing the whole page.
+
+    python benchmark_price_extraction.py                  # a synthetic quote page of about 500 KB
+    python benchmark_price_extraction.py pages/*.html     # saved quote pages, e.g. curl -o pages/AAPL.html ...
+"""
+import argparse
+import sys
+import timeit
+
+from lxml import html
+
+from workers.YahooFinanceWorkers import PRICE_XPATH, YahooFinacePriceWorker
+
+
+def synthetic_page():
+    # Quote pages carry a few hundred KB of scripts, styles and navigation around a small quote header
+    script = b'<script>window.App = {' + b','.join(b'"k%d": "%s"' % (i, b'x' * 40) for i in range(3000)) + b'};</script>'
+    nav = b''.join(b'<li><a href="/section/%d">Section %d</a></li>' % (i, i) for i in range(1000))
+    header = (b'<div id="quote-header-info"><div><h1>Apple Inc. (AAPL)</h1></div><div>NasdaqGS</div>'
+              b'<div><div><div><span>1,234.56</span><span>+1.23 (+0.10%)</span></div></div></div></div>')
+    body = b''.join(b'<tr><td>Row %d</td><td>%d.00</td></tr>' % (i, i) for i in range(8000))
+    return (b'<!DOCTYPE html><html><head><meta charset="utf-8">' + script + b'</head><body><ul>' + nav +
+            b'</ul>' + header + b'<table>' + body + b'</table></body></html>')
+
+
+def full_parse(page):
+    raw_prices = PRICE_XPATH(html.fromstring(page))
+    return raw_prices[0] if raw_prices else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*', help='saved quote pages, a synthetic one by default')
+    parser.add_argument('--repeat', type=int, default=20, help='extractions per page and method')
+    args = parser.parse_args()
+
+    pages = [(path, open(path, 'rb').read()) for path in args.pages] or [('synthetic', synthetic_page())]
+    for name, page in pages:
+        fast_price = YahooFinacePriceWorker.find_raw_price(page)
+        if fast_price != full_parse(page):
+            sys.exit(f'{name}: the fast path found {fast_price!r}, the full parse {full_parse(page)!r}')
+        fast = min(timeit.repeat(lambda: YahooFinacePriceWorker.find_raw_price(page), number=args.repeat, repeat=3))
+        full = min(timeit.repeat(lambda: full_parse(page), number=args.repeat, repeat=3))
+        print(f'{name}: {len(page) / 1024:.0f} KB, price {fast_price!r}, '
+              f'full parse {full / args.repeat * 1e3:.2f} ms, fast path {fast / args.repeat * 1e3:.3f} ms, '
+              f'x{full / fast:.0f}')
+
+
+if __name__ == '__main__':
+    main()
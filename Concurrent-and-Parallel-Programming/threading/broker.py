@@ -0,0 +1,270 @@
+import os
+import socket
+import threading
+import time
+from multiprocessing.managers import BaseManager, BaseProxy
+from queue import Empty
+
+
+def parse_address(address):
+    """
+    ('host', port) of a 'host:port' string
+    """
+    host, _, port = str(address).rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"Broker address {address!r} is not of the form host:port")
+    return host, int(port)
+
+
+class _ServedQueue():
+    # What the broker hands out for a queue. A proxy only forwards method calls, so dropped is one here
+    def __init__(self, queue):
+        self._queue = queue
+
+    def put(self, item, block=True, timeout=None):
+        self._queue.put(item, block, timeout)
+
+    def put_many(self, items, block=True, timeout=None):
+        self._queue.put_many(items, block=block, timeout=timeout)
+
+    def put_sentinel(self, item):
+        self._queue.put_sentinel(item)
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        # Together with their receipts, so that the nodes need no second round trip for them
+        items = self._queue.get_many(max_items, linger=linger, block=block, timeout=timeout)
+        take = getattr(self._queue, 'take_receipts', None)
+        return items, take() if take is not None else []
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def dropped(self):
+        return self._queue.dropped
+
+    def acknowledge(self, receipts):
+        self._queue.acknowledge(receipts)
+
+
+class _QueueProxy(BaseProxy):
+    _exposed_ = ('put', 'put_many', 'put_sentinel', 'get_many', 'qsize', 'dropped', 'acknowledge')
+
+    def put(self, item, block=True, timeout=None):
+        return self._callmethod('put', (item, block, timeout))
+
+    def put_many(self, items, block=True, timeout=None):
+        return self._callmethod('put_many', (items, block, timeout))
+
+    def put_sentinel(self, item):
+        return self._callmethod('put_sentinel', (item,))
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        return self._callmethod('get_many', (max_items, linger, block, timeout))
+
+    def qsize(self):
+        return self._callmethod('qsize')
+
+    def dropped(self):
+        return self._callmethod('dropped')
+
+    def acknowledge(self, receipts):
+        return self._callmethod('acknowledge', (receipts,))
+
+
+class _BrokerControl():
+    # Lets the nodes register their instances with the executor and report their stages back
+    def __init__(self, on_stage_finished, on_node_joined):
+        self._on_stage_finished = on_stage_finished
+        self._on_node_joined = on_node_joined
+
+    def node_joined(self, node, instances):
+        if self._on_node_joined is not None:
+            self._on_node_joined(node, instances)
+
+    def stage_finished(self, worker_name, failed):
+        self._on_stage_finished(worker_name, failed)
+
+
+class BrokerManager(BaseManager):
+    """
+    Client side of the broker: queue(name) is a queue of the pipeline, stage_input(worker_name) what an
+    instance of that stage reads, i.e. a subscription of a topic or its own consumer of a partitioned queue
+    """
+
+
+BrokerManager.register('queue', proxytype=_QueueProxy)
+BrokerManager.register('stage_input', proxytype=_QueueProxy)
+BrokerManager.register('control')
+
+
+def connect(address, authkey, timeout=60):
+    """
+    A connected BrokerManager, retrying for up to timeout seconds while the broker is not up yet
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        manager = BrokerManager(address=address, authkey=authkey)
+        try:
+            manager.connect()
+            return manager
+        except ConnectionRefusedError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.5)
+
+
+class PipelineBroker():
+    """
+    Serves the queues of a pipeline over TCP to the nodes running some of its stages, see
+    YamlPipelineExecutor. It runs inside the executor and hands out the executor's own queue objects, so
+    the stages the executor runs itself keep using them directly, and queues of every type can be served.
+    Each connection is served on a thread of its own, where a node's blocking get() waits.
+
+    The connections are authenticated with authkey, but not encrypted: expose the port on trusted
+    networks only.
+    """
+    def __init__(self, address, authkey, open_queue, open_stage_input, on_stage_finished, on_node_joined=None):
+        control = _BrokerControl(on_stage_finished, on_node_joined)
+
+        # A registry of its own, the callables are this executor's
+        class _ServingManager(BrokerManager):
+            pass
+
+        _ServingManager.register('queue', callable=lambda name: _ServedQueue(open_queue(name)),
+                                 proxytype=_QueueProxy)
+        _ServingManager.register('stage_input', callable=lambda stage: _ServedQueue(open_stage_input(stage)),
+                                 proxytype=_QueueProxy)
+        _ServingManager.register('control', callable=lambda: control)
+        self._server = _ServingManager(address=address, authkey=authkey).get_server()
+        # Set by serve_forever(), which would also exit the process once stopped; requests may look at it
+        self._server.stop_event = threading.Event()
+        self.address = self._server.address
+        self._stopped = False
+        self._accepter = threading.Thread(target=self._accept, name='pipeline-broker', daemon=True)
+        self._accepter.start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._server.listener.accept()
+            except OSError:
+                if self._stopped:
+                    return
+                continue
+            if self._stopped:
+                connection.close()
+                return
+            threading.Thread(target=self._server.handle_request, args=(connection,), daemon=True).start()
+
+    def stop(self):
+        self._stopped = True
+        # A connection of our own wakes the accepting thread up, closing the listener alone does not
+        host, port = self.address
+        try:
+            socket.create_connection(('127.0.0.1' if host in ('', '0.0.0.0') else host, port), timeout=5).close()
+        except OSError:
+            pass
+        self._accepter.join()
+        self._server.listener.close()
+
+
+class RemoteQueue():
+    """
+    A queue of the pipeline on a node, served by the PipelineBroker of the executor. It has the interface of
+    the local queues, so workers, views and the asyncio executor use it unchanged, and it can be handed to
+    process-backed instances, which connect again from their own process.
+
+    A blocking read waits on the broker in slices of POLL_INTERVAL seconds, so that the broker does not
+    keep waiting for a node that is gone. An item a node took out is lost with the node, like with an
+    instance that crashes locally.
+    """
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, address, authkey, name, stage=None):
+        self.name = name
+        self.transport = 'broker'
+        self._address = address
+        self._authkey = authkey
+        self._stage = stage
+        self._lock = threading.Lock()
+        # Receipts of the last read of each thread
+        self._local = threading.local()
+        self._proxy = None
+        self._pid = None
+
+    def __getstate__(self):
+        return self._address, self._authkey, self.name, self._stage
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _remote(self):
+        if self._proxy is None or self._pid != os.getpid():
+            with self._lock:
+                if self._proxy is None or self._pid != os.getpid():
+                    manager = connect(self._address, self._authkey)
+                    self._proxy = manager.queue(self.name) if self._stage is None else manager.stage_input(self._stage)
+                    self._pid = os.getpid()
+        return self._proxy
+
+    def consumer(self):
+        """
+        A connection of its own for one instance, which the broker gives a consumer of its own when the stage
+        reads a partitioned queue
+        """
+        return RemoteQueue(self._address, self._authkey, self.name, self._stage)
+
+    def put(self, item, block=True, timeout=None):
+        self._remote().put(item, block, timeout)
+
+    def put_many(self, items, block=True, timeout=None):
+        if items:
+            self._remote().put_many(list(items), block, timeout)
+
+    def put_sentinel(self, item):
+        self._remote().put_sentinel(item)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        self._local.receipts = []
+        if not block:
+            items, self._local.receipts = self._remote().get_many(max_items, linger, False, None)
+            return items
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.POLL_INTERVAL if deadline is None else max(0.0, min(self.POLL_INTERVAL,
+                                                                             deadline - time.monotonic()))
+            try:
+                items, self._local.receipts = self._remote().get_many(max_items, linger, True, wait)
+                return items
+            except Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, block=block, timeout=timeout)[0]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def take_receipts(self):
+        receipts, self._local.receipts = getattr(self._local, 'receipts', []), []
+        return receipts
+
+    def acknowledge(self, receipts):
+        self._remote().acknowledge(list(receipts))
+
+    def qsize(self):
+        return self._remote().qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def dropped(self):
+        return self._remote().dropped()
+
+    def cleanup(self):
+        pass
@@ -0,0 +1,21 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+
+@pytest.fixture
+def server(handler):
+    """
+    Local HTTP server on a free port, answering with the `handler` fixture of the test module. The handler's
+    initial_state() gives the attributes it counts requests in, `lock` guards them.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.lock = threading.Lock()
+    for name, value in handler.initial_state().items():
+        setattr(server, name, value)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
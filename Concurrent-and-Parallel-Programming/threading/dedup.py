@@ -0,0 +1,127 @@
+import hashlib
+import math
+
+from pipeline_queues import MP_CONTEXT
+
+DEDUP_TYPES = ('exact', 'bloom')
+
+
+def _digest(key):
+    return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+
+
+class DedupFilter():
+    """
+    Filter of the items a stage has already written, shared by every instance of the stages using it,
+    process-backed ones included. Items are compared by their repr(), or by one field of tuple items with
+    `key_field`. first_seen() takes a scope, the name of the output queue, so that a filter shared by two
+    stages or by a stage with two output queues lets the first copy through into every queue.
+
+    The table lives in shared memory of a fixed size allocated up front, so a filter never grows.
+    """
+    def __init__(self, name, capacity, key_field=None):
+        if capacity <= 0:
+            raise ValueError(f"Dedup filter {name} needs a positive capacity")
+        self.name = name
+        self.capacity = capacity
+        self.key_field = key_field
+        self._lock = MP_CONTEXT.Lock()
+        # [items let through, duplicates dropped]
+        self._counts = MP_CONTEXT.Array('q', [0, 0], lock=False)
+
+    @classmethod
+    def from_config(cls, name, dedup_config):
+        dedup_config = dict(dedup_config or {})
+        dedup_type = dedup_config.pop('type', 'exact')
+        if dedup_type == 'exact':
+            return ExactFilter(name, **dedup_config)
+        if dedup_type == 'bloom':
+            return BloomFilter(name, **dedup_config)
+        raise ValueError(f"Unknown type '{dedup_type}' for dedup filter {name}, expected one of {DEDUP_TYPES}")
+
+    def first_seen(self, scope, item):
+        """
+        Returns True for the first item with its key in scope, and False for every later one
+        """
+        key = item if self.key_field is None else item[self.key_field]
+        with self._lock:
+            new = self._add(_digest((scope, key)))
+            self._counts[0 if new else 1] += 1
+        return new
+
+    def _add(self, digest):
+        # Caller holds the lock. Returns whether digest was not in the filter yet
+        raise NotImplementedError
+
+    def snapshot(self):
+        with self._lock:
+            return {'capacity': self.capacity, 'passed': self._counts[0], 'duplicates': self._counts[1]}
+
+
+class ExactFilter(DedupFilter):
+    """
+    Set of 64-bit fingerprints, in an open addressing table kept at most half full. Two different keys
+    only collide with a probability of about capacity ** 2 / 2 ** 65, so for the runs it is meant for it
+    is exact. Takes 16 bytes per item of capacity. Once capacity keys are in, it stops filtering and lets
+    new keys through, with a warning to raise the capacity or switch to type: bloom.
+    """
+    def __init__(self, name, capacity=100000, key_field=None):
+        super(ExactFilter, self).__init__(name, capacity, key_field)
+        slots = 1 << max(4, (2 * capacity - 1).bit_length())
+        self._slots = MP_CONTEXT.Array('Q', slots, lock=False)
+        self._mask = slots - 1
+        self._warned = False
+
+    def _add(self, digest):
+        # 0 marks an empty slot
+        fingerprint = int.from_bytes(digest[:8], 'little') or 1
+        slots = self._slots
+        index = fingerprint & self._mask
+        while slots[index] != 0:
+            if slots[index] == fingerprint:
+                return False
+            index = (index + 1) & self._mask
+        if self._counts[0] >= self.capacity:
+            if not self._warned:
+                self._warned = True
+                print(f"Dedup filter {self.name} is full with {self.capacity} keys, new keys pass unfiltered. "
+                      f"Raise its capacity or use type: bloom")
+            return True
+        slots[index] = fingerprint
+        return True
+
+    def snapshot(self):
+        return dict(super(ExactFilter, self).snapshot(), type='exact')
+
+
+class BloomFilter(DedupFilter):
+    """
+    Bloom filter sized for `capacity` keys with a false positive rate of `error_rate`: a new item is taken
+    for a duplicate, and dropped, with that probability. Takes about -ln(error_rate) / ln(2) ** 2 bits per
+    item of capacity, 1.8 MB for a million keys at 0.1%, whatever the size of the items. Past capacity the
+    false positive rate climbs.
+    """
+    def __init__(self, name, capacity=1000000, error_rate=0.001, key_field=None):
+        if not 0 < error_rate < 1:
+            raise ValueError(f"Dedup filter {name} needs an error_rate between 0 and 1")
+        super(BloomFilter, self).__init__(name, capacity, key_field)
+        self.error_rate = error_rate
+        self.bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self._bytes = MP_CONTEXT.Array('B', (self.bits + 7) // 8, lock=False)
+
+    def _add(self, digest):
+        # Double hashing: the k bit positions are h1 + i * h2, from the two halves of one digest
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        new = False
+        for i in range(self.hashes):
+            position = (first + i * step) % self.bits
+            mask = 1 << (position & 7)
+            if not self._bytes[position >> 3] & mask:
+                self._bytes[position >> 3] |= mask
+                new = True
+        return new
+
+    def snapshot(self):
+        return dict(super(BloomFilter, self).snapshot(), type='bloom', error_rate=self.error_rate)
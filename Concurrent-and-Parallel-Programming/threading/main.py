@@ -9,9 +9,11 @@ def main():
     if pipeline_location is None:
         print('Pipeline location not defined')
         exit(1)
+    # Set on the machines running the stages of a `node:` of the pipeline, see YamlPipelineExecutor
+    node = os.environ.get('PIPELINE_NODE')
     scraper_start_time = time.time()
 
-    yamlPipelineExecutor = YamlPipelineExecutor(pipeline_location=pipeline_location)
+    yamlPipelineExecutor = YamlPipelineExecutor(pipeline_location=pipeline_location, node=node)
     yamlPipelineExecutor.start()
     yamlPipelineExecutor.join()
     print('Extracting time took:', round(time.time() - scraper_start_time, 1))
@@ -0,0 +1,466 @@
+import http.server
+import json
+import os
+import threading
+import time
+
+from pipeline_queues import MP_CONTEXT, is_done
+
+
+# Upper bounds in seconds of the buckets of the per-item processing latency histograms, the last bucket is +Inf
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class StageStats():
+    """
+    Counters of one stage, shared by all its instances including the process-backed ones: items taken from
+    the input queue and handed to the output queues, time spent processing and waiting for input, and a
+    histogram of the processing latency per item. An instance handed a batch of n items that kept it busy
+    for t seconds counts n items of latency t / n. That is only known at the instance's next read, so the
+    items an instance processes right before it stops are counted in items_in but not in items_processed.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = MP_CONTEXT.Lock()
+        self._items_in = MP_CONTEXT.Value('q', 0, lock=False)
+        self._items_processed = MP_CONTEXT.Value('q', 0, lock=False)
+        self._items_out = MP_CONTEXT.Value('q', 0, lock=False)
+        self._busy_seconds = MP_CONTEXT.Value('d', 0.0, lock=False)
+        self._idle_seconds = MP_CONTEXT.Value('d', 0.0, lock=False)
+        self._latency_buckets = MP_CONTEXT.Array('q', len(LATENCY_BUCKETS) + 1, lock=False)
+
+    def record_input(self, items):
+        with self._lock:
+            self._items_in.value += items
+
+    def record_processed(self, items, busy_seconds):
+        with self._lock:
+            self._items_processed.value += items
+            self._busy_seconds.value += busy_seconds
+            if items:
+                latency = busy_seconds / items
+                bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if latency <= bound),
+                              len(LATENCY_BUCKETS))
+                self._latency_buckets[bucket] += items
+
+    def record_idle(self, idle_seconds):
+        with self._lock:
+            self._idle_seconds.value += idle_seconds
+
+    def record_output(self, items):
+        with self._lock:
+            self._items_out.value += items
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'items_in': self._items_in.value,
+                'items_processed': self._items_processed.value,
+                'items_out': self._items_out.value,
+                'busy_seconds': self._busy_seconds.value,
+                'idle_seconds': self._idle_seconds.value,
+                'latency_buckets': list(self._latency_buckets),
+            }
+
+
+class InstanceStats():
+    """
+    Busy and idle time of one worker instance
+    """
+    def __init__(self, name):
+        self.name = name
+        # [busy seconds, idle seconds]
+        self._seconds = MP_CONTEXT.Array('d', 2)
+
+    def record(self, busy_seconds=0.0, idle_seconds=0.0):
+        with self._seconds.get_lock():
+            self._seconds[0] += busy_seconds
+            self._seconds[1] += idle_seconds
+
+    def snapshot(self):
+        with self._seconds.get_lock():
+            return {'busy_seconds': self._seconds[0], 'idle_seconds': self._seconds[1]}
+
+
+class StageQueueView():
+    """
+    The input queue of one worker instance as handed out by the executor. Reads are forwarded to the shared
+    queue; the time blocked in a read is counted as idle, the time between handing out items and the
+    instance's next read as the time spent processing them. This works for any worker class, since every
+    one of them reads its input queue. With a tracing.TraceReader it also unwraps the envelopes of traced
+    items and records their spans. Without stats, for stages nobody measures, reads are only forwarded.
+    """
+    def __init__(self, queue, stats, instance_stats=None, trace_reader=None):
+        self._queue = queue
+        self._stats = stats
+        self._instance_stats = instance_stats
+        self._trace_reader = trace_reader
+        self._handed_out = 0
+        self._handed_out_at = None
+        self._read_started_at = None
+
+    def _before_read(self):
+        if self._trace_reader is not None:
+            self._trace_reader.end_spans()
+        if self._stats is None:
+            return
+        self._read_started_at = time.monotonic()
+        if self._handed_out_at is not None:
+            busy_seconds = self._read_started_at - self._handed_out_at
+            self._stats.record_processed(self._handed_out, busy_seconds)
+            if self._instance_stats is not None:
+                self._instance_stats.record(busy_seconds=busy_seconds)
+            self._handed_out_at = None
+
+    def _read_finished(self):
+        if self._stats is None:
+            return
+        idle_seconds = time.monotonic() - self._read_started_at
+        self._stats.record_idle(idle_seconds)
+        if self._instance_stats is not None:
+            self._instance_stats.record(idle_seconds=idle_seconds)
+
+    def _after_read(self, items):
+        if self._stats is not None:
+            self._handed_out = sum(1 for item in items if not is_done(item))
+            self._stats.record_input(self._handed_out)
+            self._handed_out_at = time.monotonic()
+        return items if self._trace_reader is None else self._trace_reader.unwrap(items)
+
+    def get(self, block=True, timeout=None):
+        self._before_read()
+        try:
+            item = self._queue.get(block, timeout)
+        finally:
+            self._read_finished()
+        return self._after_read([item])[0]
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        self._before_read()
+        try:
+            items = self._queue.get_many(max_items, linger=linger, block=block, timeout=timeout)
+        finally:
+            self._read_finished()
+        return self._after_read(items)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def __getattr__(self, name):
+        # Everything else (qsize, name, ...) is the shared queue's. The guard keeps pickling from recursing
+        if name.startswith('__') or '_queue' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self._queue, name)
+
+
+class AsyncStageQueueView(StageQueueView):
+    """
+    StageQueueView for the coroutine workers of the asyncio executor, wrapping their AsyncQueue
+    """
+    async def get(self, timeout=None):
+        self._before_read()
+        try:
+            item = await self._queue.get(timeout)
+        finally:
+            self._read_finished()
+        return self._after_read([item])[0]
+
+    async def get_many(self, max_items, linger=0, timeout=None):
+        self._before_read()
+        try:
+            items = await self._queue.get_many(max_items, linger=linger, timeout=timeout)
+        finally:
+            self._read_finished()
+        return self._after_read(items)
+
+
+class OutputQueueView():
+    """
+    One output queue of a stage as handed out by the executor, counting the items the stage writes into `stats`.
+    With a dedup filter (see dedup.DedupFilter) items the filter has seen before are dropped here, and with
+    a tracing.TraceWriter traced items are put into their envelope.
+    """
+    def __init__(self, queue, stats, dedup_filter=None, trace_writer=None):
+        self._queue = queue
+        self._stats = stats
+        self._dedup_filter = dedup_filter
+        self._trace_writer = trace_writer
+
+    def _outgoing(self, items):
+        if self._dedup_filter is not None:
+            items = [item for item in items if self._dedup_filter.first_seen(self._queue.name, item)]
+        if self._trace_writer is not None and items:
+            items = self._trace_writer.wrap(items)
+        return items
+
+    def put(self, item, block=True, timeout=None):
+        items = self._outgoing([item])
+        if not items:
+            return
+        self._queue.put(items[0], block, timeout)
+        self._record_output(1)
+
+    def put_many(self, items, block=True, timeout=None):
+        items = self._outgoing(items)
+        if not items:
+            return
+        self._queue.put_many(items, block=block, timeout=timeout)
+        self._record_output(len(items))
+
+    def _record_output(self, items):
+        if self._stats is not None:
+            self._stats.record_output(items)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or '_queue' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self._queue, name)
+
+
+class AsyncOutputQueueView(OutputQueueView):
+    async def put(self, item):
+        items = self._outgoing([item])
+        if not items:
+            return
+        await self._queue.put(items[0])
+        self._record_output(1)
+
+    async def put_many(self, items):
+        items = self._outgoing(items)
+        if not items:
+            return
+        await self._queue.put_many(items)
+        self._record_output(len(items))
+
+
+class _QueueWait():
+    # Mean time an item spends in a queue, by Little's law: the integral of the depth over time divided by
+    # the number of items the consumers took out. Needs no timestamps on the items, so it works for every
+    # queue type; its precision depends on how often the depth is sampled.
+    def __init__(self):
+        self.depth_seconds = 0.0
+        self.last_sample = None
+
+    def sample(self, depth, now):
+        if self.last_sample is not None:
+            self.depth_seconds += depth * (now - self.last_sample)
+        self.last_sample = now
+
+
+class PipelineMetrics():
+    """
+    Metrics of a running pipeline, configured by the optional top-level `metrics:` section of the YAML:
+
+        metrics:
+          snapshot_path: metrics.json   # JSON snapshot, rewritten every snapshot_interval seconds
+          snapshot_interval: 10
+          sample_interval: 0.1          # how often the queue depths are sampled
+          port: 9108                    # Prometheus text format on http://127.0.0.1:9108/metrics
+
+    The executor registers the StageStats of every stage, the InstanceStats of every instance and the
+    queues. start() runs a sampler thread and, with a port set, the HTTP endpoint. Without the section
+    there is no PipelineMetrics at all: no sampler runs, and only autoscaled stages keep StageStats.
+    """
+    def __init__(self, snapshot_path=None, snapshot_interval=10, sample_interval=0.1, port=None, host='127.0.0.1'):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.sample_interval = sample_interval
+        self.port = port
+        self.host = host
+        self._stages = {}
+        self._instances = {}
+        self._queues = {}
+        self._queue_consumers = {}
+        self._queue_wait = {}
+        self._rate_limiters = {}
+        self._dedup_filters = {}
+        self._started_at = time.monotonic()
+        self._last_snapshot = None
+        self._server = None
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, metrics_config):
+        if metrics_config is None:
+            return None
+        return cls(snapshot_path=metrics_config.get('snapshot_path'),
+                   snapshot_interval=metrics_config.get('snapshot_interval', 10),
+                   sample_interval=metrics_config.get('sample_interval', 0.1),
+                   port=metrics_config.get('port'),
+                   host=metrics_config.get('host', '127.0.0.1'))
+
+    def add_stage(self, stats, input_queue=None):
+        self._stages[stats.name] = stats
+        if input_queue is not None:
+            self._queue_consumers.setdefault(input_queue, []).append(stats.name)
+
+    def add_instance(self, stage_name, instance_stats):
+        self._instances[instance_stats.name] = (stage_name, instance_stats)
+
+    def add_queue(self, queue):
+        self._queues[queue.name] = queue
+        self._queue_wait[queue.name] = _QueueWait()
+
+    def add_rate_limiter(self, rate_limiter):
+        self._rate_limiters[rate_limiter.name] = rate_limiter
+
+    def add_dedup_filter(self, dedup_filter):
+        self._dedup_filters[dedup_filter.name] = dedup_filter
+
+    def sample(self):
+        """
+        Samples the queue depths, and writes the JSON snapshot when it is due
+        """
+        now = time.monotonic()
+        for queue_name, queue in self._queues.items():
+            self._queue_wait[queue_name].sample(queue.qsize(), now)
+        if self.snapshot_path is not None and \
+                (self._last_snapshot is None or now - self._last_snapshot >= self.snapshot_interval):
+            self.write_snapshot()
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self._started_at
+        stages = {}
+        for stage_name, stats in self._stages.items():
+            stage = stats.snapshot()
+            stage['throughput'] = stage['items_in'] / elapsed if elapsed > 0 else 0.0
+            stage['instances'] = {instance_name: instance_stats.snapshot()
+                                  for instance_name, (instance_stage, instance_stats) in self._instances.items()
+                                  if instance_stage == stage_name}
+            stages[stage_name] = stage
+        queues = {}
+        for queue_name, queue in self._queues.items():
+            taken = sum(self._stages[stage_name].snapshot()['items_in']
+                        for stage_name in self._queue_consumers.get(queue_name, []))
+            depth_seconds = self._queue_wait[queue_name].depth_seconds
+            queues[queue_name] = {
+                'depth': queue.qsize(),
+                'dropped': queue.dropped,
+                'mean_wait_seconds': depth_seconds / taken if taken else None,
+            }
+        rate_limiters = {}
+        for name, rate_limiter in self._rate_limiters.items():
+            rate_limiters[name] = rate_limiter.snapshot()
+            rate_limiters[name]['acquired_per_second'] = rate_limiters[name]['acquired'] / elapsed if elapsed > 0 else 0.0
+        return {'elapsed_seconds': elapsed, 'latency_bounds': list(LATENCY_BUCKETS), 'stages': stages,
+                'queues': queues, 'rate_limiters': rate_limiters,
+                'dedup_filters': {name: dedup_filter.snapshot() for name, dedup_filter in self._dedup_filters.items()}}
+
+    def write_snapshot(self):
+        self._last_snapshot = time.monotonic()
+        # Written next to the target and renamed, so a reader never sees half a file
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'w') as outFile:
+            json.dump(self.snapshot(), outFile, indent=2)
+        os.replace(temp_path, self.snapshot_path)
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f'{name}{{{label_text}}} {value}')
+
+        stages = snapshot['stages']
+        metric('pipeline_stage_items_in_total', 'counter', 'Items a stage took from its input queue',
+               [({'stage': name}, stage['items_in']) for name, stage in stages.items()])
+        metric('pipeline_stage_items_out_total', 'counter', 'Items a stage put into its output queues',
+               [({'stage': name}, stage['items_out']) for name, stage in stages.items()])
+        metric('pipeline_stage_busy_seconds_total', 'counter', 'Time the instances of a stage spent processing',
+               [({'stage': name}, stage['busy_seconds']) for name, stage in stages.items()])
+        metric('pipeline_stage_idle_seconds_total', 'counter', 'Time the instances of a stage waited for input',
+               [({'stage': name}, stage['idle_seconds']) for name, stage in stages.items()])
+
+        lines.append('# HELP pipeline_stage_latency_seconds Processing time per item')
+        lines.append('# TYPE pipeline_stage_latency_seconds histogram')
+        for name, stage in stages.items():
+            cumulative = 0
+            for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], stage['latency_buckets']):
+                cumulative += count
+                lines.append(f'pipeline_stage_latency_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'pipeline_stage_latency_seconds_sum{{stage="{name}"}} {stage["busy_seconds"]}')
+            lines.append(f'pipeline_stage_latency_seconds_count{{stage="{name}"}} {stage["items_processed"]}')
+
+        instances = [(stage_name, instance_name, instance)
+                     for stage_name, stage in stages.items() for instance_name, instance in stage['instances'].items()]
+        metric('pipeline_instance_busy_seconds_total', 'counter', 'Time a worker instance spent processing',
+               [({'stage': stage_name, 'instance': instance_name}, instance['busy_seconds'])
+                for stage_name, instance_name, instance in instances])
+        metric('pipeline_instance_idle_seconds_total', 'counter', 'Time a worker instance waited for input',
+               [({'stage': stage_name, 'instance': instance_name}, instance['idle_seconds'])
+                for stage_name, instance_name, instance in instances])
+
+        queues = snapshot['queues']
+        metric('pipeline_queue_depth', 'gauge', 'Items waiting in a queue',
+               [({'queue': name}, queue['depth']) for name, queue in queues.items()])
+        metric('pipeline_queue_dropped_total', 'counter', 'Items discarded by the drop_oldest policy',
+               [({'queue': name}, queue['dropped']) for name, queue in queues.items()])
+        metric('pipeline_queue_wait_seconds', 'gauge', 'Mean time an item spent waiting in a queue',
+               [({'queue': name}, queue['mean_wait_seconds']) for name, queue in queues.items()
+                if queue['mean_wait_seconds'] is not None])
+
+        rate_limiters = snapshot['rate_limiters']
+        metric('pipeline_rate_limiter_acquired_total', 'counter', 'Tokens granted by a rate limiter',
+               [({'limiter': name}, limiter['acquired']) for name, limiter in rate_limiters.items()])
+        metric('pipeline_rate_limiter_wait_seconds_total', 'counter', 'Time callers waited for a rate limiter',
+               [({'limiter': name}, limiter['wait_seconds']) for name, limiter in rate_limiters.items()])
+        metric('pipeline_rate_limiter_rate', 'gauge', 'Configured tokens per second of a rate limiter',
+               [({'limiter': name}, limiter['rate']) for name, limiter in rate_limiters.items()])
+
+        dedup_filters = snapshot['dedup_filters']
+        metric('pipeline_dedup_passed_total', 'counter', 'Items a dedup filter let through as seen for the first time',
+               [({'filter': name}, dedup['passed']) for name, dedup in dedup_filters.items()])
+        metric('pipeline_dedup_duplicates_total', 'counter', 'Items a dedup filter dropped as duplicates',
+               [({'filter': name}, dedup['duplicates']) for name, dedup in dedup_filters.items()])
+        return '\n'.join(lines) + '\n'
+
+    def _sample_until_stopped(self):
+        while not self._stopped.wait(self.sample_interval):
+            self.sample()
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample_until_stopped, name='pipeline-metrics-sampler',
+                                         daemon=True)
+        self._sampler.start()
+        if self.port is None:
+            return
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        # Port 0 picks a free port, the actual one is kept so it can be printed and scraped
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='pipeline-metrics-server', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.sample()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self.snapshot_path is not None:
+            self.write_snapshot()
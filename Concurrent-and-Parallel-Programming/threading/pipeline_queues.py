@@ -0,0 +1,1236 @@
+import collections
+import datetime
+import math
+import multiprocessing
+import os
+import pickle
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from multiprocessing import shared_memory
+from queue import Empty, Full
+
+
+# Every multiprocessing primitive of the pipeline comes from the spawn context, the same one the executor
+# starts its worker processes with. Locks created in a fork context cannot be handed to spawned children.
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+# Where the items of a queue travel. 'thread' is a lock based in-process queue that hands over references,
+# 'process' is a multiprocessing queue that pickles every item through a pipe and is only needed when a
+# producer or a consumer of the queue runs in another process.
+TRANSPORTS = {
+    'thread': (queue.Queue, threading.Condition),
+    'process': (MP_CONTEXT.Queue, MP_CONTEXT.Condition),
+}
+
+class _EndOfStream():
+    """
+    Type of DONE, the end-of-stream marker the executor puts once per consuming instance when all producers
+    of a queue have finished. There is exactly one instance per process and unpickling returns it, so it
+    is recognized by identity and no payload, not even the string 'DONE', can be mistaken for it.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(_EndOfStream, cls).__new__(cls)
+        return cls._instance
+
+    def __reduce__(self):
+        return (_EndOfStream, ())
+
+    def __repr__(self):
+        return 'DONE'
+
+
+DONE = _EndOfStream()
+
+# What put() does when a bounded queue is full: wait for room, or make room by discarding the oldest item
+OVERFLOW_POLICIES = ('block', 'drop_oldest')
+
+
+def is_done(item):
+    return item is DONE
+
+
+class _LocalValue():
+    # Same interface as a multiprocessing Value, without the shared memory, for in-process queues
+    def __init__(self):
+        self.value = 0
+
+
+class _Batch():
+    # Several items sent with put_many travel as one message, so they are pickled and woken up for once
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+    def __getstate__(self):
+        return self.items
+
+    def __setstate__(self, items):
+        self.items = items
+
+
+class Traced():
+    """
+    Envelope of an item sampled for tracing, see tracing.Tracer: the trace it belongs to and when it was put
+    into the queue, in microseconds of the wall clock so that every process reads it the same way. Only the
+    executor's queue views wrap and unwrap items, worker classes never see an envelope.
+    """
+    __slots__ = ('item', 'trace_id', 'enqueued_at')
+
+    def __init__(self, item, trace_id, enqueued_at):
+        self.item = item
+        self.trace_id = trace_id
+        self.enqueued_at = enqueued_at
+
+    def __getstate__(self):
+        return self.item, self.trace_id, self.enqueued_at
+
+    def __setstate__(self, state):
+        self.item, self.trace_id, self.enqueued_at = state
+
+    def __repr__(self):
+        return f'Traced({self.item!r}, {self.trace_id})'
+
+
+def unwrap(item):
+    return item.item if isinstance(item, Traced) else item
+
+
+def take_receipts(queue, items):
+    """
+    Receipts of the items of the last read from queue, to acknowledge() once they are handled; None for
+    the items of queues that keep nothing to acknowledge. items are the ones read, without DONE
+    """
+    take = getattr(queue, 'take_receipts', None)
+    receipts = take() if take is not None else []
+    return list(receipts) if len(receipts) == len(items) else [None] * len(items)
+
+
+def acknowledge(queue, receipts):
+    """
+    Acknowledges handled items at their queue, see PersistentQueue
+    """
+    receipts = [receipt for receipt in receipts if receipt is not None]
+    if receipts:
+        queue.acknowledge(receipts)
+
+
+def _item_count(message):
+    return len(message.items) if isinstance(message, _Batch) else 1
+
+
+class PipelineQueue():
+    """
+    Queue connecting two pipeline stages, configured by one entry of the `queues:` section of the YAML.
+
+    With `maxsize` set the queue is bounded. The `block` overflow policy makes producers wait for room,
+    `drop_oldest` never blocks and discards the oldest queued item instead, which suits feeds where only
+    fresh values matter. With `high_watermark` set, producers are paused as soon as the queue holds that
+    many items and are only released once consumers have drained it down to `low_watermark`, so a fast
+    stage is throttled in bursts instead of waking up for every single free slot.
+
+    `transport` selects the underlying queue and synchronization primitives, see TRANSPORTS.
+
+    put_many() sends a list of items as a single message and get()/get_many() unpack it again, so a batch
+    costs one pickle and one wakeup. Bounds and watermarks count items, not messages: a batch is charged
+    its full length, so maxsize keeps memory predictable whatever batch sizes the producers use. A batch
+    larger than maxsize is only let in once the queue is empty.
+    """
+    def __init__(self, name, maxsize=0, overflow='block', high_watermark=None, low_watermark=None,
+                 transport='process'):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport '{transport}' for queue {name}, expected one of {tuple(TRANSPORTS)}")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}' for queue {name}, expected one of {OVERFLOW_POLICIES}")
+        if overflow == 'drop_oldest' and maxsize <= 0:
+            raise ValueError(f"Queue {name} uses the drop_oldest policy and needs a maxsize")
+        if overflow == 'drop_oldest' and high_watermark is not None:
+            raise ValueError(f"Queue {name} uses the drop_oldest policy, which never throttles producers, "
+                             f"so watermarks do not apply")
+        if high_watermark is not None:
+            if low_watermark is None:
+                low_watermark = high_watermark // 2
+            if not 0 <= low_watermark < high_watermark:
+                raise ValueError(f"Queue {name} needs 0 <= low_watermark < high_watermark")
+            if maxsize > 0 and high_watermark > maxsize:
+                raise ValueError(f"Queue {name} has a high_watermark above its maxsize")
+
+        QueueClass, ConditionClass = TRANSPORTS[transport]
+        self.name = name
+        self.maxsize = maxsize
+        self.transport = transport
+        # The underlying queue is unbounded, the bound is enforced on the item count kept below
+        self._queue = QueueClass()
+        self._overflow = overflow
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        # Guards the counters; producers waiting for room sleep on it and consumers notify it
+        self._room = ConditionClass()
+        new_value = (lambda: MP_CONTEXT.Value('q', 0, lock=False)) if transport == 'process' else _LocalValue
+        self._size = new_value()
+        # Set between reaching the high and the low watermark
+        self._paused = new_value()
+        self._dropped = new_value()
+        # Items of a batch message not handed out yet. Local to each process, which is where they were received
+        self._pending = collections.deque()
+
+    @classmethod
+    def from_config(cls, queue_config, transport='process'):
+        return cls(queue_config['name'],
+                   maxsize=queue_config.get('maxsize', 0),
+                   overflow=queue_config.get('overflow', 'block'),
+                   high_watermark=queue_config.get('high_watermark'),
+                   low_watermark=queue_config.get('low_watermark'),
+                   transport=transport)
+
+    def _has_room(self, count):
+        if self._paused.value:
+            return False
+        return self.maxsize <= 0 or self._size.value == 0 or self._size.value + count <= self.maxsize
+
+    def _put_message(self, message, block, timeout):
+        count = _item_count(message)
+        with self._room:
+            if self._overflow == 'drop_oldest':
+                self._drop_oldest(count)
+            else:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self._has_room(count):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if not block or (remaining is not None and remaining <= 0):
+                        raise Full
+                    self._room.wait(remaining)
+            self._size.value += count
+            if self._high_watermark is not None and self._size.value >= self._high_watermark:
+                self._paused.value = 1
+            # Never blocks, the underlying queue is unbounded
+            self._queue.put(message)
+
+    def _drop_oldest(self, count):
+        # DONE sentinels met on the way are never dropped, a consumer or a retiring instance waits for each
+        # of them. They go back behind the items kept, which only ever moves an end-of-stream later
+        kept = []
+        try:
+            while self._size.value > len(kept) and self._size.value - len(kept) + count > self.maxsize:
+                try:
+                    # A message counted in _size can still be on its way through the pipe of a process queue
+                    dropped = self._queue.get(timeout=0.1)
+                except Empty:
+                    # ... or already taken by a consumer that waits for the lock, it makes room itself then
+                    return
+                if is_done(dropped):
+                    kept.append(dropped)
+                    continue
+                self._size.value -= _item_count(dropped)
+                self._dropped.value += _item_count(dropped)
+        finally:
+            for sentinel in kept:
+                self._queue.put(sentinel)
+
+    def put(self, item, block=True, timeout=None):
+        self._put_message(item, block, timeout)
+
+    def put_many(self, items, block=True, timeout=None):
+        if items:
+            self._put_message(_Batch(list(items)), block, timeout)
+
+    def put_sentinel(self, item):
+        """
+        Control messages such as the end-of-stream marker must neither be dropped nor held back by the
+        bound or the watermarks, so they bypass both.
+        """
+        with self._room:
+            self._size.value += 1
+            self._queue.put(item)
+
+    def get(self, block=True, timeout=None):
+        try:
+            return self._pending.popleft()
+        except IndexError:
+            pass
+
+        message = self._queue.get(block, timeout)
+        with self._room:
+            self._size.value -= _item_count(message)
+            if self._paused.value and self._size.value <= self._low_watermark:
+                self._paused.value = 0
+            self._room.notify_all()
+        if isinstance(message, _Batch):
+            self._pending.extend(message.items[1:])
+            return message.items[0]
+        return message
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        """
+        Waits for the first item like get(), then keeps collecting until max_items are there or `linger`
+        seconds have passed, whichever comes first. With no linger only items already queued are taken.
+        A batch always ends at the DONE sentinel, so every consumer still gets its own.
+        """
+        items = [self.get(block, timeout)]
+        deadline = time.monotonic() + linger
+        while len(items) < max_items and not is_done(items[-1]):
+            remaining = deadline - time.monotonic()
+            try:
+                items.append(self.get(timeout=remaining) if remaining > 0 else self.get_nowait())
+            except Empty:
+                break
+        return items
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def qsize(self):
+        return self._size.value + len(self._pending)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def dropped(self):
+        return self._dropped.value
+
+    def cleanup(self):
+        pass
+
+
+# Field types of a ring buffer record schema and their struct codes. Text fields are declared with
+# their width in bytes, e.g. str16 (utf-8, decoded to str) or bytes16 (kept as bytes).
+# datetime fields hold naive UTC datetimes, stored as int64 microseconds since the epoch.
+RECORD_FIELD_TYPES = {
+    'float64': 'd',
+    'float32': 'f',
+    'int64': 'q',
+    'int32': 'i',
+    'datetime': 'q',
+}
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_HEADER = struct.Struct('<QQ')
+_DATA_RECORD = 0
+_CONTROL_RECORD = 1
+
+
+class RecordSchema():
+    """
+    Fixed layout of the records of a RingBufferQueue, declared in the YAML as a list of
+    `{name: ..., type: ...}` fields. Records are tuples in field order, or plain values when
+    the schema has a single field. None in a float field is stored as NaN and read back as None.
+    """
+    def __init__(self, fields):
+        self.fields = [(field['name'], field['type']) for field in fields]
+        if not self.fields:
+            raise ValueError('A record schema needs at least one field')
+        codes = []
+        for name, field_type in self.fields:
+            codes.append(self._struct_code(name, field_type))
+        # The leading byte tells data records apart from control records such as end-of-stream
+        self._struct = struct.Struct('<B' + ''.join(codes))
+        self.size = self._struct.size
+
+    def __reduce__(self):
+        # struct.Struct cannot be pickled, spawned workers rebuild the schema from its fields
+        return (RecordSchema, ([{'name': name, 'type': field_type} for name, field_type in self.fields],))
+
+    @staticmethod
+    def _struct_code(name, field_type):
+        if field_type in RECORD_FIELD_TYPES:
+            return RECORD_FIELD_TYPES[field_type]
+        for prefix in ('str', 'bytes'):
+            if field_type.startswith(prefix) and field_type[len(prefix):].isdigit():
+                return f'{field_type[len(prefix):]}s'
+        raise ValueError(f"Unknown type '{field_type}' for record field {name}")
+
+    def pack(self, record, kind=_DATA_RECORD):
+        if kind == _CONTROL_RECORD:
+            values = [self._empty_value(field_type) for name, field_type in self.fields]
+        else:
+            if len(self.fields) == 1:
+                record = (record,)
+            values = [self._encode(name, field_type, value) for (name, field_type), value in zip(self.fields, record)]
+        return self._struct.pack(kind, *values)
+
+    def unpack_from(self, buffer, offset):
+        kind, *values = self._struct.unpack_from(buffer, offset)
+        if kind == _CONTROL_RECORD:
+            return kind, None
+        record = tuple(self._decode(field_type, value) for (name, field_type), value in zip(self.fields, values))
+        return kind, record[0] if len(record) == 1 else record
+
+    @staticmethod
+    def _empty_value(field_type):
+        if field_type.startswith('str') or field_type.startswith('bytes'):
+            return b''
+        return 0
+
+    @staticmethod
+    def _encode(name, field_type, value):
+        if field_type == 'datetime':
+            delta = value - _EPOCH
+            return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        if field_type.startswith('str') or field_type.startswith('bytes'):
+            if field_type.startswith('str'):
+                encoded, width = value.encode('utf-8'), int(field_type[len('str'):])
+            else:
+                encoded, width = value, int(field_type[len('bytes'):])
+            # struct would silently cut the value, possibly in the middle of a multi-byte character
+            if len(encoded) > width:
+                raise ValueError(f"Value {value!r} does not fit into record field {name} of type {field_type}")
+            return encoded
+        if field_type.startswith('float') and value is None:
+            return math.nan
+        return value
+
+    @staticmethod
+    def _decode(field_type, value):
+        if field_type == 'datetime':
+            return _EPOCH + datetime.timedelta(microseconds=value)
+        if field_type.startswith('str'):
+            return value.rstrip(b'\0').decode('utf-8')
+        if field_type.startswith('bytes'):
+            return value.rstrip(b'\0')
+        if field_type.startswith('float') and math.isnan(value):
+            return None
+        return value
+
+
+class RingBufferQueue():
+    """
+    Bounded queue of fixed-size records in a multiprocessing.shared_memory block, for high-rate edges
+    between process-backed stages. Producers pack their tuples straight into a free slot and consumers
+    unpack them, so nothing is pickled and nothing goes through a pipe. Two semaphores count the free
+    and the filled slots, the lock only guards the head/tail counters in the header of the block.
+
+    Control messages (the end-of-stream marker) are not records; they are put on a small side queue and
+    a control record keeps their position in the ring, so they are still seen in order. Control messages
+    are interchangeable markers, two consumers reading control records at the same time may swap them.
+    """
+    def __init__(self, name, schema, capacity=65536):
+        if capacity <= 0:
+            raise ValueError(f"Ring buffer {name} needs a positive capacity")
+        self.name = name
+        self.maxsize = capacity
+        self.transport = 'shared_memory'
+        self.schema = schema
+        self._capacity = capacity
+        self._shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + capacity * schema.size)
+        _HEADER.pack_into(self._shm.buf, 0, 0, 0)
+        self._owner = True
+        self._lock = MP_CONTEXT.Lock()
+        self._free_slots = MP_CONTEXT.Semaphore(capacity)
+        self._filled_slots = MP_CONTEXT.Semaphore(0)
+        self._control = MP_CONTEXT.Queue()
+
+    @classmethod
+    def from_config(cls, queue_config, transport=None):
+        for option in ('overflow', 'high_watermark', 'low_watermark'):
+            if option in queue_config:
+                raise ValueError(f"Ring buffer {queue_config['name']} always blocks when full, {option} is not supported")
+        return cls(queue_config['name'], RecordSchema(queue_config['record']),
+                   capacity=queue_config.get('capacity', queue_config.get('maxsize', 65536)))
+
+    def __getstate__(self):
+        # Process-backed workers re-attach to the block by name instead of copying it
+        state = self.__dict__.copy()
+        state['_shm'] = self._shm.name
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=state['_shm'])
+
+    def _offset(self, index):
+        return _HEADER.size + (index % self._capacity) * self.schema.size
+
+    def _write(self, packed_records):
+        # Records are packed before a slot is reserved, so a record that does not match the schema never
+        # holds on to a permit
+        buffer = self._shm.buf
+        size = self.schema.size
+        with self._lock:
+            head, tail = _HEADER.unpack_from(buffer, 0)
+            for packed in packed_records:
+                offset = self._offset(head)
+                buffer[offset:offset + size] = packed
+                head += 1
+            _HEADER.pack_into(buffer, 0, head, tail)
+        for _ in packed_records:
+            self._filled_slots.release()
+
+    def _read(self, count):
+        # Stops right after a control record; the permits of the records left unread are handed back.
+        # The control message itself is fetched from the side queue only once the ring lock is released.
+        buffer = self._shm.buf
+        items = []
+        control_record_read = False
+        with self._lock:
+            head, tail = _HEADER.unpack_from(buffer, 0)
+            while len(items) < count:
+                kind, record = self.schema.unpack_from(buffer, self._offset(tail))
+                items.append(record)
+                tail += 1
+                if kind == _CONTROL_RECORD:
+                    control_record_read = True
+                    break
+            _HEADER.pack_into(buffer, 0, head, tail)
+        for _ in range(count - len(items)):
+            self._filled_slots.release()
+        for _ in items:
+            self._free_slots.release()
+        if control_record_read:
+            items[-1] = self._control.get()
+        return items
+
+    def put(self, item, block=True, timeout=None):
+        packed = self.schema.pack(item)
+        if not self._free_slots.acquire(block, timeout):
+            raise Full
+        self._write([packed])
+
+    def put_many(self, items, block=True, timeout=None):
+        # Packs everything first, then reserves the slots of a whole chunk and writes it under one lock.
+        # When the slots of a chunk cannot be reserved in time, the chunks before it are already written.
+        packed_records = [self.schema.pack(item) for item in items]
+        for start in range(0, len(packed_records), self._capacity):
+            chunk = packed_records[start:start + self._capacity]
+            for reserved in range(len(chunk)):
+                if not self._free_slots.acquire(block, timeout):
+                    for _ in range(reserved):
+                        self._free_slots.release()
+                    raise Full
+            self._write(chunk)
+
+    def put_sentinel(self, item):
+        self._control.put(item)
+        packed = self.schema.pack(None, kind=_CONTROL_RECORD)
+        self._free_slots.acquire()
+        self._write([packed])
+
+    def get(self, block=True, timeout=None):
+        if not self._filled_slots.acquire(block, timeout):
+            raise Empty
+        return self._read(1)[0]
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        """
+        Waits for the first record like get(), then reserves further records until max_items are there or
+        `linger` seconds have passed, and unpacks them all under a single lock acquisition.
+        """
+        if not self._filled_slots.acquire(block, timeout):
+            raise Empty
+        count = 1
+        deadline = time.monotonic() + linger
+        while count < max_items:
+            remaining = deadline - time.monotonic()
+            if not (self._filled_slots.acquire(True, remaining) if remaining > 0 else self._filled_slots.acquire(False)):
+                break
+            count += 1
+        return self._read(count)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def qsize(self):
+        head, tail = _HEADER.unpack_from(self._shm.buf, 0)
+        return head - tail
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def dropped(self):
+        return 0
+
+    def cleanup(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class _Pickled():
+    # An item of a process topic, pickled once by the publisher and sent as is to every subscriber
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __getstate__(self):
+        return self.payload
+
+    def __setstate__(self, payload):
+        self.payload = payload
+
+
+class TopicQueue():
+    """
+    Broadcast queue: every stage reading it (a subscriber) sees every item, the instances of one stage
+    share that stage's subscription like they share a plain queue. Producers publish once with put() or
+    put_many(), whatever the number of subscribers. Items must not be modified after publishing, since
+    subscribers may hold the same object.
+
+    With the thread transport the items are kept once in a log and each subscription is a cursor into
+    it; an item is released when the slowest cursor has passed it, and `maxsize` bounds that lag.
+    With the process transport each item is pickled once and the same bytes are handed to one
+    multiprocessing queue per subscriber, which then holds `maxsize` items at most.
+
+    The executor calls subscribe() once per consuming stage before any item is published.
+    """
+    def __init__(self, name, maxsize=0, transport='process'):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport '{transport}' for queue {name}, expected one of {tuple(TRANSPORTS)}")
+        self.name = name
+        self.maxsize = maxsize
+        self.transport = transport
+        self._subscriptions = {}
+        if transport == 'thread':
+            self._log = collections.deque()
+            # Position of the first item still in the log
+            self._base = 0
+            self._changed = threading.Condition()
+
+    @classmethod
+    def from_config(cls, queue_config, transport='process'):
+        for option in ('overflow', 'high_watermark', 'low_watermark'):
+            if option in queue_config:
+                raise ValueError(f"Topic {queue_config['name']} always blocks when full, {option} is not supported")
+        return cls(queue_config['name'], maxsize=queue_config.get('maxsize', 0), transport=transport)
+
+    def subscribe(self, subscriber):
+        if subscriber not in self._subscriptions:
+            if self.transport == 'thread':
+                self._subscriptions[subscriber] = _LogSubscription(self, f'{self.name}.{subscriber}')
+            else:
+                self._subscriptions[subscriber] = _ProcessSubscription(
+                    PipelineQueue(f'{self.name}.{subscriber}', maxsize=self.maxsize, transport='process'))
+        return self._subscriptions[subscriber]
+
+    def _end(self):
+        return self._base + len(self._log)
+
+    def _trim(self):
+        # Called with the condition held, after a cursor moved
+        oldest = min(subscription.cursor for subscription in self._subscriptions.values())
+        while self._base < oldest:
+            self._log.popleft()
+            self._base += 1
+
+    def _publish(self, items, block, timeout):
+        # Nobody could ever read an item published without subscribers
+        if not items or not self._subscriptions:
+            return
+        if self.transport != 'thread':
+            pickled = [_Pickled(pickle.dumps(item, pickle.HIGHEST_PROTOCOL)) for item in items]
+            for subscription in self._subscriptions.values():
+                subscription.queue.put_many(pickled, block=block, timeout=timeout)
+            return
+        with self._changed:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            # Same rule as PipelineQueue: a batch larger than maxsize only enters an empty log
+            while self.maxsize > 0 and self._log and len(self._log) + len(items) > self.maxsize:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Full
+                self._changed.wait(remaining)
+            self._log.extend(items)
+            self._changed.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        self._publish([item], block, timeout)
+
+    def put_many(self, items, block=True, timeout=None):
+        self._publish(list(items), block, timeout)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def put_sentinel(self, item):
+        for subscription in self._subscriptions.values():
+            subscription.put_sentinel(item)
+
+    def qsize(self):
+        """
+        Items the slowest subscriber has not read yet
+        """
+        return max((subscription.qsize() for subscription in self._subscriptions.values()), default=0)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def dropped(self):
+        return 0
+
+    def cleanup(self):
+        pass
+
+
+class _LogSubscription():
+    # Cursor of one subscriber into the log of an in-process TopicQueue
+    def __init__(self, topic, name):
+        self.name = name
+        self.cursor = topic._end()
+        self._topic = topic
+        # Control messages with the log position they were put at, delivered once the cursor gets there
+        self._sentinels = collections.deque()
+
+    def _take(self):
+        # Called with the topic's condition held, raises Empty when there is nothing to read
+        topic = self._topic
+        if self._sentinels and self._sentinels[0][0] <= self.cursor:
+            return self._sentinels.popleft()[1]
+        if self.cursor < topic._end():
+            item = topic._log[self.cursor - topic._base]
+            self.cursor += 1
+            topic._trim()
+            topic._changed.notify_all()
+            return item
+        raise Empty
+
+    def get(self, block=True, timeout=None):
+        changed = self._topic._changed
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with changed:
+            while True:
+                try:
+                    return self._take()
+                except Empty:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if not block or (remaining is not None and remaining <= 0):
+                        raise
+                    changed.wait(remaining)
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        items = [self.get(block, timeout)]
+        deadline = time.monotonic() + linger
+        while len(items) < max_items and not is_done(items[-1]):
+            remaining = deadline - time.monotonic()
+            try:
+                items.append(self.get(timeout=remaining) if remaining > 0 else self.get_nowait())
+            except Empty:
+                break
+        return items
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_sentinel(self, item):
+        with self._topic._changed:
+            self._sentinels.append((self._topic._end(), item))
+            self._topic._changed.notify_all()
+
+    def qsize(self):
+        return self._topic._end() - self.cursor + len(self._sentinels)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def dropped(self):
+        return 0
+
+    def cleanup(self):
+        pass
+
+
+class _ProcessSubscription():
+    # Queue of one subscriber of a process TopicQueue, unpickles what the publisher pickled once
+    def __init__(self, queue):
+        self.queue = queue
+        self.name = queue.name
+
+    @staticmethod
+    def _unwrap(item):
+        return pickle.loads(item.payload) if isinstance(item, _Pickled) else item
+
+    def get(self, block=True, timeout=None):
+        return self._unwrap(self.queue.get(block, timeout))
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        return [self._unwrap(item) for item in self.queue.get_many(max_items, linger=linger, block=block,
+                                                                     timeout=timeout)]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_sentinel(self, item):
+        self.queue.put_sentinel(item)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    @property
+    def dropped(self):
+        return 0
+
+    def cleanup(self):
+        pass
+
+
+class PartitionedQueue():
+    """
+    Queue split into `partitions` sub-queues by a key of the items, so that all items with the same key reach
+    the same worker instance, in the order they were put. The key is the item itself, or field `key_field`
+    of tuple items, and is routed by the crc32 of its repr(), which every process computes the same way.
+
+    Every consuming instance reads through its own consumer(), which joins the queue as a member with its
+    first read. The partitions are dealt out round robin over the members and have one owner at a time.
+    Whenever a member joins or leaves, they are dealt out again: the old owner hands a partition over at
+    its next read, once it has finished what it took from it, and only then does the new owner start
+    reading it. So no key is ever processed by two instances at once, and each instance keeps seeing the
+    same keys, which is what its caches and ordered writes rely on.
+
+    Control messages such as DONE go to one queue shared by the members. A member takes one only once the
+    partitions dealt to it are all empty, and leaves the queue with a DONE. Bounds and watermarks apply to
+    each partition. There should be at least as many partitions as instances, the others stay idle.
+
+    A member with nothing to read sleeps on one condition of the queue, which every put, DONE and change
+    of the members or owners notifies, so idle members neither poll nor miss work in another partition.
+    """
+    # How long a member waits for an item counted in a partition that is still in the pipe of a process queue
+    IN_FLIGHT_WAIT = 0.01
+    MAX_MEMBERS = 1024
+
+    def __init__(self, name, partitions=8, key_field=None, maxsize=0, overflow='block', high_watermark=None,
+                 low_watermark=None, transport='process'):
+        if partitions < 1:
+            raise ValueError(f"Queue {name} needs at least one partition")
+        self.name = name
+        self.key_field = key_field
+        self.maxsize = maxsize
+        self.transport = transport
+        self.partitions = [PipelineQueue(f'{name}.{i}', maxsize=maxsize, overflow=overflow,
+                                         high_watermark=high_watermark, low_watermark=low_watermark,
+                                         transport=transport)
+                           for i in range(partitions)]
+        self._control = PipelineQueue(f'{name}.control', transport=transport)
+        # Notified whenever there may be something new to read. Counts the notifications, so that a member
+        # only goes to sleep when nothing happened since it last looked
+        self._changed = TRANSPORTS[transport][1]()
+        if transport == 'process':
+            self._version = MP_CONTEXT.Value('q', 0, lock=False)
+            self._lock = MP_CONTEXT.Lock()
+            self._members = MP_CONTEXT.Array('b', self.MAX_MEMBERS, lock=False)
+            self._next_member = MP_CONTEXT.Value('i', 0, lock=False)
+            # Partition -> member it is dealt to, and member currently reading it. -1 for none
+            self._assigned = MP_CONTEXT.Array('i', [-1] * partitions, lock=False)
+            self._owners = MP_CONTEXT.Array('i', [-1] * partitions, lock=False)
+        else:
+            self._version = _LocalValue()
+            self._lock = threading.Lock()
+            self._members = bytearray(self.MAX_MEMBERS)
+            self._next_member = _LocalValue()
+            self._assigned = [-1] * partitions
+            self._owners = [-1] * partitions
+
+    @classmethod
+    def from_config(cls, queue_config, transport='process'):
+        return cls(queue_config['name'],
+                   partitions=queue_config.get('partitions', 8),
+                   key_field=queue_config.get('key_field'),
+                   maxsize=queue_config.get('maxsize', 0),
+                   overflow=queue_config.get('overflow', 'block'),
+                   high_watermark=queue_config.get('high_watermark'),
+                   low_watermark=queue_config.get('low_watermark'),
+                   transport=transport)
+
+    def partition_of(self, item):
+        item = unwrap(item)
+        key = item if self.key_field is None else item[self.key_field]
+        return zlib.crc32(repr(key).encode('utf-8')) % len(self.partitions)
+
+    def _notify(self):
+        with self._changed:
+            self._version.value += 1
+            self._changed.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        self.partitions[self.partition_of(item)].put(item, block, timeout)
+        self._notify()
+
+    def put_many(self, items, block=True, timeout=None):
+        by_partition = {}
+        for item in items:
+            by_partition.setdefault(self.partition_of(item), []).append(item)
+        for partition, partition_items in by_partition.items():
+            self.partitions[partition].put_many(partition_items, block=block, timeout=timeout)
+        if by_partition:
+            self._notify()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def put_sentinel(self, item):
+        self._control.put_sentinel(item)
+        self._notify()
+
+    def consumer(self, leave_on_done=True):
+        """
+        Returns the reading end of one instance. The asyncio instances of a process share one consumer that
+        stays a member after a DONE, since their other coroutines keep reading through it.
+        """
+        return _PartitionConsumer(self, leave_on_done)
+
+    def _deal(self):
+        # Called with the lock held, after the members changed
+        members = [member for member in range(self._next_member.value) if self._members[member]]
+        for partition in range(len(self.partitions)):
+            self._assigned[partition] = members[partition % len(members)] if members else -1
+
+    def _join(self):
+        with self._lock:
+            member = self._next_member.value
+            if member >= self.MAX_MEMBERS:
+                raise ValueError(f"Queue {self.name} had more than {self.MAX_MEMBERS} consumers")
+            self._next_member.value += 1
+            self._members[member] = 1
+            self._deal()
+        self._notify()
+        return member
+
+    def _leave(self, member):
+        with self._lock:
+            self._members[member] = 0
+            for partition in range(len(self.partitions)):
+                if self._owners[partition] == member:
+                    self._owners[partition] = -1
+            self._deal()
+        self._notify()
+
+    def _claim(self, member):
+        """
+        Hands over the partitions member no longer gets and takes the ones dealt to it that are free.
+        Returns the partitions it owns now, and whether it owns all that are dealt to it.
+        """
+        owned = []
+        complete = True
+        handed_over = False
+        with self._lock:
+            for partition in range(len(self.partitions)):
+                # Items of a batch message not handed out yet are local to this process, they are read first
+                if self._owners[partition] == member and self._assigned[partition] != member and \
+                        not self.partitions[partition]._pending:
+                    self._owners[partition] = -1
+                    handed_over = True
+                if self._owners[partition] == -1 and self._assigned[partition] == member:
+                    self._owners[partition] = member
+                if self._owners[partition] == member:
+                    owned.append(partition)
+                elif self._assigned[partition] == member:
+                    complete = False
+        if handed_over:
+            # The member the partition is dealt to may be waiting for it
+            self._notify()
+        return owned, complete
+
+    def qsize(self):
+        return sum(partition.qsize() for partition in self.partitions) + self._control.qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def dropped(self):
+        return sum(partition.dropped for partition in self.partitions)
+
+    def cleanup(self):
+        pass
+
+
+class _PartitionConsumer():
+    # Reading end of one member of a PartitionedQueue
+    def __init__(self, queue, leave_on_done):
+        self.name = queue.name
+        self._queue = queue
+        self._leave_on_done = leave_on_done
+        self._member = None
+        self._left = False
+        # Partition to look at first on the next read, so that a busy partition does not starve the others
+        self._next = 0
+
+    def _read(self, take, block, timeout):
+        queue = self._queue
+        if self._member is None:
+            self._member = queue._join()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            seen = queue._version.value
+            owned, complete = queue._claim(self._member) if not self._left else ([], True)
+            in_flight = False
+            for i in range(len(owned)):
+                partition = queue.partitions[owned[(self._next + i) % len(owned)]]
+                if partition.qsize() > 0:
+                    try:
+                        # A counted item may still be on its way through the pipe of a process queue
+                        items = take(partition, queue.IN_FLIGHT_WAIT)
+                    except Empty:
+                        in_flight = True
+                        continue
+                    self._next += i + 1
+                    return items
+            # An item still on its way is read before a DONE put after it
+            if complete and not in_flight and queue._control.qsize() > 0:
+                try:
+                    item = queue._control.get(timeout=queue.IN_FLIGHT_WAIT)
+                except Empty:
+                    in_flight = True
+                else:
+                    if is_done(item) and self._leave_on_done and not self._left:
+                        self._left = True
+                        queue._leave(self._member)
+                    return [item]
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not block or (remaining is not None and remaining <= 0):
+                raise Empty
+            if in_flight:
+                continue
+            with queue._changed:
+                if queue._version.value == seen:
+                    queue._changed.wait(remaining)
+
+    def get(self, block=True, timeout=None):
+        return self._read(lambda partition, wait: [partition.get(timeout=wait)], block, timeout)[0]
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        return self._read(lambda partition, wait: partition.get_many(max_items, linger=linger, timeout=wait),
+                          block, timeout)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_sentinel(self, item):
+        self._queue.put_sentinel(item)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+    @property
+    def dropped(self):
+        return self._queue.dropped
+
+    def cleanup(self):
+        pass
+
+
+class PersistentQueue():
+    """
+    Queue kept in a SQLite database file (`path`, by default `<name>.queue.sqlite3`), so its items survive
+    a crash of the pipeline and are picked up again by the next run.
+
+    An item read by a consumer is only claimed. take_receipts() right after a read returns the receipts of
+    its items, and acknowledge(receipts) deletes them once the consumer has handled them, e.g. written them
+    downstream or out to a sink; see acknowledge() below. Whatever is still claimed is deleted by
+    acknowledge_claimed() once the whole consuming stage has exited normally. Items still claimed when the
+    pipeline died are handed out again on the next start, so delivery is at-least-once. Control messages are
+    not kept across runs.
+
+    Every process and thread opens its own connection to the database. `maxsize` bounds the unread items
+    and always blocks producers when reached.
+    """
+    def __init__(self, name, path=None, maxsize=0, transport='process'):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport '{transport}' for queue {name}, expected one of {tuple(TRANSPORTS)}")
+        self.name = name
+        self.path = path if path is not None else f'{name}.queue.sqlite3'
+        self.maxsize = maxsize
+        self.transport = transport
+        # Producers waiting for room and consumers waiting for items sleep on it
+        self._changed = TRANSPORTS[transport][1]()
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'kind INTEGER NOT NULL, payload BLOB NOT NULL, claimed_by TEXT)')
+        connection.execute('DELETE FROM items WHERE kind = ?', (_CONTROL_RECORD,))
+        connection.execute('UPDATE items SET claimed_by = NULL WHERE claimed_by IS NOT NULL')
+        # Items left over by a previous run, which are delivered before anything new
+        self.resumed = self.qsize()
+
+    @classmethod
+    def from_config(cls, queue_config, transport='process'):
+        for option in ('overflow', 'high_watermark', 'low_watermark'):
+            if option in queue_config:
+                raise ValueError(f"Persistent queue {queue_config['name']} always blocks when full, "
+                                 f"{option} is not supported")
+        return cls(queue_config['name'], path=queue_config.get('path'), maxsize=queue_config.get('maxsize', 0),
+                   transport=transport)
+
+    def __getstate__(self):
+        # A sqlite3 connection cannot leave the process it was opened in
+        state = self.__dict__.copy()
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _consumer_id():
+        return f'{os.getpid()}:{threading.get_ident()}'
+
+    def _insert(self, rows, block=True, timeout=None, bounded=True):
+        connection = self._connection()
+        with self._changed:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while bounded and self.maxsize > 0:
+                # Same rule as PipelineQueue: a batch larger than maxsize only enters an empty queue
+                unread = self.qsize()
+                if unread == 0 or unread + len(rows) <= self.maxsize:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Full
+                self._changed.wait(remaining)
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT INTO items (kind, payload) VALUES (?, ?)', rows)
+            connection.execute('COMMIT')
+            self._changed.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        self._insert([(_DATA_RECORD, pickle.dumps(item, pickle.HIGHEST_PROTOCOL))], block, timeout)
+
+    def put_many(self, items, block=True, timeout=None):
+        # One transaction, so one sync of the log, for the whole batch
+        rows = [(_DATA_RECORD, pickle.dumps(item, pickle.HIGHEST_PROTOCOL)) for item in items]
+        if rows:
+            self._insert(rows, block, timeout)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def put_sentinel(self, item):
+        self._insert([(_CONTROL_RECORD, pickle.dumps(item, pickle.HIGHEST_PROTOCOL))], bounded=False)
+
+    def _claim(self, max_items):
+        # Claims up to max_items unread rows, stopping after a control row, which is deleted right away
+        connection = self._connection()
+        consumer_id = self._consumer_id()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute('SELECT id, kind, payload FROM items WHERE claimed_by IS NULL '
+                                      'ORDER BY id LIMIT ?', (max_items,)).fetchall()
+            for index, (row_id, kind, payload) in enumerate(rows):
+                if kind == _CONTROL_RECORD:
+                    rows = rows[:index + 1]
+                    connection.execute('DELETE FROM items WHERE id = ?', (row_id,))
+                    break
+            connection.executemany('UPDATE items SET claimed_by = ? WHERE id = ?',
+                                   [(consumer_id, row_id) for row_id, kind, payload in rows if kind == _DATA_RECORD])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self._local.receipts.extend(row_id for row_id, kind, payload in rows if kind == _DATA_RECORD)
+        return [pickle.loads(payload) for row_id, kind, payload in rows]
+
+    def _wait_for_items(self, max_items, block, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while True:
+                items = self._claim(max_items)
+                if items:
+                    self._changed.notify_all()
+                    return items
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Empty
+                self._changed.wait(remaining)
+
+    def get(self, block=True, timeout=None):
+        self._local.receipts = []
+        return self._wait_for_items(1, block, timeout)[0]
+
+    def get_many(self, max_items, linger=0, block=True, timeout=None):
+        self._local.receipts = []
+        items = self._wait_for_items(max_items, block, timeout)
+        deadline = time.monotonic() + linger
+        while len(items) < max_items and not is_done(items[-1]):
+            remaining = deadline - time.monotonic()
+            try:
+                items.extend(self._wait_for_items(max_items - len(items), remaining > 0, max(remaining, 0)))
+            except Empty:
+                break
+        return items
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def take_receipts(self):
+        """
+        Receipts of the items the last read of this thread handed out, DONE and control messages aside, in order
+        """
+        receipts, self._local.receipts = getattr(self._local, 'receipts', []), []
+        return receipts
+
+    def acknowledge(self, receipts):
+        """
+        Deletes the items of receipts, which their consumer has handled
+        """
+        if not receipts:
+            return
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany('DELETE FROM items WHERE id = ?', [(receipt,) for receipt in receipts])
+        connection.execute('COMMIT')
+
+    def acknowledge_claimed(self):
+        """
+        Called by the executor once every instance of the consuming stage has exited normally
+        """
+        with self._changed:
+            self._connection().execute('DELETE FROM items WHERE claimed_by IS NOT NULL')
+            self._changed.notify_all()
+
+    def qsize(self):
+        return self._connection().execute('SELECT COUNT(*) FROM items WHERE claimed_by IS NULL').fetchone()[0]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    @property
+    def dropped(self):
+        return 0
+
+    def cleanup(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+# Queue classes selectable with the `type:` key of a queue entry
+QUEUE_TYPES = {
+    'fifo': PipelineQueue,
+    'ring_buffer': RingBufferQueue,
+    'topic': TopicQueue,
+    'persistent': PersistentQueue,
+    'partitioned': PartitionedQueue,
+}
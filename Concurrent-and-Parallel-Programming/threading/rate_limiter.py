@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from pipeline_queues import MP_CONTEXT
+
+
+class TokenBucket():
+    """
+    Rate limiter shared by every instance of the stages using it, process-backed ones included, so the
+    aggregate rate stays at `rate` per second however many instances run. Up to `burst` tokens accumulate
+    while nobody asks for them and can be spent at once.
+
+    acquire() reserves its tokens under the lock and sleeps outside of it for as long as the bucket is
+    in debt, so waiting callers are served in the order they arrived and nobody sleeps longer than needed.
+    """
+    def __init__(self, name, rate, burst=None):
+        if rate <= 0:
+            raise ValueError(f"Rate limit {name} needs a positive rate")
+        if burst is None:
+            burst = max(1.0, rate)
+        if burst < 1:
+            raise ValueError(f"Rate limit {name} needs a burst of at least 1")
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self._lock = MP_CONTEXT.Lock()
+        # [tokens, time of the last refill, tokens granted, seconds spent waiting]. CLOCK_MONOTONIC is
+        # system wide, so the refill time means the same in every process.
+        self._state = MP_CONTEXT.Array('d', [burst, time.monotonic(), 0.0, 0.0], lock=False)
+
+    @classmethod
+    def from_config(cls, name, rate_limit_config):
+        return cls(name, rate=rate_limit_config['rate'], burst=rate_limit_config.get('burst'))
+
+    def _reserve(self, tokens):
+        # Returns how long the caller has to wait before its tokens are there
+        if tokens > self.burst:
+            raise ValueError(f"Cannot take {tokens} tokens at once from rate limit {self.name} with burst {self.burst}")
+        with self._lock:
+            now = time.monotonic()
+            state = self._state
+            state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[1] = now
+            state[0] -= tokens
+            wait = -state[0] / self.rate if state[0] < 0 else 0.0
+            state[2] += tokens
+            state[3] += wait
+            return wait
+
+    def acquire(self, tokens=1):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def snapshot(self):
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, 'acquired': self._state[2],
+                    'wait_seconds': self._state[3]}
@@ -0,0 +1,123 @@
+import builtins
+import collections
+import importlib
+import math
+import random
+import time
+
+# What a stage puts into its dead_letter_queue for an item it gave up on. `error` is the repr() of the last
+# exception, so that the record pickles whatever the exception holds.
+DeadLetter = collections.namedtuple('DeadLetter', ('stage', 'item', 'error', 'attempts', 'failed_at'))
+
+
+def _exception_class(name):
+    # 'ConnectionError' is a builtin, anything else is given as module.Class
+    if '.' not in name:
+        exception_class = getattr(builtins, name, None)
+    else:
+        module_name, class_name = name.rsplit('.', 1)
+        exception_class = getattr(importlib.import_module(module_name), class_name, None)
+    if not (isinstance(exception_class, type) and issubclass(exception_class, BaseException)):
+        raise ValueError(f"Retry policy names {name}, which is not an exception class")
+    return exception_class
+
+
+class RetryPolicy():
+    """
+    How often and how soon a stage retries an item whose processing raised, configured with:
+
+    max_attempts   attempts per item, the first one included, 3 by default
+    backoff        seconds before the second attempt, doubled for every further one, 0.5 by default
+    max_backoff    upper bound of the delay, 30 seconds by default
+    jitter         true (the default) waits a random time between 0 and the delay instead, so items that
+                   failed together are not all retried at the same moment
+    retry_on       exception classes worth retrying, builtins by name and others as module.Class.
+                   Exception by default; anything else fails the item at once
+    """
+    def __init__(self, name, max_attempts=3, backoff=0.5, max_backoff=30, jitter=True, retry_on=('Exception',)):
+        if max_attempts < 1:
+            raise ValueError(f"Retry policy {name} needs max_attempts of at least 1")
+        if backoff < 0 or max_backoff < backoff:
+            raise ValueError(f"Retry policy {name} needs 0 <= backoff <= max_backoff")
+        self.name = name
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = tuple(_exception_class(exception_name) for exception_name in retry_on)
+
+    @classmethod
+    def from_config(cls, name, retry_config):
+        return cls(name, **(retry_config or {}))
+
+    def should_retry(self, attempt, error):
+        """
+        Whether an item whose attempt number `attempt` raised error gets another one
+        """
+        return attempt < self.max_attempts and isinstance(error, self.retry_on)
+
+    def delay(self, attempt):
+        """
+        Seconds to wait after attempt number `attempt` failed
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+class TimerWheel():
+    """
+    Hashed timing wheel keeping entries until their delay has passed: `slots` buckets of `tick` seconds
+    each, an entry goes into the bucket of its deadline and stays there for as many turns of the wheel as
+    its delay needs. schedule() is O(1) however many entries are waiting, and expired() only looks at the
+    buckets the clock has passed since the last call. Deadlines are rounded up to the next tick.
+
+    Not thread safe: each worker instance keeps its own wheel and polls it from its own thread.
+    """
+    def __init__(self, tick=0.01, slots=512):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        # Ticks since the epoch of time.monotonic() up to which the entries were handed out
+        self._current = math.floor(time.monotonic() / tick)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, entry):
+        deadline = max(self._current + 1, math.ceil((time.monotonic() + delay) / self.tick))
+        self._slots[deadline % len(self._slots)].append((deadline, entry))
+        self._count += 1
+
+    def expired(self):
+        """
+        Removes and returns the entries whose deadline has passed, earliest first
+        """
+        target = math.floor(time.monotonic() / self.tick)
+        if self._count == 0 or target <= self._current:
+            self._current = max(self._current, target)
+            return []
+        # After a full turn every bucket has been looked at once
+        ticks = range(self._current + 1, min(target, self._current + len(self._slots)) + 1)
+        expired = []
+        for tick in ticks:
+            slot = self._slots[tick % len(self._slots)]
+            if slot:
+                expired.extend(timer for timer in slot if timer[0] <= target)
+                slot[:] = [timer for timer in slot if timer[0] > target]
+        self._current = target
+        self._count -= len(expired)
+        expired.sort(key=lambda timer: timer[0])
+        return [entry for _, entry in expired]
+
+    def next_expiry(self):
+        """
+        Seconds until the next bucket holding an entry comes up, None when nothing waits. The entry may need
+        further turns of the wheel, so this is a lower bound, which is all a caller deciding how long it
+        may sleep needs.
+        """
+        if self._count == 0:
+            return None
+        for tick in range(self._current + 1, self._current + len(self._slots) + 1):
+            if self._slots[tick % len(self._slots)]:
+                return max(0.0, tick * self.tick - time.monotonic())
+        return None
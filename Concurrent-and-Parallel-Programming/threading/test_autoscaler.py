@@ -0,0 +1,48 @@
+import pytest
+
+from autoscaler import Autoscaler
+
+
+def test_stage_without_bounds_is_not_autoscaled():
+    assert Autoscaler.from_config({'name': 'a', 'instances': 3}) is None
+
+
+def test_config_defaults_and_validation():
+    autoscaler = Autoscaler.from_config({'name': 'a', 'instances': 3, 'min_instances': 2})
+    assert (autoscaler.min_instances, autoscaler.max_instances, autoscaler.target_latency) == (2, 3, 1.0)
+    with pytest.raises(ValueError):
+        Autoscaler.from_config({'name': 'a', 'min_instances': 4, 'max_instances': 2})
+    with pytest.raises(ValueError):
+        Autoscaler.from_config({'name': 'a', 'max_instances': 2, 'target_latency': 0})
+
+
+def test_holds_until_a_service_time_was_measured():
+    autoscaler = Autoscaler('a', min_instances=1, max_instances=8)
+    assert autoscaler.desired_instances(2, depth=100, items=0, busy_seconds=0.0) == 2
+
+
+def test_grows_to_meet_the_target_latency_and_stops_at_max():
+    autoscaler = Autoscaler('a', min_instances=1, max_instances=8, target_latency=1.0)
+    # 10 items took 1 second, 30 waiting items need 3 seconds of work
+    assert autoscaler.desired_instances(1, depth=30, items=10, busy_seconds=1.0) == 3
+    assert autoscaler.service_time == pytest.approx(0.1)
+    assert autoscaler.desired_instances(3, depth=1000, items=20, busy_seconds=2.0) == 8
+
+
+def test_backlog_below_target_does_not_shrink_the_stage():
+    autoscaler = Autoscaler('a', min_instances=1, max_instances=8)
+    assert autoscaler.desired_instances(4, depth=2, items=10, busy_seconds=1.0) == 4
+
+
+def test_idle_stage_shrinks_one_instance_per_tick_down_to_min():
+    autoscaler = Autoscaler('a', min_instances=2, max_instances=8)
+    assert autoscaler.desired_instances(4, depth=0, items=0, busy_seconds=0.0) == 3
+    assert autoscaler.desired_instances(3, depth=0, items=0, busy_seconds=0.0) == 2
+    assert autoscaler.desired_instances(2, depth=0, items=0, busy_seconds=0.0) == 2
+
+
+def test_service_time_is_smoothed_over_ticks():
+    autoscaler = Autoscaler('a', min_instances=1, max_instances=8, smoothing=0.5)
+    autoscaler.desired_instances(1, depth=1, items=10, busy_seconds=1.0)
+    autoscaler.desired_instances(1, depth=1, items=20, busy_seconds=4.0)
+    assert autoscaler.service_time == pytest.approx(0.5 * 0.3 + 0.5 * 0.1)
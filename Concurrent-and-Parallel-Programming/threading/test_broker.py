@@ -0,0 +1,210 @@
+import csv
+import os
+import socket
+import time
+from multiprocessing import AuthenticationError
+from queue import Empty
+
+import pytest
+import yaml
+
+from broker import PipelineBroker, RemoteQueue, connect, parse_address
+from pipeline_queues import DONE, MP_CONTEXT, PartitionedQueue, PipelineQueue
+from workers.PipelineWorker import PipelineWorker
+from yaml_reader import YamlPipelineExecutor
+
+AUTHKEY = b'test'
+
+
+class NumberSource(PipelineWorker):
+    def __init__(self, output_queue, count=0, start_after=None, input_queue=None, **kwargs):
+        super(NumberSource, self).__init__(input_queue, output_queue, **kwargs)
+        self._count = count
+        self._start_after = start_after
+        self.start()
+
+    def produce(self):
+        while self._start_after is not None and not os.path.exists(self._start_after):
+            time.sleep(0.01)
+        for number in range(self._count):
+            yield (f'S{number}', number)
+
+
+class Doubler(PipelineWorker):
+    def __init__(self, input_queue, output_queue, **kwargs):
+        super(Doubler, self).__init__(input_queue, output_queue, **kwargs)
+        self.start()
+
+    def process(self, item):
+        symbol, number = item
+        return symbol, number * 2
+
+
+def _broker(queues, finished=None):
+    return PipelineBroker(('127.0.0.1', 0), AUTHKEY, queues.__getitem__, queues.__getitem__,
+                          lambda worker_name, failed: finished.append((worker_name, failed)))
+
+
+def test_remote_queues_put_and_get_through_the_broker():
+    queue = PipelineQueue('A', transport='thread')
+    finished = []
+    broker = _broker({'A': queue}, finished)
+    try:
+        remote = RemoteQueue(broker.address, AUTHKEY, 'A')
+        remote.put_many([1, 2, 3])
+        remote.put_sentinel(DONE)
+        assert queue.qsize() == 4
+        assert remote.get_many(10) == [1, 2, 3, DONE]
+        with pytest.raises(Empty):
+            remote.get(timeout=0.2)
+        connect(broker.address, AUTHKEY).control().stage_finished('double', False)
+        assert finished == [('double', False)]
+    finally:
+        broker.stop()
+
+
+def test_the_broker_turns_away_a_wrong_authkey():
+    broker = _broker({})
+    try:
+        with pytest.raises(AuthenticationError):
+            connect(broker.address, b'wrong')
+    finally:
+        broker.stop()
+
+
+def _read_all(queue, results):
+    items = []
+    while True:
+        items.extend(queue.get_many(10))
+        if items[-1] is DONE:
+            break
+    results.put(items[:-1])
+
+
+def test_remote_queues_connect_again_in_other_processes():
+    queue = PipelineQueue('A', transport='thread')
+    broker = _broker({'A': queue})
+    try:
+        queue.put_many(list(range(20)))
+        queue.put_sentinel(DONE)
+        results = MP_CONTEXT.Queue()
+        process = MP_CONTEXT.Process(target=_read_all, args=(RemoteQueue(broker.address, AUTHKEY, 'A'), results))
+        process.start()
+        assert results.get(timeout=30) == list(range(20))
+        process.join(30)
+        assert process.exitcode == 0
+    finally:
+        broker.stop()
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def _pipeline(tmp_path, start_after=None, **doubler):
+    pipeline = {
+        'broker': {'address': f'127.0.0.1:{_free_port()}', 'authkey': 'test'},
+        'queues': [{'name': 'Numbers', 'type': 'partitioned', 'partitions': 4, 'key_field': 0},
+                   {'name': 'Doubled'}],
+        'workers': [
+            {'name': 'Source', 'location': 'test_broker', 'class': 'NumberSource',
+             'params': {'count': 50, 'start_after': start_after},
+             'output_queues': ['Numbers']},
+            dict({'name': 'Double', 'location': 'test_broker', 'class': 'Doubler', 'node': 'doublers',
+                  'instances': 2, 'input_queue': 'Numbers', 'output_queues': ['Doubled']}, **doubler),
+            {'name': 'Sink', 'location': 'workers.CsvWorker', 'class': 'CsvSink', 'input_queue': 'Doubled',
+             'params': {'path': str(tmp_path / 'doubled.csv'), 'header': False}},
+        ],
+    }
+    path = tmp_path / 'pipeline.yaml'
+    path.write_text(yaml.safe_dump(pipeline))
+    return str(path)
+
+
+def _run_node(pipeline_location, node):
+    executor = YamlPipelineExecutor(pipeline_location=pipeline_location, node=node)
+    executor.start()
+    executor.join()
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_a_stage_runs_on_a_node_of_its_own(tmp_path, executor):
+    pipeline_location = _pipeline(tmp_path, executor=executor)
+    node = MP_CONTEXT.Process(target=_run_node, args=(pipeline_location, 'doublers'))
+    node.start()
+    try:
+        executor = YamlPipelineExecutor(pipeline_location=pipeline_location)
+        executor.start()
+        executor.join()
+    finally:
+        node.join(60)
+    assert node.exitcode == 0
+    with open(tmp_path / 'doubled.csv') as inFile:
+        rows = sorted(tuple(row) for row in csv.reader(inFile))
+    assert rows == sorted((f'S{number}', str(number * 2)) for number in range(50))
+
+
+def test_several_nodes_share_a_stage(tmp_path):
+    started = tmp_path / 'started'
+    pipeline_location = _pipeline(tmp_path, start_after=str(started))
+    nodes = [MP_CONTEXT.Process(target=_run_node, args=(pipeline_location, 'doublers')) for _ in range(2)]
+    for node in nodes:
+        node.start()
+    try:
+        executor = YamlPipelineExecutor(pipeline_location=pipeline_location)
+        executor.start()
+        # The source starts once both nodes joined, otherwise the first could be done before the second comes
+        deadline = time.monotonic() + 60
+        while executor._remote_running.get('Double', 0) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        started.touch()
+        executor.join(60)
+    finally:
+        for node in nodes:
+            node.join(60)
+    assert [node.exitcode for node in nodes] == [0, 0]
+    assert executor._queue_consumers['Numbers']['Double'] == 4
+    assert executor._queue_producers['Doubled'] == 0
+    with open(tmp_path / 'doubled.csv') as inFile:
+        rows = sorted(tuple(row) for row in csv.reader(inFile))
+    assert rows == sorted((f'S{number}', str(number * 2)) for number in range(50))
+
+
+def test_stages_on_nodes_need_a_broker_and_a_fixed_number_of_instances():
+    executor = YamlPipelineExecutor(pipeline_location=None)
+    executor._yaml_data = {'queues': [], 'workers': [{'name': 'a', 'node': 'n', 'input_queue': 'Q'}]}
+    with pytest.raises(ValueError):
+        executor._initialize_broker()
+
+    executor._yaml_data['broker'] = {'address': 'localhost:50000', 'authkey': 'test'}
+    executor._yaml_data['workers'][0]['max_instances'] = 4
+    with pytest.raises(ValueError):
+        executor._initialize_broker()
+    with pytest.raises(ValueError):
+        parse_address('localhost')
+
+
+def test_a_partitioned_stage_input_gives_each_remote_instance_its_own_consumer():
+    queue = PartitionedQueue('P', partitions=4, key_field=0, transport='thread')
+    consumers = {}
+    broker = PipelineBroker(('127.0.0.1', 0), AUTHKEY, {'P': queue}.__getitem__,
+                            lambda stage: consumers.setdefault(len(consumers), queue.consumer()),
+                            lambda worker_name, failed: None)
+    try:
+        first, second = (RemoteQueue(broker.address, AUTHKEY, 'P', stage='double').consumer() for _ in range(2))
+        assert first.qsize() == second.qsize() == 0
+        assert len(consumers) == 2
+    finally:
+        broker.stop()
+
+
+def test_nodes_are_turned_away_from_stages_they_do_not_run_or_that_finished():
+    executor = YamlPipelineExecutor(pipeline_location=None)
+    executor._remote_stages = {'Double': 'doublers'}
+    with pytest.raises(ValueError):
+        executor._remote_node_joined('fetchers', {'Double': 1})
+    executor._scaling_stopped.add('Double')
+    with pytest.raises(ValueError):
+        executor._remote_node_joined('doublers', {'Double': 1})
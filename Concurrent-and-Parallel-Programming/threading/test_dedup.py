@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from dedup import BloomFilter, DedupFilter, ExactFilter
+from pipeline_metrics import OutputQueueView, PipelineMetrics, StageStats
+from pipeline_queues import MP_CONTEXT, PipelineQueue
+from yaml_reader import YamlPipelineExecutor
+
+
+def test_only_the_first_copy_of_a_key_is_seen_first_per_scope():
+    dedup = ExactFilter('symbols', capacity=10)
+    assert [dedup.first_seen('Q', symbol) for symbol in ['AAPL', 'MSFT', 'AAPL']] == [True, True, False]
+    assert dedup.first_seen('R', 'AAPL')
+    assert dedup.snapshot() == {'type': 'exact', 'capacity': 10, 'passed': 3, 'duplicates': 1}
+
+
+def test_key_field_compares_one_field_of_tuple_items():
+    dedup = DedupFilter.from_config('rows', {'key_field': 0})
+    assert dedup.first_seen('Q', ('AAPL', 1.0))
+    assert not dedup.first_seen('Q', ('AAPL', 2.0))
+
+
+def test_full_exact_filter_lets_new_keys_through():
+    dedup = ExactFilter('symbols', capacity=2)
+    assert all(dedup.first_seen('Q', key) for key in range(5))
+    assert not dedup.first_seen('Q', 0)
+
+
+def test_bloom_filter_stays_near_its_error_rate():
+    dedup = BloomFilter('symbols', capacity=20000, error_rate=0.01)
+    for key in range(10000):
+        dedup.first_seen('Q', key)
+    # No false negatives
+    assert not any(dedup.first_seen('Q', key) for key in range(10000))
+    false_positives = sum(not dedup.first_seen('Q', f'new-{key}') for key in range(10000))
+    assert false_positives < 10000 * 0.01
+    # 9.6 bits per key
+    assert dedup.bits // 20000 == 9
+
+
+def test_invalid_configuration_is_rejected():
+    with pytest.raises(ValueError):
+        DedupFilter.from_config('symbols', {'type': 'cuckoo'})
+    with pytest.raises(ValueError):
+        BloomFilter('symbols', error_rate=1)
+    with pytest.raises(ValueError):
+        ExactFilter('symbols', capacity=0)
+
+
+def test_output_views_drop_what_another_instance_already_wrote():
+    queue = PipelineQueue('SymbolQueue', transport='thread')
+    stats = StageStats('wiki')
+    dedup = ExactFilter('symbols')
+    views = [OutputQueueView(queue, stats, dedup) for _ in range(4)]
+    threads = [threading.Thread(target=view.put_many, args=([f'S{i}' for i in range(500)],)) for view in views]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(queue.get_many(5000)) == sorted(f'S{i}' for i in range(500))
+    assert stats.snapshot()['items_out'] == 500
+    assert dedup.snapshot()['duplicates'] == 1500
+
+
+def _put_symbols(queue, dedup, count):
+    OutputQueueView(queue, StageStats('wiki'), dedup).put_many([f'S{i}' for i in range(count)])
+
+
+@pytest.mark.parametrize('dedup', [ExactFilter('symbols'), BloomFilter('symbols', capacity=10000)])
+def test_processes_share_one_filter(dedup):
+    queue = PipelineQueue('SymbolQueue', transport='process')
+    processes = [MP_CONTEXT.Process(target=_put_symbols, args=(queue, dedup, 200)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    items = []
+    while len(items) < 200:
+        items.extend(queue.get_many(200, timeout=10))
+    for process in processes:
+        process.join()
+    assert sorted(items) == sorted(f'S{i}' for i in range(200))
+    assert dedup.snapshot()['duplicates'] == 400
+
+
+def test_dedup_entries_are_handed_to_workers_by_name():
+    executor = YamlPipelineExecutor(pipeline_location=None)
+    executor._yaml_data = {'queues': [], 'workers': [],
+                           'dedup_filters': {'symbols': {'type': 'bloom', 'capacity': 1000}}}
+    executor._metrics = PipelineMetrics()
+    executor._initialize_dedup_filters()
+    assert executor._stage_dedup_filter({'name': 'a', 'dedup': 'symbols'}) is executor._dedup_filters['symbols']
+    assert isinstance(executor._stage_dedup_filter({'name': 'b', 'dedup': {}}), ExactFilter)
+    assert executor._stage_dedup_filter({'name': 'c'}) is None
+    with pytest.raises(ValueError):
+        executor._stage_dedup_filter({'name': 'd', 'dedup': 'missing'})
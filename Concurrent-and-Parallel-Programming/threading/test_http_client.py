@@ -0,0 +1,75 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('requests')
+
+from workers.HttpClient import HttpClient  # noqa: E402
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @staticmethod
+    def initial_state():
+        return {'connections': set(), 'requests': 0, 'failures': 0}
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.requests += 1
+            failing = server.failures > 0
+            server.failures -= 1
+        status, body = (503, b'busy') if failing else (200, b'ok')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def handler():
+    return _Handler
+
+
+def _url(server):
+    return f'http://127.0.0.1:{server.server_address[1]}/quote'
+
+
+def test_threads_reuse_at_most_max_connections_per_host(server):
+    client = HttpClient('test', max_connections_per_host=2).acquire()
+
+    def fetch():
+        for _ in range(10):
+            assert client.get(_url(server)).status_code == 200
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.release()
+    assert server.requests == 40
+    assert len(server.connections) <= 2
+
+
+def test_failed_responses_are_retried_with_backoff(server):
+    server.failures = 2
+    client = HttpClient('test', retries=3, backoff_factor=0.01).acquire()
+    assert client.get(_url(server)).status_code == 200
+    assert server.requests == 3
+    # Once the retries are used up the last response is returned
+    server.failures = 5
+    assert client.get(_url(server)).status_code == 503
+    client.release()
+
+
+def test_clients_are_shared_per_process_by_name():
+    assert HttpClient.shared({'name': 'yahoo', 'timeout': 5}) is HttpClient.shared({'name': 'yahoo'})
+    assert HttpClient.shared() is HttpClient.shared({'name': 'default'})
+    assert HttpClient.shared({'name': 'yahoo'}).timeout == 5
@@ -0,0 +1,88 @@
+import json
+import urllib.request
+
+import pytest
+
+from pipeline_metrics import (LATENCY_BUCKETS, InstanceStats, OutputQueueView, PipelineMetrics, StageQueueView,
+                              StageStats)
+from pipeline_queues import DONE, PipelineQueue
+
+
+def test_views_count_items_in_and_out_and_skip_done():
+    queue = PipelineQueue('Q', transport='thread')
+    out = PipelineQueue('R', transport='thread')
+    stats = StageStats('stage')
+    instance = InstanceStats('stage-0')
+    view = StageQueueView(queue, stats, instance)
+    queue.put_many([1, 2, 3])
+    queue.put_sentinel(DONE)
+
+    assert view.get_many(10) == [1, 2, 3, DONE]
+    OutputQueueView(out, stats).put_many([2, 4, 6])
+    snapshot = stats.snapshot()
+    assert (snapshot['items_in'], snapshot['items_out']) == (3, 3)
+    # Processing time is only known at the next read
+    assert snapshot['items_processed'] == 0
+    assert view.qsize() == 0 and out.qsize() == 3
+
+
+def test_processing_time_is_recorded_at_the_next_read():
+    queue = PipelineQueue('Q', transport='thread')
+    stats = StageStats('stage')
+    instance = InstanceStats('stage-0')
+    view = StageQueueView(queue, stats, instance)
+    queue.put_many([1, 2])
+    view.get_many(2)
+    queue.put(3)
+    view.get()
+    snapshot = stats.snapshot()
+    assert snapshot['items_processed'] == 2
+    assert sum(snapshot['latency_buckets']) == 2
+    assert instance.snapshot()['busy_seconds'] == pytest.approx(snapshot['busy_seconds'])
+
+
+def test_latency_lands_in_the_matching_bucket():
+    stats = StageStats('stage')
+    # 4 items in 2 seconds is 0.5 seconds per item
+    stats.record_processed(4, 2.0)
+    stats.record_processed(1, 60.0)
+    buckets = stats.snapshot()['latency_buckets']
+    assert buckets[LATENCY_BUCKETS.index(0.5)] == 4
+    assert buckets[-1] == 1
+
+
+def test_queue_wait_follows_littles_law():
+    queue = PipelineQueue('Q', transport='thread')
+    stats = StageStats('stage')
+    metrics = PipelineMetrics()
+    metrics.add_queue(queue)
+    metrics.add_stage(stats, input_queue='Q')
+    wait = metrics._queue_wait['Q']
+    # 10 items waited for 2 seconds, then all of them were taken
+    wait.sample(10, 0.0)
+    wait.sample(10, 2.0)
+    stats.record_input(10)
+    assert metrics.snapshot()['queues']['Q']['mean_wait_seconds'] == pytest.approx(2.0)
+
+
+def test_snapshot_file_and_prometheus_endpoint(tmp_path):
+    queue = PipelineQueue('Q', transport='thread')
+    stats = StageStats('stage')
+    metrics = PipelineMetrics(snapshot_path=str(tmp_path / 'metrics.json'), port=0)
+    metrics.add_queue(queue)
+    metrics.add_stage(stats, input_queue='Q')
+    metrics.add_instance('stage', InstanceStats('stage-0'))
+    stats.record_input(3)
+    stats.record_processed(3, 0.3)
+    metrics.start()
+    try:
+        text = urllib.request.urlopen(f'http://127.0.0.1:{metrics.port}/metrics').read().decode()
+    finally:
+        metrics.stop()
+
+    assert 'pipeline_stage_items_in_total{stage="stage"} 3' in text
+    assert 'pipeline_stage_latency_seconds_bucket{stage="stage",le="+Inf"} 3' in text
+    assert 'pipeline_instance_busy_seconds_total{stage="stage",instance="stage-0"} 0.0' in text
+    assert 'pipeline_queue_depth{queue="Q"} 0' in text
+    snapshot = json.loads((tmp_path / 'metrics.json').read_text())
+    assert snapshot['stages']['stage']['items_processed'] == 3
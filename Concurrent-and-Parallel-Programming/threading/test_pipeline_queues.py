@@ -0,0 +1,482 @@
+import datetime
+import threading
+import time
+from queue import Empty, Full
+
+import pytest
+
+from pipeline_queues import (DONE, MP_CONTEXT, PartitionedQueue, PersistentQueue, PipelineQueue, RecordSchema,
+                             RingBufferQueue, TopicQueue, is_done)
+
+
+def _produce_and_collect(queue, producers=4, items_per_producer=500):
+    def produce(producer_id):
+        for i in range(items_per_producer):
+            queue.put((producer_id, i))
+
+    threads = [threading.Thread(target=produce, args=(producer_id,)) for producer_id in range(producers)]
+    for thread in threads:
+        thread.start()
+    received = [queue.get(timeout=10) for _ in range(producers * items_per_producer)]
+    for thread in threads:
+        thread.join()
+    return received
+
+
+@pytest.mark.parametrize('transport', ['thread', 'process'])
+def test_watermarks_deliver_every_item_with_several_producers(transport):
+    queue = PipelineQueue('q', maxsize=20, high_watermark=10, low_watermark=2, transport=transport)
+    received = _produce_and_collect(queue)
+    assert sorted(received) == [(producer_id, i) for producer_id in range(4) for i in range(500)]
+    assert queue.qsize() == 0
+
+
+@pytest.mark.parametrize('transport', ['thread', 'process'])
+def test_high_watermark_pauses_producers_until_low_watermark(transport):
+    queue = PipelineQueue('q', maxsize=10, high_watermark=4, low_watermark=1, transport=transport)
+    for i in range(4):
+        queue.put(i)
+    with pytest.raises(Full):
+        queue.put(4, timeout=0.05)
+    queue.get()
+    queue.get()
+    # Still above the low watermark, producers stay paused
+    with pytest.raises(Full):
+        queue.put_nowait(4)
+    queue.get()
+    queue.put(4, timeout=1)
+    assert [queue.get(timeout=1), queue.get(timeout=1)] == [3, 4]
+
+
+@pytest.mark.parametrize('transport', ['thread', 'process'])
+def test_drop_oldest_keeps_newest_items(transport):
+    queue = PipelineQueue('q', maxsize=3, overflow='drop_oldest', transport=transport)
+    for i in range(6):
+        queue.put(i)
+    assert queue.dropped == 3
+    assert [queue.get(timeout=1) for _ in range(3)] == [3, 4, 5]
+    with pytest.raises(Empty):
+        queue.get(timeout=0.05)
+
+
+@pytest.mark.parametrize('transport', ['thread', 'process'])
+def test_batches_are_charged_their_length_against_maxsize(transport):
+    queue = PipelineQueue('q', maxsize=10, transport=transport)
+    queue.put_many(range(8))
+    assert queue.qsize() == 8
+    with pytest.raises(Full):
+        queue.put_many(range(3), timeout=0.05)
+    queue.put_many(range(2))
+    assert queue.get_many(4) == [0, 1, 2, 3]
+    queue.put_many(range(3), timeout=1)
+    assert queue.qsize() == 9
+
+
+def test_oversized_batch_only_enters_an_empty_queue():
+    queue = PipelineQueue('q', maxsize=4, transport='thread')
+    queue.put(0)
+    with pytest.raises(Full):
+        queue.put_many(range(6), block=False)
+    queue.get()
+    queue.put_many(range(6), block=False)
+    assert queue.get_many(10) == list(range(6))
+
+
+@pytest.mark.parametrize('transport', ['thread', 'process'])
+def test_drop_oldest_drops_whole_batches(transport):
+    queue = PipelineQueue('q', maxsize=4, overflow='drop_oldest', transport=transport)
+    queue.put_many([1, 2, 3])
+    queue.put_many([4, 5])
+    assert queue.dropped == 3
+    assert queue.get_many(10, timeout=1) == [4, 5]
+
+
+@pytest.mark.parametrize('transport', ['thread', 'process'])
+def test_drop_oldest_never_drops_done(transport):
+    queue = PipelineQueue('q', maxsize=2, overflow='drop_oldest', transport=transport)
+    queue.put(1)
+    queue.put_sentinel(DONE)
+    for i in range(2, 6):
+        queue.put(i)
+    assert queue.dropped == 3
+    assert [queue.get(timeout=1) for _ in range(3)] == [4, DONE, 5]
+
+
+def test_get_many_stops_at_done_and_lingers_for_late_items():
+    queue = PipelineQueue('q', transport='thread')
+    queue.put_many([1, 2])
+    queue.put_sentinel(DONE)
+    queue.put_sentinel(DONE)
+    assert queue.get_many(10) == [1, 2, DONE]
+    assert queue.get_many(10) == [DONE]
+
+    threading.Timer(0.05, queue.put, args=(3,)).start()
+    queue.put(2)
+    assert queue.get_many(2, linger=2) == [2, 3]
+
+
+def test_sentinel_bypasses_watermarks():
+    queue = PipelineQueue('q', maxsize=10, high_watermark=2, transport='thread')
+    queue.put(1)
+    queue.put(2)
+    queue.put_sentinel(DONE)
+    assert [queue.get(), queue.get(), queue.get()] == [1, 2, DONE]
+
+
+@pytest.mark.parametrize('options', [
+    {'overflow': 'drop_newest'},
+    {'overflow': 'drop_oldest'},
+    {'maxsize': 5, 'overflow': 'drop_oldest', 'high_watermark': 4},
+    {'maxsize': 5, 'high_watermark': 6},
+    {'high_watermark': 4, 'low_watermark': 4},
+    {'transport': 'socket'},
+])
+def test_invalid_configuration_is_rejected(options):
+    with pytest.raises(ValueError):
+        PipelineQueue('q', **options)
+
+
+def _quote_schema():
+    return RecordSchema([{'name': 'symbol', 'type': 'str8'},
+                         {'name': 'price', 'type': 'float64'},
+                         {'name': 'extracted_time', 'type': 'datetime'}])
+
+
+@pytest.fixture
+def ring():
+    queue = RingBufferQueue('ring', _quote_schema(), capacity=4)
+    yield queue
+    queue.cleanup()
+
+
+def test_ring_buffer_round_trips_records(ring):
+    now = datetime.datetime(2024, 5, 17, 14, 30, 1, 123456)
+    ring.put(('AAPL', 189.5, now))
+    ring.put(('MSFT', None, now))
+    assert ring.qsize() == 2
+    assert ring.get_many(10) == [('AAPL', 189.5, now), ('MSFT', None, now)]
+    assert ring.empty()
+
+
+def test_ring_buffer_rejects_values_that_do_not_fit(ring):
+    with pytest.raises(ValueError, match='symbol'):
+        ring.put(('VERYLONGSYMBOL', 1.0, datetime.datetime(2024, 1, 1)))
+    # Four bytes of utf-8 for two characters, would be cut in the middle of a character in a str3 field
+    schema = RecordSchema([{'name': 'name', 'type': 'str3'}])
+    with pytest.raises(ValueError, match='name'):
+        schema.pack('éé')
+
+
+def test_ring_buffer_bad_record_does_not_leak_a_slot(ring):
+    with pytest.raises(Exception):
+        ring.put(('AAPL', 'not a float', datetime.datetime(2024, 1, 1)))
+    now = datetime.datetime(2024, 1, 1)
+    for i in range(4):
+        ring.put((f'S{i}', float(i), now), timeout=1)
+    with pytest.raises(Full):
+        ring.put(('S4', 4.0, now), timeout=0.05)
+
+
+def test_ring_buffer_batches_stop_at_control_records(ring):
+    now = datetime.datetime(2024, 1, 1)
+    ring.put(('A', 1.0, now))
+    ring.put_sentinel(DONE)
+    ring.put_sentinel(DONE)
+    assert ring.get_many(10) == [('A', 1.0, now), DONE]
+    assert ring.get_many(10) == [DONE]
+
+
+def test_ring_buffer_put_many_larger_than_capacity():
+    queue = RingBufferQueue('ring', RecordSchema([{'name': 'value', 'type': 'int64'}]), capacity=4)
+    try:
+        producer = threading.Thread(target=queue.put_many, args=(range(10),))
+        producer.start()
+        received = []
+        while len(received) < 10:
+            received.extend(queue.get_many(3, linger=0.01, timeout=5))
+        producer.join()
+        assert received == list(range(10))
+    finally:
+        queue.cleanup()
+
+
+def _put_quotes(queue, count):
+    for i in range(count):
+        queue.put((f'S{i}', float(i), datetime.datetime(2024, 1, 1)))
+    queue.put_sentinel(DONE)
+
+
+def test_ring_buffer_between_processes():
+    queue = RingBufferQueue('ring', _quote_schema(), capacity=8)
+    try:
+        producer = MP_CONTEXT.Process(target=_put_quotes, args=(queue, 50))
+        producer.start()
+        received = []
+        while True:
+            batch = queue.get_many(16, timeout=10)
+            received.extend(batch)
+            if batch[-1] == DONE:
+                break
+        producer.join()
+        assert received[:-1] == [(f'S{i}', float(i), datetime.datetime(2024, 1, 1)) for i in range(50)]
+    finally:
+        queue.cleanup()
+
+
+def test_topic_hands_the_same_item_to_every_subscriber():
+    topic = TopicQueue('t', transport='thread')
+    first, second = topic.subscribe('a'), topic.subscribe('b')
+    item = {'symbol': 'AAPL'}
+    topic.put(item)
+    topic.put_many([1, 2])
+    assert first.get_many(10) == [item, 1, 2]
+    assert second.get(timeout=1) is item
+    assert topic.qsize() == 2
+    assert second.get_many(10) == [1, 2]
+    assert topic.qsize() == 0 and not topic._log
+
+
+def test_topic_bounds_the_lag_of_the_slowest_subscriber():
+    topic = TopicQueue('t', maxsize=3, transport='thread')
+    fast, slow = topic.subscribe('fast'), topic.subscribe('slow')
+    topic.put_many([0, 1, 2])
+    assert fast.get_many(3) == [0, 1, 2]
+    with pytest.raises(Full):
+        topic.put(3, timeout=0.05)
+    slow.get()
+    topic.put(3, timeout=0.05)
+
+
+def test_topic_sentinel_is_seen_after_the_items_published_before_it():
+    topic = TopicQueue('t', transport='thread')
+    first, second = topic.subscribe('a'), topic.subscribe('b')
+    topic.put_many([1, 2])
+    second.put_sentinel(DONE)
+    topic.put(3)
+    assert first.get_many(10) == [1, 2, 3]
+    assert second.get_many(10) == [1, 2, DONE]
+    assert second.get_nowait() == 3
+
+
+def _read_subscription(subscription, results):
+    items = []
+    while True:
+        batch = subscription.get_many(10, timeout=10)
+        items.extend(batch)
+        if batch[-1] == DONE:
+            break
+    results.put(items)
+
+
+def test_process_topic_delivers_to_every_subscriber_process():
+    topic = TopicQueue('t', transport='process')
+    results = MP_CONTEXT.Queue()
+    readers = [MP_CONTEXT.Process(target=_read_subscription, args=(topic.subscribe(name), results))
+               for name in ('a', 'b')]
+    for reader in readers:
+        reader.start()
+    topic.put_many([(i, f'S{i}') for i in range(20)])
+    topic.put_sentinel(DONE)
+    received = [results.get(timeout=20) for _ in readers]
+    for reader in readers:
+        reader.join()
+    assert received == [[(i, f'S{i}') for i in range(20)] + [DONE]] * 2
+
+
+def test_persistent_queue_redelivers_unacknowledged_items_after_a_restart(tmp_path):
+    path = str(tmp_path / 'q.sqlite3')
+    queue = PersistentQueue('q', path=path, transport='thread')
+    queue.put_many(['a', 'b', 'c'])
+    queue.put_sentinel(DONE)
+    # 'a' is acknowledged once handled, 'b' is still being processed when the pipeline dies
+    assert queue.get() == 'a'
+    queue.acknowledge(queue.take_receipts())
+    assert queue.get() == 'b'
+    queue.cleanup()
+
+    restarted = PersistentQueue('q', path=path, transport='thread')
+    assert restarted.resumed == 2
+    assert restarted.get_many(10) == ['b', 'c']
+    restarted.acknowledge_claimed()
+    assert restarted.qsize() == 0
+    restarted.cleanup()
+    assert PersistentQueue('q', path=path, transport='thread').resumed == 0
+
+
+def test_persistent_queue_items_stay_until_they_are_acknowledged(tmp_path):
+    path = str(tmp_path / 'q.sqlite3')
+    queue = PersistentQueue('q', path=path, transport='thread')
+    queue.put_many(['a', 'b', 'c'])
+    queue.put_sentinel(DONE)
+    assert queue.get_many(2) == ['a', 'b']
+    first = queue.take_receipts()
+    # Reading on does not acknowledge what was read before
+    assert queue.get_many(10) == ['c', DONE]
+    queue.acknowledge(queue.take_receipts())
+    assert queue.take_receipts() == []
+    queue.cleanup()
+
+    restarted = PersistentQueue('q', path=path, transport='thread')
+    assert restarted.resumed == 2
+    assert restarted.get_many(10, block=False) == ['a', 'b']
+    restarted.acknowledge(first)
+    restarted.cleanup()
+    assert PersistentQueue('q', path=path, transport='thread').resumed == 0
+
+
+def test_persistent_queue_batches_stop_at_done_and_respect_maxsize(tmp_path):
+    queue = PersistentQueue('q', path=str(tmp_path / 'q.sqlite3'), maxsize=3, transport='thread')
+    queue.put_many([1, 2])
+    with pytest.raises(Full):
+        queue.put_many([3, 4], timeout=0.05)
+    queue.put(3)
+    queue.put_sentinel(DONE)
+    assert queue.get_many(2) == [1, 2]
+    assert queue.get_many(10, linger=0.01) == [3, DONE]
+    with pytest.raises(Empty):
+        queue.get(timeout=0.05)
+
+
+def _consume_persistent(queue, results):
+    items = []
+    while True:
+        batch = queue.get_many(5, timeout=10)
+        items.extend(batch)
+        if batch[-1] == DONE:
+            break
+    results.put(items)
+
+
+def test_persistent_queue_between_processes(tmp_path):
+    queue = PersistentQueue('q', path=str(tmp_path / 'q.sqlite3'), maxsize=10, transport='process')
+    results = MP_CONTEXT.Queue()
+    consumer = MP_CONTEXT.Process(target=_consume_persistent, args=(queue, results))
+    consumer.start()
+    for i in range(0, 40, 4):
+        queue.put_many(list(range(i, i + 4)))
+    queue.put_sentinel(DONE)
+    assert results.get(timeout=20) == list(range(40)) + [DONE]
+    consumer.join()
+
+
+@pytest.mark.parametrize('transport', ['thread', 'process'])
+def test_done_payload_is_an_ordinary_item(transport):
+    queue = PipelineQueue('q', transport=transport)
+    queue.put_many(['DONE', 'x'])
+    queue.put_sentinel(DONE)
+    # The linger only covers the pipe of the process transport, the batch ends at DONE
+    items = queue.get_many(10, linger=1)
+    assert items == ['DONE', 'x', DONE]
+    assert not is_done(items[0]) and is_done(items[2])
+
+
+def _drain(consumer, results, max_items=5):
+    # Reads until DONE and reports every item with the time it was read
+    items = []
+    while True:
+        batch = consumer.get_many(max_items, timeout=10)
+        items.extend((time.monotonic(), item) for item in batch if not is_done(item))
+        if is_done(batch[-1]):
+            break
+    results.put(items)
+
+
+def _assert_keys_in_order(received, expected):
+    # Every consumer got its keys in order, and so did the next owner of a key after a handover
+    read = sorted(read for items in received for read in items)
+    assert sorted(item for _, item in read) == sorted(expected)
+    for key in {symbol for symbol, _ in expected}:
+        assert [item for _, item in read if item[0] == key] == [item for item in expected if item[0] == key]
+
+
+def test_partitioned_queue_routes_each_key_to_one_partition():
+    queue = PartitionedQueue('q', partitions=4, key_field=0, transport='thread')
+    items = [(f'S{i % 10}', i) for i in range(100)]
+    queue.put_many(items)
+    partitions = [partition.get_many(100) for partition in queue.partitions if partition.qsize()]
+    assert sorted(item for partition in partitions for item in partition) == sorted(items)
+    for partition in partitions:
+        for key in {symbol for symbol, _ in partition}:
+            assert [item for item in partition if item[0] == key] == [item for item in items if item[0] == key]
+    assert queue.partition_of(('S1', 0)) == PartitionedQueue('r', partitions=4, key_field=0).partition_of(('S1', 5))
+
+
+def test_partitioned_queue_gives_every_key_to_one_consumer():
+    queue = PartitionedQueue('q', partitions=8, key_field=0, transport='thread')
+    consumers = [queue.consumer() for _ in range(3)]
+    # Everybody joins before the items arrive, so no partition changes hands
+    for consumer in consumers:
+        with pytest.raises(Empty):
+            consumer.get_many(5, timeout=0.02)
+    results = MP_CONTEXT.Queue()
+    threads = [threading.Thread(target=_drain, args=(consumer, results)) for consumer in consumers]
+    for thread in threads:
+        thread.start()
+    expected = [(f'S{i % 20}', i) for i in range(600)]
+    queue.put_many(expected)
+    for _ in threads:
+        queue.put_sentinel(DONE)
+    received = [results.get(timeout=20) for _ in threads]
+    for thread in threads:
+        thread.join()
+    _assert_keys_in_order(received, expected)
+    keys = [{item[0] for _, item in items} for items in received]
+    assert all(keys) and sum(len(consumer_keys) for consumer_keys in keys) == 20
+
+
+def test_partitions_are_handed_over_when_consumers_join_and_leave():
+    queue = PartitionedQueue('q', partitions=4, transport='thread')
+    first, second = queue.consumer(), queue.consumer()
+    queue.put_many(range(40))
+    items = first.get_many(1)
+    # Alone, the first consumer owns everything
+    assert len(queue._claim(first._member)[0]) == 4
+    # The second one joins, but only gets its share at the first one's next read
+    with pytest.raises(Empty):
+        second.get_many(1, timeout=0.05)
+    items += first.get_many(1)
+    assert len(queue._claim(first._member)[0]) == 2
+    items += second.get_many(1)
+    assert len(queue._claim(second._member)[0]) == 2
+    # A consumer only takes a DONE once its own partitions are drained, then leaves them to the others
+    queue.put_sentinel(DONE)
+    for consumer, partitions in ((second, 2), (first, 4)):
+        if consumer is first:
+            queue.put_sentinel(DONE)
+        batch = []
+        while not batch or not is_done(batch[-1]):
+            assert len(queue._claim(consumer._member)[0]) == partitions
+            batch = consumer.get_many(10, timeout=1)
+            items += batch
+    assert sorted(item for item in items if not is_done(item)) == list(range(40))
+    assert queue.qsize() == 0
+
+
+def test_an_idle_partition_consumer_sleeps_until_it_is_notified():
+    queue = PartitionedQueue('q', partitions=2, transport='thread')
+    consumer = queue.consumer()
+    claims = []
+    claim = queue._claim
+    queue._claim = lambda member: claims.append(member) or claim(member)
+    threading.Timer(0.3, queue.put, args=(1,)).start()
+    assert consumer.get(timeout=5) == 1
+    # One look before going to sleep and one after the put woke it, instead of one every few milliseconds
+    assert len(claims) <= 3
+
+
+def test_partitioned_queue_between_processes():
+    queue = PartitionedQueue('q', partitions=6, key_field=0, transport='process')
+    results = MP_CONTEXT.Queue()
+    consumers = [MP_CONTEXT.Process(target=_drain, args=(queue.consumer(), results)) for _ in range(3)]
+    for consumer in consumers:
+        consumer.start()
+    expected = [(f'S{i % 12}', i) for i in range(300)]
+    for i in range(0, 300, 30):
+        queue.put_many(expected[i:i + 30])
+    for _ in consumers:
+        queue.put_sentinel(DONE)
+    received = [results.get(timeout=30) for _ in consumers]
+    for consumer in consumers:
+        consumer.join()
+    # The consumers start one after the other, so partitions change hands while items are read
+    _assert_keys_in_order(received, expected)
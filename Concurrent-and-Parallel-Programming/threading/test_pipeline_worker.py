@@ -0,0 +1,166 @@
+import sqlite3
+import time
+
+import pytest
+
+from pipeline_queues import DONE, PersistentQueue, PipelineQueue
+from retry import DeadLetter, RetryPolicy
+from workers.PipelineWorker import PipelineWorker
+
+
+class RecordingWorker(PipelineWorker):
+    def __init__(self, input_queue, output_queue=None, fail_on=None, **kwargs):
+        super(RecordingWorker, self).__init__(input_queue, output_queue, **kwargs)
+        self.calls = []
+        self._fail_on = fail_on
+
+    def setup(self):
+        self.calls.append('setup')
+
+    def teardown(self):
+        self.calls.append('teardown')
+
+    def process(self, item):
+        self.calls.append(item)
+        if item == self._fail_on:
+            raise RuntimeError(item)
+        return item * 2 if item % 2 else None
+
+
+class RecordingSource(RecordingWorker):
+    def produce(self):
+        yield from range(5)
+
+
+def _drain(queue):
+    items = []
+    while queue.qsize():
+        items.append(queue.get())
+    return items
+
+
+def test_setup_and_teardown_run_once_around_all_items():
+    input_queue, output_queue = PipelineQueue('in'), PipelineQueue('out')
+    input_queue.put_many([1, 2, 3, DONE])
+    worker = RecordingWorker(input_queue, output_queue, batch_size=2)
+    worker.run()
+    assert worker.calls == ['setup', 1, 2, 3, 'teardown']
+    # None results are not sent downstream
+    assert _drain(output_queue) == [2, 6]
+
+
+def test_teardown_runs_when_processing_fails():
+    input_queue = PipelineQueue('in')
+    input_queue.put_many([1, 2, DONE])
+    worker = RecordingWorker(input_queue, fail_on=2)
+    with pytest.raises(RuntimeError):
+        worker.run()
+    assert worker.calls == ['setup', 1, 2, 'teardown']
+
+
+def test_source_sends_what_produce_yields_in_batches():
+    output_queue = PipelineQueue('out')
+    sent = []
+    worker = RecordingSource(None, output_queue, batch_size=2)
+    worker.send_downstream = lambda values: (sent.append(list(values)), output_queue.put_many(values))
+    worker.run()
+    assert sent == [[0, 1], [2, 3], [4]]
+    assert worker.calls == ['setup', 'teardown']
+    assert _drain(output_queue) == [0, 1, 2, 3, 4]
+
+
+class FlakyWorker(PipelineWorker):
+    # Fails the first `failures` attempts of every item, and always for the items in broken
+    def __init__(self, input_queue, output_queue=None, failures=0, broken=(), **kwargs):
+        super(FlakyWorker, self).__init__(input_queue, output_queue, **kwargs)
+        self.attempts = {}
+        self.processed_at = {}
+        self._failures = failures
+        self._broken = broken
+
+    def process(self, item):
+        self.attempts[item] = self.attempts.get(item, 0) + 1
+        if item in self._broken:
+            raise ValueError(f'{item} is broken')
+        if self.attempts[item] <= self._failures:
+            raise ConnectionError(f'{item} failed')
+        self.processed_at[item] = time.monotonic()
+        return item
+
+
+def test_failed_items_are_retried_while_the_next_ones_go_on():
+    input_queue, output_queue = PipelineQueue('in', transport='thread'), PipelineQueue('out', transport='thread')
+    input_queue.put_many([1, 2, 3, DONE])
+    policy = RetryPolicy('net', max_attempts=3, backoff=0.1, jitter=False)
+    worker = FlakyWorker(input_queue, output_queue, failures=1, broken=(), retry_policy=policy)
+    started = time.monotonic()
+    worker.run()
+    # Every item failed once; the three retries waited together instead of one after the other
+    assert worker.attempts == {1: 2, 2: 2, 3: 2}
+    assert time.monotonic() - started < 0.2
+    assert sorted(_drain(output_queue)) == [1, 2, 3]
+
+
+class CountingWorker(FlakyWorker):
+    # Counts the rows left in the persistent input queue at every attempt
+    def __init__(self, input_queue, path, **kwargs):
+        super(CountingWorker, self).__init__(input_queue, **kwargs)
+        self.rows = {}
+        self._path = path
+
+    def process(self, item):
+        with sqlite3.connect(self._path) as connection:
+            self.rows[item, self.attempts.get(item, 0) + 1] = \
+                connection.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+        return super(CountingWorker, self).process(item)
+
+
+def test_retried_items_are_acknowledged_once_they_succeeded_or_went_to_the_dead_letter_queue(tmp_path):
+    path = str(tmp_path / 'in.sqlite3')
+    input_queue = PersistentQueue('in', path=path, transport='thread')
+    dead_letters = PipelineQueue('dead', transport='thread')
+    input_queue.put_many([1, 2, 3])
+    input_queue.put_sentinel(DONE)
+    policy = RetryPolicy('net', max_attempts=2, backoff=0.05, jitter=False, retry_on=['ConnectionError'])
+    worker = CountingWorker(input_queue, path, failures=1, broken=(3,), retry_policy=policy,
+                            dead_letter_queue=dead_letters)
+    worker.run()
+    # 3 went to the dead letter queue and was acknowledged, 1 and 2 stayed while waiting for their retry
+    assert worker.rows[1, 2] == worker.rows[2, 2] == 2
+    assert [letter.item for letter in _drain(dead_letters)] == [3]
+    with sqlite3.connect(path) as connection:
+        assert connection.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+
+
+def test_items_of_a_batch_that_raised_are_not_acknowledged(tmp_path):
+    path = str(tmp_path / 'in.sqlite3')
+    input_queue = PersistentQueue('in', path=path, transport='thread')
+    input_queue.put_many([1, 2, 3])
+    input_queue.put_sentinel(DONE)
+    worker = RecordingWorker(input_queue, PipelineQueue('out', transport='thread'), fail_on=2)
+    with pytest.raises(RuntimeError):
+        worker.run()
+    assert worker.failed
+    input_queue.cleanup()
+    assert PersistentQueue('in', path=path, transport='thread').get_many(10, block=False) == [2, 3]
+
+
+def test_items_that_fail_for_good_go_to_the_dead_letter_queue():
+    input_queue, dead_letters = PipelineQueue('in', transport='thread'), PipelineQueue('dead', transport='thread')
+    input_queue.put_many([1, 2, DONE])
+    policy = RetryPolicy('net', max_attempts=3, backoff=0.01, retry_on=['ConnectionError'])
+    worker = FlakyWorker(input_queue, failures=5, broken=(2,), retry_policy=policy, dead_letter_queue=dead_letters)
+    worker.run()
+    letters = sorted(_drain(dead_letters))
+    assert [(letter.item, letter.attempts) for letter in letters] == [(1, 3), (2, 1)]
+    assert all(isinstance(letter, DeadLetter) and letter.stage == 'FlakyWorker' for letter in letters)
+    assert letters[1].error == "ValueError('2 is broken')"
+
+
+def test_without_a_dead_letter_queue_failed_items_are_dropped(capsys):
+    input_queue, output_queue = PipelineQueue('in', transport='thread'), PipelineQueue('out', transport='thread')
+    input_queue.put_many([1, 2, DONE])
+    worker = FlakyWorker(input_queue, output_queue, broken=(1,), retry_policy=RetryPolicy('net', max_attempts=1))
+    worker.run()
+    assert _drain(output_queue) == [2]
+    assert 'giving up on 1 after 1 attempts' in capsys.readouterr().out
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import pytest
+
+from pipeline_queues import MP_CONTEXT
+from rate_limiter import TokenBucket
+
+
+def test_burst_is_granted_at_once_then_requests_are_paced():
+    bucket = TokenBucket('host', rate=20, burst=5)
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.05
+    for _ in range(4):
+        bucket.acquire()
+    # 4 more tokens at 20 per second
+    assert time.monotonic() - started == pytest.approx(0.2, abs=0.05)
+    snapshot = bucket.snapshot()
+    assert snapshot['acquired'] == 9
+    assert snapshot['wait_seconds'] > 0
+
+
+def test_async_acquire_does_not_block_the_loop():
+    bucket = TokenBucket('host', rate=10, burst=1)
+
+    async def take_three():
+        started = time.monotonic()
+        await asyncio.gather(*(bucket.acquire_async() for _ in range(3)))
+        return time.monotonic() - started
+
+    assert asyncio.run(take_three()) == pytest.approx(0.2, abs=0.05)
+
+
+def test_invalid_configuration_is_rejected():
+    with pytest.raises(ValueError):
+        TokenBucket('host', rate=0)
+    with pytest.raises(ValueError):
+        TokenBucket('host', rate=5, burst=2).acquire(3)
+
+
+def _take(bucket, count):
+    for _ in range(count):
+        bucket.acquire()
+
+
+def test_processes_share_one_budget():
+    bucket = TokenBucket('host', rate=50, burst=1)
+    started = time.monotonic()
+    processes = [MP_CONTEXT.Process(target=_take, args=(bucket, 10)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    # 30 tokens at 50 per second take at least 0.58 seconds, whatever the number of processes
+    assert time.monotonic() - started >= 0.55
+    assert bucket.snapshot()['acquired'] == 30
@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from retry import RetryPolicy, TimerWheel
+
+
+def test_backoff_doubles_up_to_max_backoff():
+    policy = RetryPolicy('net', backoff=0.5, max_backoff=3, jitter=False)
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [0.5, 1, 2, 3, 3]
+
+
+def test_jitter_spreads_the_delay_below_the_backoff():
+    policy = RetryPolicy('net', backoff=1, max_backoff=30)
+    delays = [policy.delay(3) for _ in range(200)]
+    assert all(0 <= delay <= 4 for delay in delays)
+    assert len(set(delays)) > 100
+
+
+def test_only_listed_exceptions_are_retried_until_max_attempts():
+    pytest.importorskip('lxml')
+    from workers.YahooFinanceWorkers import PriceNotFound, QuoteUnavailable
+
+    policy = RetryPolicy.from_config('net', {
+        'max_attempts': 3,
+        'retry_on': ['ConnectionError', 'workers.YahooFinanceWorkers.QuoteUnavailable'],
+    })
+    assert policy.should_retry(1, ConnectionResetError())
+    assert policy.should_retry(2, QuoteUnavailable())
+    assert not policy.should_retry(3, ConnectionResetError())
+    assert not policy.should_retry(1, PriceNotFound())
+
+
+def test_invalid_configuration_is_rejected():
+    with pytest.raises(ValueError):
+        RetryPolicy('net', max_attempts=0)
+    with pytest.raises(ValueError):
+        RetryPolicy('net', backoff=5, max_backoff=1)
+    with pytest.raises(ValueError):
+        RetryPolicy('net', retry_on=['NoSuchError'])
+    with pytest.raises(ValueError):
+        RetryPolicy('net', retry_on=['time.sleep'])
+
+
+def test_timer_wheel_hands_out_entries_once_their_delay_has_passed():
+    wheel = TimerWheel(tick=0.01, slots=8)
+    wheel.schedule(0.05, 'b')
+    wheel.schedule(0.01, 'a')
+    # Longer than a turn of the wheel (0.08 seconds)
+    wheel.schedule(0.2, 'c')
+    assert wheel.expired() == []
+    assert 0 <= wheel.next_expiry() <= 0.02
+    time.sleep(0.07)
+    assert wheel.expired() == ['a', 'b']
+    assert len(wheel) == 1
+    time.sleep(0.05)
+    # 'c' is still a turn away
+    assert wheel.expired() == []
+    time.sleep(0.1)
+    assert wheel.expired() == ['c']
+    assert wheel.next_expiry() is None
+
+
+def test_timer_wheel_catches_up_after_several_turns():
+    wheel = TimerWheel(tick=0.001, slots=4)
+    for i in range(20):
+        wheel.schedule(i * 0.001, i)
+    time.sleep(0.05)
+    assert wheel.expired() == list(range(20))
+    assert len(wheel) == 0
@@ -0,0 +1,204 @@
+import datetime
+import os
+import sqlite3
+import time
+
+import pytest
+
+from pipeline_queues import DONE, PersistentQueue, PipelineQueue
+from workers.SinkWorker import BufferedSinkWorker, FlushPolicy
+
+
+class RecordingSink(BufferedSinkWorker):
+    def __init__(self, input_queue, **kwargs):
+        super(RecordingSink, self).__init__(input_queue, **kwargs)
+        self.flushes = []
+        self.closed = False
+        self.start()
+
+    def write_rows(self, rows):
+        self.flushes.append(rows)
+
+    def close(self):
+        self.closed = True
+
+
+def test_rows_are_flushed_by_count_and_after_the_last_row():
+    queue = PipelineQueue('rows')
+    queue.put_many(list(range(7)) + [DONE])
+    sink = RecordingSink(queue, flush_rows=3, flush_interval=60, batch_size=2)
+    sink.join()
+    # Reads of 2 rows reach 3 buffered rows with the second read
+    assert sink.flushes == [[0, 1, 2, 3], [4, 5, 6]]
+    assert sink.closed
+
+
+def test_buffered_rows_are_flushed_after_the_interval_without_more_input():
+    queue = PipelineQueue('rows')
+    sink = RecordingSink(queue, flush_rows=100, flush_interval=0.1)
+    queue.put_many([1, 2])
+    time.sleep(0.3)
+    assert sink.flushes == [[1, 2]]
+    queue.put(DONE)
+    sink.join()
+    assert sink.flushes == [[1, 2]]
+
+
+def test_rows_from_a_persistent_queue_are_only_acknowledged_once_written(tmp_path):
+    path = str(tmp_path / 'rows.sqlite3')
+    queue = PersistentQueue('rows', path=path, transport='thread')
+    sink = RecordingSink(queue, flush_rows=100, flush_interval=60)
+    queue.put_many(list(range(11)))
+    deadline = time.monotonic() + 5
+    while queue.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    # All read and buffered, none written: a crash now must not lose them
+    assert sink.flushes == []
+    with sqlite3.connect(path) as connection:
+        assert connection.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 11
+    queue.put_sentinel(DONE)
+    sink.join()
+    assert sink.flushes == [list(range(11))]
+    with sqlite3.connect(path) as connection:
+        assert connection.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+
+
+def test_invalid_flush_policy_is_rejected():
+    with pytest.raises(ValueError):
+        FlushPolicy(max_rows=0)
+    with pytest.raises(ValueError):
+        FlushPolicy(max_interval=0)
+
+
+@pytest.mark.parametrize('insert_method', ['executemany', 'values'])
+def test_postgres_sink_writes_every_row_through_a_shared_engine(tmp_path, insert_method):
+    sqlalchemy = pytest.importorskip('sqlalchemy')
+    from workers.PostgresWorker import PostgresMasterScheduler, PostgresWorker
+
+    url = f"sqlite:///{tmp_path / 'prices.sqlite3'}"
+    engine = sqlalchemy.create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text('CREATE TABLE prices (symbol TEXT, price REAL, extracted_time TIMESTAMP)'))
+    queue = PipelineQueue('rows')
+    now = datetime.datetime.utcnow()
+    queue.put_many([(f'S{i}', float(i), now) for i in range(700)])
+    # Like the executor, one separate DONE per instance: inside a batch, the DONE meant for one instance
+    # could still sit unpacked in the other's process while the first one waits on the queue
+    for _ in range(2):
+        queue.put_sentinel(DONE)
+    sinks = [PostgresMasterScheduler(queue, url=url, insert_method=insert_method, flush_rows=250, batch_size=50)
+             for _ in range(2)]
+    for sink in sinks:
+        sink.join()
+    with engine.connect() as conn:
+        assert conn.execute(sqlalchemy.text('SELECT COUNT(*), SUM(price) FROM prices')).one() == (700, sum(range(700)))
+    engine.dispose()
+    # The last instance to finish disposed of the shared engine
+    assert url not in PostgresWorker._engines
+
+
+def _price_rows(count):
+    now = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    return [(f'S{i}', float(i), now) for i in range(count)]
+
+
+def _run_sinks(SinkClass, rows, instances=2, **params):
+    queue = PipelineQueue('rows')
+    queue.put_many(rows)
+    for _ in range(instances):
+        queue.put_sentinel(DONE)
+    sinks = [SinkClass(queue, flush_rows=100, batch_size=30, **params) for _ in range(instances)]
+    for sink in sinks:
+        sink.join()
+    return sinks
+
+
+def test_sqlite_sink_writes_every_row_in_wal_mode(tmp_path):
+    import sqlite3
+    from workers.SqliteWorker import SqliteSink
+
+    path = tmp_path / 'prices.sqlite3'
+    _run_sinks(SqliteSink, _price_rows(500), path=str(path))
+    connection = sqlite3.connect(path)
+    assert connection.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    assert connection.execute('SELECT COUNT(*), SUM(price) FROM prices').fetchone() == (500, sum(range(500)))
+    assert connection.execute("SELECT extracted_time FROM prices LIMIT 1").fetchone() == ('2024-01-02 03:04:05',)
+    connection.close()
+
+
+def test_csv_sink_appends_rows_below_a_single_header(tmp_path):
+    import csv
+    from workers.CsvWorker import CsvSink
+
+    path = tmp_path / 'prices.csv'
+    _run_sinks(CsvSink, _price_rows(500), path=str(path))
+    # A second run appends to the same file
+    _run_sinks(CsvSink, _price_rows(10), instances=1, path=str(path))
+    with open(path, newline='') as f:
+        lines = list(csv.reader(f))
+    assert lines[0] == ['symbol', 'price', 'extracted_time']
+    assert len(lines) == 511
+    assert sorted(float(line[1]) for line in lines[1:]) == sorted([float(i) for i in range(500)] +
+                                                                  [float(i) for i in range(10)])
+
+
+def test_csv_sink_rows_of_another_instance_never_land_above_the_header(tmp_path, monkeypatch):
+    import csv
+    from workers.CsvWorker import CsvSink
+
+    path = tmp_path / 'prices.csv'
+    link = os.link
+
+    def racing_link(source, target):
+        # Another instance starts, creates the file and writes its rows while this one is about to create it
+        monkeypatch.setattr(os, 'link', link)
+        _run_sinks(CsvSink, _price_rows(5), instances=1, path=str(path))
+        link(source, target)
+
+    monkeypatch.setattr(os, 'link', racing_link)
+    _run_sinks(CsvSink, _price_rows(3), instances=1, path=str(path))
+    with open(path, newline='') as f:
+        lines = list(csv.reader(f))
+    assert lines[0] == ['symbol', 'price', 'extracted_time']
+    assert len(lines) == 9 and lines.count(lines[0]) == 1
+    assert os.listdir(tmp_path) == ['prices.csv']
+
+
+def test_dead_letter_sink_writes_one_json_line_per_letter(tmp_path):
+    import json
+    from retry import DeadLetter
+    from workers.DeadLetterWorker import DeadLetterSink
+
+    path = tmp_path / 'dead_letters.jsonl'
+    now = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    letters = [DeadLetter('YahooFinancePriceScheduler', f'S{i}', "QuoteUnavailable('busy')", 3, now) for i in range(50)]
+    _run_sinks(DeadLetterSink, letters, path=str(path))
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert sorted(line['item'] for line in lines) == sorted(f'S{i}' for i in range(50))
+    assert lines[0]['failed_at'] == '2024-01-02 03:04:05' and lines[0]['attempts'] == 3
+
+
+@pytest.mark.parametrize('format', ['parquet', 'arrow'])
+def test_arrow_sink_writes_one_row_group_per_flush(tmp_path, format):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    from workers.ArrowWorker import ArrowSink
+
+    sinks = _run_sinks(ArrowSink, _price_rows(500), path=str(tmp_path / ('prices-{part}.' + format)), format=format)
+    assert len({sink.path for sink in sinks}) == 2
+    tables = []
+    # An instance that got no rows at all writes no file
+    for sink in [sink for sink in sinks if os.path.exists(sink.path)]:
+        if format == 'parquet':
+            metadata = pq.ParquetFile(sink.path).metadata
+            # A flush happens at the read that brings the buffer to 100 rows or more
+            assert all(metadata.row_group(i).num_rows < 130 for i in range(metadata.num_row_groups))
+            tables.append(pq.read_table(sink.path))
+        else:
+            with pa.ipc.open_file(sink.path) as reader:
+                tables.append(reader.read_all())
+    table = pa.concat_tables(tables)
+    assert table.schema.field('extracted_time').type == pa.timestamp('us')
+    assert sorted(table.column('price').to_pylist()) == [float(i) for i in range(500)]
@@ -0,0 +1,156 @@
+import json
+
+import pytest
+
+import tracing
+from pipeline_metrics import OutputQueueView, StageQueueView, StageStats
+from pipeline_queues import DONE, MP_CONTEXT, PartitionedQueue, PipelineQueue, Traced
+from test_sink_worker import RecordingSink
+from tracing import TraceReader, Tracer, TraceWriter
+from workers.PipelineWorker import PipelineWorker
+
+
+def _views(tracer, stage, queue, outputs=()):
+    stats = StageStats(stage)
+    reader = StageQueueView(queue, stats, trace_reader=TraceReader(tracer, stage, f'{stage}-0', queue.name))
+    return reader, [OutputQueueView(output, stats, trace_writer=TraceWriter(tracer)) for output in outputs]
+
+
+def _source(tracer, queue):
+    return OutputQueueView(queue, StageStats('source'), trace_writer=TraceWriter(tracer, starts_traces=True))
+
+
+def test_items_carry_their_trace_through_every_stage(tmp_path):
+    tracer = Tracer(str(tmp_path / 'trace.jsonl'))
+    first = PipelineQueue('A', transport='thread')
+    second = PipelineQueue('B', transport='thread')
+    _source(tracer, first).put_many(['AAPL', 'MSFT'])
+    assert all(isinstance(item, Traced) for item in first.get_many(2, block=False))
+
+    first.put_many([Traced('AAPL', 'a', tracing.now_us()), 'MSFT', Traced('IBM', 'c', tracing.now_us())])
+    first.put_sentinel(DONE)
+    reader, (writer,) = _views(tracer, 'double', first, [second])
+    items = reader.get_many(3)
+    # The worker only ever sees the items themselves
+    assert items == ['AAPL', 'MSFT', 'IBM']
+    for item in items:
+        writer.put(item * 2)
+    assert reader.get() is DONE
+
+    outputs = second.get_many(3, block=False)
+    assert [(output.item, output.trace_id) for output in outputs if isinstance(output, Traced)] == \
+        [('AAPLAAPL', 'a'), ('IBMIBM', 'c')]
+    assert outputs[1] == 'MSFTMSFT'
+    spans = tracing.read_spans(tracer.path)
+    assert [(span['trace_id'], span['stage'], span['queue']) for span in spans] == [('a', 'double', 'A'),
+                                                                                   ('c', 'double', 'A')]
+    assert all(span['enqueued'] <= span['dequeued'] <= span['started'] <= span['ended'] for span in spans)
+
+
+def test_sample_rate_traces_a_share_of_the_source_items(tmp_path):
+    tracer = Tracer(str(tmp_path / 'trace.jsonl'), sample_rate=0.25)
+    queue = PipelineQueue('A', transport='thread')
+    _source(tracer, queue).put_many(list(range(4000)))
+    traced = sum(isinstance(item, Traced) for item in queue.get_many(4000, block=False))
+    assert 800 < traced < 1200
+    with pytest.raises(ValueError):
+        Tracer(str(tmp_path / 'trace.jsonl'), sample_rate=0)
+
+
+class FlakyDoubler(PipelineWorker):
+    def __init__(self, input_queue, output_queue, **kwargs):
+        super(FlakyDoubler, self).__init__(input_queue, output_queue, **kwargs)
+        self.attempts = {}
+        self.start()
+
+    def process(self, item):
+        self.attempts[item] = self.attempts.get(item, 0) + 1
+        if item == 2 and self.attempts[item] < 3:
+            raise ConnectionError(item)
+        return item * 2
+
+
+def test_a_retried_item_is_processed_until_its_last_attempt(tmp_path):
+    from retry import RetryPolicy
+
+    tracer = Tracer(str(tmp_path / 'trace.jsonl'))
+    queue = PipelineQueue('A', transport='thread')
+    out = PipelineQueue('B', transport='thread')
+    queue.put_many([Traced(item, f't{item}', tracing.now_us()) for item in (1, 2, 3)])
+    queue.put_sentinel(DONE)
+    reader, writers = _views(tracer, 'double', queue, [out])
+    worker = FlakyDoubler(reader, writers, batch_size=3,
+                          retry_policy=RetryPolicy('net', backoff=0.05, jitter=False, retry_on=['ConnectionError']))
+    worker.join()
+    tracing.flush_all()
+
+    assert sorted((item.item, item.trace_id) for item in out.get_many(3, block=False)) == \
+        [(2, 't1'), (4, 't2'), (6, 't3')]
+    spans = {span['trace_id']: span for span in tracing.read_spans(tracer.path)}
+    assert spans['t2']['attempts'] == 3
+    # Two backoffs of 0.05 and 0.1 seconds
+    assert spans['t2']['ended'] - spans['t2']['started'] >= 150000
+    assert spans['t1']['attempts'] == 1
+
+
+def test_sink_rows_are_processed_until_they_are_written(tmp_path):
+    tracer = Tracer(str(tmp_path / 'trace.jsonl'))
+    queue = PipelineQueue('A', transport='thread')
+    queue.put_many([Traced(('AAPL', 1.0), 'a', tracing.now_us()), ('MSFT', 2.0)])
+    queue.put_sentinel(DONE)
+    reader, _ = _views(tracer, 'sink', queue)
+    sink = RecordingSink(reader, flush_rows=10, flush_interval=60)
+    sink.join()
+    tracing.flush_all()
+    assert sink.flushes == [[('AAPL', 1.0), ('MSFT', 2.0)]]
+    (span,) = tracing.read_spans(tracer.path)
+    assert span['trace_id'] == 'a' and span['attempts'] == 0
+
+
+def test_partitioned_queues_route_traced_items_by_their_key():
+    queue = PartitionedQueue('P', partitions=4, key_field=0, transport='thread')
+    item = ('AAPL', 1.0)
+    assert queue.partition_of(Traced(item, 'a', 0)) == queue.partition_of(item)
+
+
+def _double_in_process(reader, writers):
+    while True:
+        items = reader.get_many(10)
+        for writer in writers:
+            writer.put_many([item * 2 for item in items if item is not DONE])
+        if items[-1] is DONE:
+            break
+    tracing.flush_all()
+
+
+def test_spans_of_process_backed_stages_end_up_in_the_same_file(tmp_path):
+    tracer = Tracer(str(tmp_path / 'trace.jsonl'), flush_interval=60)
+    queue = PipelineQueue('A', transport='process')
+    out = PipelineQueue('B', transport='process')
+    _source(tracer, queue).put_many(list(range(20)))
+    queue.put_sentinel(DONE)
+    reader, writers = _views(tracer, 'double', queue, [out])
+    process = MP_CONTEXT.Process(target=_double_in_process, args=(reader, writers))
+    process.start()
+    process.join(30)
+    assert process.exitcode == 0
+    outputs = out.get_many(20, timeout=10)
+    spans = tracing.read_spans(tracer.path)
+    assert sorted(span['trace_id'] for span in spans) == sorted(output.trace_id for output in outputs)
+    assert len(spans) == 20
+
+
+def test_chrome_export_and_summary():
+    spans = [{'trace_id': 'a', 'stage': 'fetch', 'instance': 'fetch-0', 'queue': 'A', 'enqueued': 0,
+              'dequeued': 1000, 'started': 1000, 'ended': 3000, 'attempts': 1},
+             {'trace_id': 'a', 'stage': 'insert', 'instance': 'insert-0', 'queue': 'B', 'enqueued': 3000,
+              'dequeued': 7000, 'started': 7000, 'ended': 8000, 'attempts': 1}]
+    events = tracing.chrome_trace(spans)['traceEvents']
+    assert [event['args']['name'] for event in events if event['ph'] == 'M'] == ['fetch', 'insert']
+    assert [(event['name'], event['ph'], event['ts']) for event in events if event['pid'] == 2 and event['ph'] != 'M'] \
+        == [('wait in B', 'b', 3000), ('wait in B', 'e', 7000), ('insert', 'b', 7000), ('insert', 'e', 8000)]
+    json.dumps(events)
+    latencies = tracing.summary(spans)
+    assert latencies['queue B']['p50'] == 4.0
+    assert latencies['stage fetch']['max'] == 2.0
+    assert latencies['end to end']['count'] == 1 and latencies['end to end']['p99'] == 8.0
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from workers.TtlCache import MISSING, TtlCache
+
+
+def test_entries_are_served_until_the_ttl_has_passed():
+    cache = TtlCache('test', ttl=0.1).acquire()
+    cache.put('AAPL', (1.5, 'now'))
+    assert cache.get('AAPL') == (1.5, 'now')
+    time.sleep(0.15)
+    assert cache.get('AAPL') is MISSING
+    assert cache.snapshot()['entries'] == 0
+    cache.release()
+
+
+def test_least_recently_used_entries_are_evicted_beyond_max_bytes():
+    cache = TtlCache('test', max_bytes=300).acquire()
+    for symbol in ('A', 'B', 'C'):
+        cache.put(symbol, b'x' * 80)
+    # A becomes the most recently used, so D evicts B
+    cache.get('A')
+    cache.put('D', b'x' * 80)
+    assert [symbol for symbol in 'ABCD' if cache.get(symbol) is not MISSING] == ['A', 'C', 'D']
+    assert cache.snapshot()['bytes'] <= 300
+    cache.release()
+
+
+def test_disk_tier_outlives_the_memory_tier(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = TtlCache('test', path=path).acquire()
+    cache.put('AAPL', 1.5)
+    cache.release()
+    # A new process, or the next run, starts with an empty memory tier
+    cache = TtlCache('test', path=path).acquire()
+    assert cache.get('AAPL') == 1.5
+    assert cache.snapshot()['entries'] == 1
+    cache.release()
+
+
+def test_concurrent_lookups_of_one_key_share_a_single_fetch():
+    cache = TtlCache('test').acquire()
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        time.sleep(0.1)
+        return 1.5
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch('AAPL', fetch))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1.5] * 8
+    assert len(fetches) == 1
+    cache.release()
+
+
+def test_failed_and_uncacheable_fetches_are_not_cached():
+    cache = TtlCache('test').acquire()
+
+    def fail():
+        raise ConnectionError('down')
+
+    with pytest.raises(ConnectionError):
+        cache.get_or_fetch('AAPL', fail)
+    assert cache.get_or_fetch('AAPL', lambda: None, cacheable=lambda value: value is not None) is None
+    assert cache.get('AAPL') is MISSING
+    assert cache.get_or_fetch('AAPL', lambda: 1.5) == 1.5
+    assert cache.get('AAPL') == 1.5
+    cache.release()
+
+
+def test_coroutines_share_a_single_fetch():
+    cache = TtlCache('test').acquire()
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0.05)
+        return 1.5
+
+    async def lookups():
+        return await asyncio.gather(*(cache.get_or_fetch_async('AAPL', fetch) for _ in range(20)))
+
+    assert asyncio.run(lookups()) == [1.5] * 20
+    assert len(fetches) == 1
+    cache.release()
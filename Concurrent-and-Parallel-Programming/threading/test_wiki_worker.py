@@ -0,0 +1,81 @@
+import itertools
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('lxml')
+pytest.importorskip('requests')
+
+from workers.HttpClient import HttpClient  # noqa: E402
+from workers.WikiWorker import WikiWorker  # noqa: E402
+
+SYMBOLS = [f'S{i}' for i in range(300)]
+PAGE = ('<html><body><table id="other"><tr><td>NOT</td></tr></table>'
+        '<table class="wikitable" id="constituents"><tbody><tr><th>Symbol</th><th>Security</th></tr>' +
+        ''.join(f'<tr><td><a href="/q/{symbol}">{symbol}</a>\n</td><td>Company {symbol}</td></tr>\n'
+                for symbol in SYMBOLS) +
+        '</tbody></table>' + '<p>More text</p>' * 5000 + '</body></html>').encode('utf-8')
+
+
+def _chunks(page, size, taken):
+    for start in range(0, len(page), size):
+        taken.append(start)
+        yield page[start:start + size]
+
+
+def test_symbols_are_emitted_while_the_page_is_still_coming_in():
+    taken = []
+    symbols = WikiWorker._extract_company_symbols(_chunks(PAGE, 1024, taken))
+    assert next(symbols) == 'S0'
+    assert len(taken) < 3
+    assert list(symbols) == SYMBOLS[1:]
+    # Nothing after the table is read
+    assert len(taken) < len(PAGE) // 1024 // 2
+
+
+def test_streaming_parse_matches_the_full_parse():
+    bs4 = pytest.importorskip('bs4')
+    table = bs4.BeautifulSoup(PAGE, 'lxml').find(id='constituents')
+    expected = [row.find('td').text.strip('\n') for row in table.find_all('tr')[1:]]
+    assert list(WikiWorker._extract_company_symbols(_chunks(PAGE, 100, []))) == expected
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @staticmethod
+    def initial_state():
+        return {'full': 0, 'not_modified': 0}
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        self.server.full += 1
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def handler():
+    return _Handler
+
+
+def test_unchanged_page_is_revalidated_instead_of_downloaded(server, tmp_path):
+    url = f'http://127.0.0.1:{server.server_address[1]}/wiki/List_of_S%26P_500_companies'
+    client = HttpClient('wiki-test').acquire()
+    # Taking only a few symbols still leaves the complete page in the cache
+    first = list(itertools.islice(WikiWorker(url, session=client, page_cache=str(tmp_path)).get_sp_500_companies(), 5))
+    assert first == SYMBOLS[:5]
+    assert list(WikiWorker(url, session=client, page_cache=str(tmp_path)).get_sp_500_companies()) == SYMBOLS
+    client.release()
+    assert (server.full, server.not_modified) == (1, 1)
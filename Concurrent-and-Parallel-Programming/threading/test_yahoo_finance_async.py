@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('lxml')
+
+from pipeline_queues import DONE  # noqa: E402
+from retry import RetryPolicy  # noqa: E402
+from workers.YahooFinanceAsyncWorkers import YahooFinanceAsyncPriceScheduler  # noqa: E402
+from workers.YahooFinanceWorkers import PriceNotFound  # noqa: E402
+
+PAGE = (b'<html><body><div id="quote-header-info"><div></div><div></div>'
+        b'<div><div><div><span>1,234.50</span></div></div></div></div></body></html>')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @staticmethod
+    def initial_state():
+        return {'in_flight': 0, 'peak': 0, 'requests': 0, 'failures': 0}
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.peak = max(server.peak, server.in_flight)
+            server.requests += 1
+            missing = self.path.endswith('/MISSING')
+            failing = server.failures > 0 and not missing
+            server.failures -= failing
+        time.sleep(0.05)
+        with server.lock:
+            server.in_flight -= 1
+        status, body = (503, b'busy') if failing else (200, PAGE)
+        if missing:
+            status, body = 404, b'not found'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def handler():
+    return _Handler
+
+
+class _ListQueue():
+    # Stands in for the AsyncStageQueueView/AsyncOutputQueueView the executor hands to asyncio stages
+    def __init__(self, items=()):
+        self.items = list(items)
+
+    async def get_many(self, max_items, linger=0, timeout=None):
+        items, self.items = self.items[:max_items], self.items[max_items:]
+        return items
+
+    async def put(self, item):
+        self.items.append(item)
+
+    async def put_many(self, items):
+        self.items.extend(items)
+
+
+def _run_stage(server, symbols, dead_letters=None, **params):
+    input_queue, output_queue = _ListQueue(symbols + [DONE]), _ListQueue()
+    stage = YahooFinanceAsyncPriceScheduler(input_queue, output_queue, dead_letter_queue=dead_letters,
+                                            base_url=f'http://127.0.0.1:{server.server_address[1]}/quote/',
+                                            **params)
+    started = time.monotonic()
+    asyncio.run(stage.run())
+    return output_queue.items, time.monotonic() - started
+
+
+def test_requests_run_concurrently_within_the_per_host_limit(server):
+    symbols = [f'S{i}' for i in range(60)]
+    rows, elapsed = _run_stage(server, symbols, concurrency=20, batch_size=7,
+                               http_client={'name': 'async-limit', 'max_connections_per_host': 10})
+    assert sorted(symbol for symbol, _, _ in rows) == sorted(symbols)
+    assert 5 <= server.peak <= 10
+    # 60 requests of 50 ms each, 10 at a time
+    assert elapsed < 1.5
+
+
+def test_failed_responses_are_retried(server):
+    server.failures = 2
+    rows, _ = _run_stage(server, ['AAPL'], http_client={'name': 'async-retry', 'backoff_factor': 0.01})
+    assert server.requests == 3
+    assert [symbol for symbol, _, _ in rows] == ['AAPL']
+    assert rows[0][1] is not None
+
+
+def test_cached_symbols_skip_the_network(server, tmp_path):
+    cache = {'name': 'async-cache', 'ttl': 60, 'path': str(tmp_path / 'quotes.sqlite3')}
+    rows, _ = _run_stage(server, ['AAPL', 'MSFT', 'AAPL', 'AAPL'], concurrency=4, cache=cache)
+    assert sorted(symbol for symbol, _, _ in rows) == ['AAPL', 'AAPL', 'AAPL', 'MSFT']
+    # Concurrent lookups of AAPL waited for the same request
+    assert server.requests == 2
+    rows, _ = _run_stage(server, ['MSFT'], cache=cache)
+    assert server.requests == 2
+    assert rows[0][2] < datetime.datetime.utcnow()
+
+
+def test_symbols_that_keep_failing_go_to_the_dead_letter_queue(server):
+    server.failures = 4
+    dead_letters = _ListQueue()
+    policy = RetryPolicy('quotes', max_attempts=2, backoff=0.01,
+                         retry_on=['workers.YahooFinanceWorkers.QuoteUnavailable'])
+    rows, _ = _run_stage(server, ['AAPL', 'MISSING'], dead_letters=dead_letters, retry_policy=policy,
+                         http_client={'name': 'async-dead-letters', 'retries': 1, 'backoff_factor': 0.01})
+    assert rows == []
+    letters = sorted(dead_letters.items)
+    # A missing quote page is not worth a retry, a busy host is retried once
+    assert [(letter.item, letter.attempts) for letter in letters] == [('AAPL', 2), ('MISSING', 1)]
+    assert letters[1].error.startswith('PriceNotFound')
+
+
+def test_a_fetch_that_raised_fails_the_stage(server):
+    # Without a retry policy or a dead letter queue the missing quote page is an error of the stage
+    with pytest.raises(PriceNotFound):
+        _run_stage(server, ['MISSING', 'AAPL', 'MSFT'], concurrency=1)
+    assert server.requests < 3
@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip('lxml')
+pytest.importorskip('requests')
+
+from benchmark_price_extraction import full_parse, synthetic_page  # noqa: E402
+from workers.YahooFinanceWorkers import PriceNotFound, YahooFinacePriceWorker  # noqa: E402
+
+
+def _page(header_filler=b'', before=b''):
+    return (b'<html><body>' + before + b'<div id="quote-header-info"><div></div><div>' + header_filler +
+            b'</div><div><div><div><span>1,234.50</span></div></div></div></div><p>after</p></body></html>')
+
+
+@pytest.mark.parametrize('page', [
+    synthetic_page(),
+    _page(),
+    # The price lies beyond every fast path window
+    _page(header_filler=b'<span>filler</span>' * 5000),
+    # The first marker is inside a script, only the full parse finds the header
+    _page(before=b'<script>var s = \'<p id="quote-header-info">\';</script>'),
+])
+def test_fast_path_agrees_with_the_full_parse(page):
+    assert YahooFinacePriceWorker.find_raw_price(page) == full_parse(page)
+    assert full_parse(page) is not None
+
+
+def test_page_without_a_price_gives_none():
+    assert YahooFinacePriceWorker.find_raw_price(b'<html><body><p>Not found</p></body></html>') is None
+    assert YahooFinacePriceWorker.find_raw_price(b'<div id="quote-header-info"><div></div></div>') is None
+
+
+def test_extract_price_returns_the_price_or_raises():
+    assert YahooFinacePriceWorker.extract_price('AAPL', _page()) == 1234.5
+    with pytest.raises(PriceNotFound):
+        YahooFinacePriceWorker.extract_price('AAPL', b'<html><body><p>Not found</p></body></html>')
+    with pytest.raises(PriceNotFound):
+        YahooFinacePriceWorker.extract_price('AAPL', _page().replace(b'1,234.50', b'N/A'))
@@ -0,0 +1,249 @@
+import asyncio
+import csv
+import json
+import os
+import re
+import sqlite3
+import time
+
+import pytest
+import yaml
+
+from pipeline_queues import DONE, PersistentQueue
+from workers.PipelineWorker import PipelineWorker
+from yaml_reader import AsyncQueue, EventLoopThread, YamlPipelineExecutor
+
+
+class NumberSource(PipelineWorker):
+    def __init__(self, output_queue, count=0, pause=0, input_queue=None, **kwargs):
+        super(NumberSource, self).__init__(input_queue, output_queue, **kwargs)
+        self._count = count
+        self._pause = pause
+        self.start()
+
+    def produce(self):
+        for number in range(self._count):
+            yield (f'S{number}', number)
+        # Holds the stage open with its items all sent, like a source waiting for the next burst
+        time.sleep(self._pause)
+
+
+class Doubler(PipelineWorker):
+    def __init__(self, input_queue, output_queue, fail_on=None, delay=0, **kwargs):
+        super(Doubler, self).__init__(input_queue, output_queue, **kwargs)
+        self._fail_on = fail_on
+        self._delay = delay
+        self.start()
+
+    def process(self, item):
+        symbol, number = item
+        if number == self._fail_on:
+            raise RuntimeError(f'failing on {number}')
+        time.sleep(self._delay)
+        return symbol, number * 2
+
+
+def _run(path, pipeline):
+    with open(path, 'w') as outFile:
+        yaml.safe_dump(pipeline, outFile)
+    executor = YamlPipelineExecutor(pipeline_location=str(path), progress_interval=0.1)
+    executor.start()
+    executor.join(120)
+    assert not executor.is_alive()
+    return executor
+
+
+def _rows(path):
+    with open(path) as inFile:
+        return sorted((symbol, int(number)) for symbol, number in csv.reader(inFile))
+
+
+def _three_stages(tmp_path, count, source=None, **doubler):
+    return {
+        'queues': [{'name': 'Numbers', 'maxsize': 50}, {'name': 'Doubled'}],
+        'workers': [
+            {'name': 'Source', 'location': 'test_yaml_reader', 'class': 'NumberSource',
+             'params': dict({'count': count}, **(source or {})), 'output_queues': ['Numbers']},
+            dict({'name': 'Double', 'location': 'test_yaml_reader', 'class': 'Doubler', 'input_queue': 'Numbers',
+                  'output_queues': ['Doubled']}, **doubler),
+            {'name': 'Sink', 'location': 'workers.CsvWorker', 'class': 'CsvSink', 'input_queue': 'Doubled',
+             'params': {'path': str(tmp_path / 'doubled.csv'), 'header': False}},
+        ],
+    }
+
+
+def _assert_shut_down_cleanly(executor):
+    assert executor._failed_stages == set()
+    assert executor._scaling_stopped == set(executor._workers)
+    for instances in executor._workers.values():
+        for instance in instances:
+            assert not instance.is_alive()
+            assert getattr(instance, 'exitcode', 0) == 0
+    assert all(queue.qsize() == 0 for queue in executor._queues.values())
+
+
+def _executor_with(workers):
+    executor = YamlPipelineExecutor(pipeline_location=None)
+    executor._yaml_data = {'queues': [], 'workers': workers}
+    return executor
+
+
+def test_thread_and_asyncio_stages_get_an_in_process_queue():
+    executor = _executor_with([
+        {'name': 'a', 'output_queues': ['Q']},
+        {'name': 'b', 'executor': 'asyncio', 'input_queue': 'Q'},
+    ])
+    assert executor._select_transport({'name': 'Q'}) == 'thread'
+
+
+def test_process_stage_on_either_side_needs_the_process_transport():
+    executor = _executor_with([
+        {'name': 'a', 'output_queues': ['Q', 'R']},
+        {'name': 'b', 'executor': 'process', 'input_queue': 'Q'},
+        {'name': 'c', 'input_queue': 'R'},
+    ])
+    assert executor._select_transport({'name': 'Q'}) == 'process'
+    assert executor._select_transport({'name': 'R'}) == 'thread'
+
+
+def test_transport_can_be_overridden_in_the_queue_entry():
+    executor = _executor_with([
+        {'name': 'a', 'output_queues': ['Q']},
+        {'name': 'b', 'input_queue': 'Q'},
+    ])
+    assert executor._select_transport({'name': 'Q', 'transport': 'process'}) == 'process'
+
+
+def test_thread_transport_cannot_be_forced_onto_a_process_edge():
+    executor = _executor_with([
+        {'name': 'a', 'executor': 'process', 'output_queues': ['Q']},
+    ])
+    with pytest.raises(ValueError):
+        executor._select_transport({'name': 'Q', 'transport': 'thread'})
+    with pytest.raises(ValueError):
+        executor._select_transport({'name': 'Q', 'transport': 'pipe'})
+
+
+def test_http_client_entries_are_handed_to_workers_by_name():
+    executor = _executor_with([])
+    executor._yaml_data['http_clients'] = {'yahoo': {'timeout': 5, 'max_connections_per_host': 4}}
+    assert executor._stage_http_client({'name': 'a', 'http_client': 'yahoo'}) == \
+        {'name': 'yahoo', 'timeout': 5, 'max_connections_per_host': 4}
+    assert executor._stage_http_client({'name': 'a', 'http_client': {'retries': 1}}) == {'name': 'a', 'retries': 1}
+    assert executor._stage_http_client({'name': 'a'}) is None
+    with pytest.raises(ValueError):
+        executor._stage_http_client({'name': 'a', 'http_client': 'missing'})
+
+
+def test_retry_policies_are_handed_to_workers_by_name():
+    executor = _executor_with([])
+    executor._yaml_data['retry_policies'] = {'network': {'max_attempts': 5, 'retry_on': ['OSError']}}
+    policy = executor._stage_retry_policy({'name': 'a', 'retry': 'network'})
+    assert (policy.name, policy.max_attempts, policy.retry_on) == ('network', 5, (OSError,))
+    assert executor._stage_retry_policy({'name': 'a', 'retry': {'backoff': 2}}).backoff == 2
+    assert executor._stage_retry_policy({'name': 'a'}) is None
+    with pytest.raises(ValueError):
+        executor._stage_retry_policy({'name': 'a', 'retry': 'missing'})
+
+
+def test_dead_letter_queue_follows_the_transport_of_its_writer():
+    executor = _executor_with([
+        {'name': 'a', 'executor': 'process', 'output_queues': ['Q'], 'dead_letter_queue': 'D'},
+        {'name': 'b', 'input_queue': 'D'},
+    ])
+    assert executor._select_transport({'name': 'D'}) == 'process'
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_every_item_passes_through_a_three_stage_pipeline(tmp_path, executor):
+    pipeline = _three_stages(tmp_path, 300, executor=executor, instances=3)
+    finished = _run(tmp_path / 'pipeline.yaml', pipeline)
+    _assert_shut_down_cleanly(finished)
+    assert len(finished._workers['Double']) == 3
+    # Without a metrics: section nothing is sampled or counted
+    assert finished._metrics is None
+    assert set(finished._stage_stats.values()) == {None}
+    assert _rows(tmp_path / 'doubled.csv') == sorted((f'S{number}', number * 2) for number in range(300))
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_the_autoscaler_grows_a_stage_under_a_backlog_and_shrinks_it_when_idle(tmp_path, executor, capsys):
+    # 200 items of 10 ms each take 2 s on one instance, four times the target latency
+    pipeline = _three_stages(tmp_path, 200, source={'pause': 2}, executor=executor, min_instances=1,
+                             max_instances=4, target_latency=0.2, params={'delay': 0.01})
+    finished = _run(tmp_path / 'pipeline.yaml', pipeline)
+    _assert_shut_down_cleanly(finished)
+    assert _rows(tmp_path / 'doubled.csv') == sorted((f'S{number}', number * 2) for number in range(200))
+    steps = [(int(old), int(new)) for old, new in
+             re.findall(r'Autoscaler: Double (\d+) -> (\d+) instances', capsys.readouterr().out)]
+    sizes = [1] + [new for _, new in steps]
+    assert max(sizes) > 1
+    # Shrunk back one instance per tick once the source paused
+    assert sizes[-1] == 1 and sizes.index(max(sizes)) < len(sizes) - 1
+    assert len(finished._workers['Double']) >= max(sizes)
+    # Only the autoscaled stage is measured, for its autoscaler
+    assert [name for name, stats in finished._stage_stats.items() if stats is not None] == ['Double']
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_a_run_whose_stage_failed_mid_stream_is_resumed_from_the_checkpoint(tmp_path, executor):
+    checkpoint = tmp_path / 'checkpoint.json'
+    pipeline = {
+        'checkpoint': str(checkpoint),
+        'queues': [{'name': 'Numbers', 'type': 'persistent', 'path': str(tmp_path / 'numbers.sqlite3')},
+                   {'name': 'Doubled', 'type': 'persistent', 'path': str(tmp_path / 'doubled.sqlite3')}],
+        'workers': [
+            {'name': 'Source', 'location': 'test_yaml_reader', 'class': 'NumberSource', 'params': {'count': 10},
+             'output_queues': ['Numbers']},
+            {'name': 'Double', 'location': 'test_yaml_reader', 'class': 'Doubler', 'executor': executor,
+             'params': {'fail_on': 6}, 'input_queue': 'Numbers', 'output_queues': ['Doubled']},
+            {'name': 'Sink', 'location': 'workers.CsvWorker', 'class': 'CsvSink', 'input_queue': 'Doubled',
+             'params': {'path': str(tmp_path / 'doubled.csv'), 'header': False, 'flush_interval': 0.05}},
+        ],
+    }
+    first = _run(tmp_path / 'pipeline.yaml', pipeline)
+    assert first._failed_stages == {'Double'}
+    # The sink wrote what it got, but more is to come from Double: only the source is complete
+    with open(checkpoint) as inFile:
+        assert json.load(inFile) == {'completed_stages': ['Source']}
+    assert _rows(tmp_path / 'doubled.csv') == [(f'S{number}', number * 2) for number in range(6)]
+
+    del pipeline['workers'][1]['params']
+    second = _run(tmp_path / 'pipeline.yaml', pipeline)
+    assert second._failed_stages == set()
+    # The item Double failed on was not acknowledged, so the resumed run picks it up again
+    assert _rows(tmp_path / 'doubled.csv') == [(f'S{number}', number * 2) for number in range(10)]
+    assert not os.path.exists(checkpoint)
+
+
+def test_items_prefetched_for_asyncio_stages_wait_for_their_own_acknowledgement(tmp_path):
+    path = str(tmp_path / 'q.sqlite3')
+    queue = PersistentQueue('q', path=path, transport='thread')
+    queue.put_many(['a', 'b', 'c'])
+    queue.put_sentinel(DONE)
+    loop_thread = EventLoopThread()
+    async_queue = AsyncQueue(queue, loop_thread.loop)
+
+    async def read(max_items):
+        items = await async_queue.get_many(max_items, linger=1)
+        return items, async_queue.take_receipts()
+
+    def rows():
+        with sqlite3.connect(path) as connection:
+            # The items, without DONE
+            return connection.execute('SELECT COUNT(*) FROM items WHERE kind = 0').fetchone()[0]
+
+    items, receipts = asyncio.run_coroutine_threadsafe(read(1), loop_thread.loop).result(5)
+    assert items == ['a'] and len(receipts) == 1
+    # The feeder has taken 'b' and 'c' out of the queue meanwhile, which must not acknowledge 'a'
+    time.sleep(0.1)
+    assert rows() == 3
+    async_queue.acknowledge(receipts)
+    assert rows() == 2
+    items, receipts = asyncio.run_coroutine_threadsafe(read(10), loop_thread.loop).result(5)
+    assert items == ['b', 'c', DONE] and len(receipts) == 2
+    async_queue.acknowledge(receipts)
+    assert rows() == 0
+    async_queue.stop()
+    loop_thread.stop()
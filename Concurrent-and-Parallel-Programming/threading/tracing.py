@@ -0,0 +1,357 @@
+"""
+Per-item tracing of a pipeline, and the tools to read a trace file:
+
+    python tracing.py trace.jsonl --chrome trace.json   # for chrome://tracing or https://ui.perfetto.dev
+    python tracing.py trace.jsonl                       # latency percentiles per queue and stage
+    python tracing.py trace.jsonl trace.fetchers.jsonl  # together with the spans of a node
+"""
+import argparse
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import weakref
+
+from pipeline_queues import Traced, is_done
+
+# The tracers and trace readers of this process, flushed by flush_all() before a worker process exits
+_TRACERS = weakref.WeakSet()
+_READERS = weakref.WeakSet()
+
+# Spans of the items the current worker instance is processing. Every thread has its own context and
+# asyncio tasks copy the one they were created in, so each instance sees its own spans
+_current = contextvars.ContextVar('trace_spans', default=())
+
+
+def now_us():
+    return time.time_ns() // 1000
+
+
+class Span():
+    """
+    One hop of a traced item: the queue it waited in and the stage instance that took it out, with the times
+    it was put in, taken out, and processed, in microseconds of the wall clock, and how many attempts the
+    processing took.
+    """
+    __slots__ = ('tracer', 'trace_id', 'stage', 'instance', 'queue', 'enqueued', 'dequeued', 'started', 'ended',
+                 'attempts', 'claimed')
+
+    def __init__(self, tracer, trace_id, stage, instance, queue, enqueued, dequeued):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.stage = stage
+        self.instance = instance
+        self.queue = queue
+        self.enqueued = enqueued
+        self.dequeued = dequeued
+        self.started = dequeued
+        self.ended = None
+        self.attempts = 0
+        # Set once a worker marks the processing itself, the queue view then leaves the span alone
+        self.claimed = False
+
+    def as_dict(self):
+        return {'trace_id': self.trace_id, 'stage': self.stage, 'instance': self.instance, 'queue': self.queue,
+                'enqueued': self.enqueued, 'dequeued': self.dequeued, 'started': self.started, 'ended': self.ended,
+                'attempts': self.attempts}
+
+
+class Tracer():
+    """
+    Records where sampled items spend their time, configured by the optional top-level `tracing:` section:
+
+        tracing:
+          path: trace.jsonl    # truncated when the pipeline starts
+          sample_rate: 0.1     # share of the items of the source stages that are traced, 1 by default
+
+    A source stage starts a trace for each sampled item it writes, and the item travels in a
+    pipeline_queues.Traced envelope with the trace id and the time it was enqueued. The stage reading it
+    records one span per hop, see Span, and whatever it writes while processing the item carries the trace
+    on, so a trace follows a symbol from the Wikipedia page to its Postgres insert.
+
+    Which output belongs to which input is up to the worker: the outputs written after a read are matched
+    to the items of that read in order, and an item's processing ends when its output is written, or at
+    the next read. Workers that reorder, batch or retry items mark them with processing() and scope(), as
+    workers.PipelineWorker does. Ring buffer queues cannot carry an envelope, items written into one end
+    their trace.
+
+    Every process buffers its spans and appends them to the file as JSON lines, in single writes to a file
+    opened with O_APPEND, so all processes share it.
+    """
+    def __init__(self, path, sample_rate=1.0, buffer_size=1000, flush_interval=1.0):
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f"Tracing needs a sample_rate above 0 and at most 1, got {sample_rate}")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        open(path, 'w').close()
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._flushed_at = time.monotonic()
+        _TRACERS.add(self)
+
+    def __getstate__(self):
+        return self.path, self.sample_rate, self.buffer_size, self.flush_interval
+
+    def __setstate__(self, state):
+        self.path, self.sample_rate, self.buffer_size, self.flush_interval = state
+        self._reset()
+
+    @classmethod
+    def from_config(cls, tracing_config):
+        if tracing_config is None:
+            return None
+        return cls(**tracing_config)
+
+    def new_trace(self):
+        """
+        Id of a new trace, or None when the item is not sampled
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        return f'{random.getrandbits(64):016x}'
+
+    def record(self, span):
+        with self._lock:
+            self._buffer.append(span.as_dict())
+            due = len(self._buffer) >= self.buffer_size or \
+                time.monotonic() - self._flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+            self._flushed_at = time.monotonic()
+        if not spans:
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            os.write(fd, ''.join(json.dumps(span) + '\n' for span in spans).encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+def flush_all():
+    """
+    Records the spans still open and writes out every buffer, once the instances of this process are done
+    """
+    for reader in list(_READERS):
+        reader.end_spans()
+    for tracer in list(_TRACERS):
+        tracer.flush()
+
+
+class TraceReader():
+    """
+    The tracing side of a stage instance's input queue view: unwraps the envelopes of a read into spans
+    and records the spans of the previous read, which the worker has finished processing by then
+    """
+    def __init__(self, tracer, stage, instance, queue):
+        self._tracer = tracer
+        self._stage = stage
+        self._instance = instance
+        self._queue = queue
+        self._spans = ()
+        _READERS.add(self)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _READERS.add(self)
+
+    def end_spans(self):
+        """
+        Called when the instance reads again, done with the items of its last read
+        """
+        ended = now_us()
+        for span in self._spans:
+            if span is not None and not span.claimed:
+                span.ended = span.ended or ended
+                self._tracer.record(span)
+        self._spans = ()
+
+    def unwrap(self, items):
+        """
+        Called with what a read returned, before the instance gets it
+        """
+        dequeued = now_us()
+        self._spans = tuple(Span(self._tracer, item.trace_id, self._stage, self._instance, self._queue,
+                                 item.enqueued_at, dequeued) if isinstance(item, Traced) else None
+                            for item in items if not is_done(item))
+        _current.set(self._spans)
+        if not self._spans and items and is_done(items[-1]):
+            # Nothing is read after DONE. The spans of a batch that ends in DONE are ended by flush_all()
+            self._tracer.flush()
+        return [item.item if isinstance(item, Traced) else item for item in items]
+
+
+class TraceWriter():
+    """
+    The tracing side of an output queue view: wraps the items written into envelopes carrying the trace of
+    the item they came from, or a new trace for the items of a source stage
+    """
+    def __init__(self, tracer, starts_traces=False):
+        self._tracer = tracer
+        self._starts_traces = starts_traces
+        # The spans of the read being written for, and how many outputs this queue got for them so far
+        self._spans = ()
+        self._written = 0
+
+    def wrap(self, items):
+        enqueued = now_us()
+        if self._starts_traces:
+            trace_ids = [self._tracer.new_trace() for _ in items]
+        else:
+            spans = _current.get()
+            if spans is not self._spans:
+                self._spans, self._written = spans, 0
+            trace_ids = []
+            for _ in items:
+                span = spans[min(self._written, len(spans) - 1)] if spans else None
+                self._written += 1
+                if span is not None and not span.claimed and span.ended is None:
+                    # Writing its output ends the processing of the item
+                    span.ended = enqueued
+                trace_ids.append(span.trace_id if span is not None else None)
+        return [Traced(item, trace_id, enqueued) if trace_id is not None else item
+                for item, trace_id in zip(items, trace_ids)]
+
+
+def spans_for(items):
+    """
+    The spans of items as handed out by the last read, None for the items that are not traced
+    """
+    spans = _current.get()
+    return list(spans) if len(spans) == len(items) else [None] * len(items)
+
+
+def claim(span):
+    """
+    Marks the processing of span as the worker's: the queue view no longer ends it at the next read, and
+    processing() records it. For workers that read ahead of what they have processed, like the asyncio ones
+    """
+    if span is not None:
+        span.claimed = True
+
+
+def start(span):
+    """
+    Marks an attempt at processing span's item; the first one is where its processing starts
+    """
+    if span is None:
+        return
+    claim(span)
+    if span.attempts == 0:
+        span.started = now_us()
+    span.attempts += 1
+
+
+def finish(spans):
+    """
+    Ends and records claimed spans whose items are done, e.g. once a sink has written them out
+    """
+    ended = now_us()
+    for span in spans:
+        if span is not None and span.ended is None:
+            span.ended = ended
+            span.tracer.record(span)
+
+
+@contextlib.contextmanager
+def scope(spans):
+    """
+    Outputs written within the block carry on the traces of spans, in order
+    """
+    token = _current.set(tuple(spans))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def processing(span):
+    """
+    The block processes the item of span: records its processing start and end, and has the outputs
+    written within the block carry its trace
+    """
+    start(span)
+    try:
+        with scope([span]):
+            yield
+    finally:
+        finish([span])
+
+
+def read_spans(path):
+    with open(path, 'r') as inFile:
+        return [json.loads(line) for line in inFile if line.strip()]
+
+
+def chrome_trace(spans):
+    """
+    Chrome trace event format of spans. Each stage is a process with an async track per queue wait and per
+    processing, and all events of an item share its trace id.
+    """
+    stages = sorted({span['stage'] for span in spans})
+    pids = {stage: pid for pid, stage in enumerate(stages, 1)}
+    events = [{'ph': 'M', 'name': 'process_name', 'pid': pid, 'args': {'name': stage}} for stage, pid in pids.items()]
+    for span in spans:
+        args = {'trace_id': span['trace_id'], 'instance': span['instance']}
+        for name, category, begin, end in ((f"wait in {span['queue']}", 'queue', span['enqueued'], span['dequeued']),
+                                           (span['stage'], 'stage', span['started'], span['ended'])):
+            common = {'name': name, 'cat': category, 'id': span['trace_id'], 'pid': pids[span['stage']], 'tid': 0}
+            events.append(dict(common, ph='b', ts=begin, args=args))
+            events.append(dict(common, ph='e', ts=end))
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _percentiles(values):
+    values = sorted(values)
+    pick = lambda share: values[min(len(values) - 1, int(share * len(values)))]
+    return {'count': len(values), 'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': values[-1]}
+
+
+def summary(spans):
+    """
+    Latency percentiles in milliseconds of the waits per queue, the processing per stage and whole traces
+    """
+    latencies = collections.defaultdict(list)
+    traces = {}
+    for span in spans:
+        latencies[f"queue {span['queue']}"].append((span['dequeued'] - span['enqueued']) / 1000)
+        latencies[f"stage {span['stage']}"].append((span['ended'] - span['started']) / 1000)
+        first, last = traces.get(span['trace_id'], (span['enqueued'], span['ended']))
+        traces[span['trace_id']] = (min(first, span['enqueued']), max(last, span['ended']))
+    if traces:
+        latencies['end to end'] = [(last - first) / 1000 for first, last in traces.values()]
+    return {name: _percentiles(values) for name, values in latencies.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('traces', nargs='+', help='trace files written by the pipeline and its nodes')
+    parser.add_argument('--chrome', help='write the trace in Chrome trace event format to this file')
+    args = parser.parse_args()
+
+    spans = [span for path in args.traces for span in read_spans(path)]
+    if args.chrome:
+        with open(args.chrome, 'w') as outFile:
+            json.dump(chrome_trace(spans), outFile)
+        print(f'{len(spans)} spans written to {args.chrome}')
+        return
+    for name, stats in sorted(summary(spans).items()):
+        print(f"{name}: {stats['count']} items, p50 {stats['p50']:.2f} ms, p95 {stats['p95']:.2f} ms, "
+              f"p99 {stats['p99']:.2f} ms, max {stats['max']:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
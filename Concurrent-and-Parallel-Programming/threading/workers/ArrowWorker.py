@@ -0,0 +1,69 @@
+import uuid
+
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+from workers.SinkWorker import PRICE_COLUMNS, BufferedSinkWorker
+
+FORMATS = ('parquet', 'arrow')
+
+# Arrow types of the default price columns
+PRICE_TYPES = {'symbol': 'string', 'price': 'float64', 'extracted_time': 'timestamp[us]'}
+
+
+class ArrowSink(BufferedSinkWorker):
+    """
+    Sink stage writing rows into a columnar file for analytics, a drop-in for PostgresMasterScheduler that
+    needs no server. Every flush becomes one Parquet row group or one Arrow record batch, so flush_rows sets
+    the row group size; the defaults favour few large row groups over frequent small ones. The file is only
+    complete once the instance has finished, and an instance that got no rows writes none. Options under `params:`:
+
+    path       prices-{part}.parquet by default. {part} is replaced by a token unique to the instance, as a
+               columnar file has a single writer. Without {part} in the path, run a single instance
+    format     parquet (default) or arrow for the Arrow IPC file format
+    columns    names of the row fields, symbol, price and extracted_time by default
+    types      Arrow type aliases per column (string, float64, timestamp[us], ...). Columns the mapping does
+               not cover make the whole schema inferred from the first flush
+    """
+    def __init__(self, input_queue, path='prices-{part}.parquet', format='parquet', columns=PRICE_COLUMNS,
+                 types=None, flush_rows=50000, flush_interval=30, **kwargs):
+        super(ArrowSink, self).__init__(input_queue, flush_rows=flush_rows, flush_interval=flush_interval, **kwargs)
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format '{format}', expected one of {FORMATS}")
+        self._path = path.replace('{part}', uuid.uuid4().hex[:12])
+        self._format = format
+        self._columns = tuple(columns)
+        types = types if types is not None else PRICE_TYPES
+        self._schema = None
+        if all(column in types for column in self._columns):
+            self._schema = pa.schema([(column, pa.type_for_alias(types[column])) for column in self._columns])
+        self._writer = None
+        self.start()
+
+    @property
+    def path(self):
+        return self._path
+
+    def write_rows(self, rows):
+        columns = list(zip(*rows))
+        if self._schema is None:
+            table = pa.Table.from_arrays([pa.array(values) for values in columns], names=list(self._columns))
+            # Inferred once, the later flushes are converted to the same schema
+            self._schema = table.schema
+        else:
+            table = pa.Table.from_arrays([pa.array(values, type=field.type)
+                                          for values, field in zip(columns, self._schema)], schema=self._schema)
+        if self._writer is None:
+            if self._format == 'parquet':
+                self._writer = pq.ParquetWriter(self._path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self._path, self._schema)
+        if self._format == 'parquet':
+            self._writer.write_table(table, row_group_size=table.num_rows)
+        else:
+            self._writer.write_table(table, max_chunksize=table.num_rows)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,60 @@
+import csv
+import io
+import os
+import tempfile
+
+from workers.SinkWorker import PRICE_COLUMNS, BufferedSinkWorker
+
+
+class CsvSink(BufferedSinkWorker):
+    """
+    Sink stage appending rows to a CSV file, a drop-in for PostgresMasterScheduler that needs no server.
+    Each flush is formatted in memory and appended with a single write() on a file opened with O_APPEND, so
+    any number of instances, process-backed ones included, can share the file without interleaving the rows
+    of their flushes. The header row is written by whichever instance creates the file, and the file only
+    appears with its header already in it, so no other instance can append rows above it. Options under
+    `params:`:
+
+    path       prices.csv by default
+    columns    header row, symbol, price and extracted_time by default
+    header     false to write no header row
+    """
+    def __init__(self, input_queue, path='prices.csv', columns=PRICE_COLUMNS, header=True, **kwargs):
+        super(CsvSink, self).__init__(input_queue, **kwargs)
+        self._path = path
+        self._columns = tuple(columns)
+        self._header = header
+        self._fd = None
+        self.start()
+
+    def setup(self):
+        if self._header and not os.path.exists(self._path):
+            self._create_with_header()
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+
+    def _create_with_header(self):
+        # The header goes into a file of its own first, which is then linked in under the path. The link fails
+        # if another instance got there first, and otherwise publishes the file with the complete header
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(self._path)))
+        try:
+            try:
+                os.write(fd, self._format([self._columns]))
+            finally:
+                os.close(fd)
+            os.link(temp_path, self._path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+
+    def write_rows(self, rows):
+        os.write(self._fd, self._format(rows))
+
+    def close(self):
+        os.close(self._fd)
+
+    @staticmethod
+    def _format(rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode('utf-8')
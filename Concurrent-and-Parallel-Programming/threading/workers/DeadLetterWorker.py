@@ -0,0 +1,30 @@
+import json
+import os
+
+from workers.SinkWorker import BufferedSinkWorker
+
+
+class DeadLetterSink(BufferedSinkWorker):
+    """
+    Sink stage for a dead letter queue: appends every retry.DeadLetter as one JSON object per line, with the
+    stage, the item, the error, the number of attempts and when it failed. Values JSON has no type for are
+    written as their str(). Like CsvSink, each flush is a single write() to a file opened with O_APPEND, so
+    instances in any process can share the file. Options under `params:`:
+
+    path       dead_letters.jsonl by default
+    """
+    def __init__(self, input_queue, path='dead_letters.jsonl', **kwargs):
+        super(DeadLetterSink, self).__init__(input_queue, **kwargs)
+        self._path = path
+        self._fd = None
+        self.start()
+
+    def setup(self):
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+
+    def write_rows(self, dead_letters):
+        lines = ''.join(json.dumps(dead_letter._asdict(), default=str) + '\n' for dead_letter in dead_letters)
+        os.write(self._fd, lines.encode('utf-8'))
+
+    def close(self):
+        os.close(self._fd)
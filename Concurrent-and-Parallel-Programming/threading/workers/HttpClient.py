@@ -0,0 +1,90 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpClient():
+    """
+    HTTP client shared by every worker instance of a process that names the same client, so their requests
+    reuse kept-alive connections instead of paying a TCP and TLS handshake each. Configured by an entry
+    of the top-level `http_clients:` section of the YAML, which a worker entry picks with `http_client:`:
+
+    timeout                   seconds to wait for the response, 10 by default
+    connect_timeout           seconds to wait for the connection, 3.05 by default
+    max_connections_per_host  connections kept open to one host, 10 by default. Requests beyond it wait
+                              for a free connection, so this also caps the load on the host
+    max_hosts                 hosts to keep connection pools for, 10 by default
+    retries                   attempts after a connection error or a 429/5xx response, 3 by default
+    backoff_factor            retries wait backoff_factor * 2 ** (retry - 1) seconds, or what Retry-After asks
+    headers                   sent with every request, e.g. a User-Agent
+
+    Workers call acquire() in setup() and release() in teardown(); the last release() closes the connections.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    def __init__(self, name, timeout=10, connect_timeout=3.05, max_connections_per_host=10, max_hosts=10,
+                 retries=3, backoff_factor=0.5, headers=None):
+        self.name = name
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.max_hosts = max_hosts
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.headers = headers or {}
+        self._session = None
+        self._users = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, config=None):
+        """
+        Returns this process's client for an `http_clients:` entry, as handed to workers by the executor,
+        creating it on first use. Workers without an http_client get the default one.
+        """
+        config = dict(config or {})
+        name = config.setdefault('name', 'default')
+        with cls._clients_lock:
+            if name not in cls._clients:
+                cls._clients[name] = cls(**config)
+            return cls._clients[name]
+
+    def _create_session(self):
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor, status_forcelist=self.RETRY_STATUSES,
+                      allowed_methods=frozenset(['GET', 'HEAD']), respect_retry_after_header=True,
+                      raise_on_status=False)
+        # pool_block makes requests wait for one of the host's connections instead of opening more
+        adapter = HTTPAdapter(pool_connections=self.max_hosts, pool_maxsize=self.max_connections_per_host,
+                              pool_block=True, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(self.headers)
+        return session
+
+    def acquire(self):
+        with self._lock:
+            if self._session is None:
+                self._session = self._create_session()
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                self._session.close()
+                self._session = None
+
+    def get(self, url, **kwargs):
+        """
+        requests.get() on the shared session, with the client's timeouts unless the caller passes its own.
+        Once the retries are used up the last response is returned, so callers still check status_code.
+        """
+        kwargs.setdefault('timeout', (self.connect_timeout, self.timeout))
+        return self._session.get(url, **kwargs)
@@ -0,0 +1,229 @@
+import datetime
+import threading
+import time
+import traceback
+from queue import Empty
+
+import tracing
+from pipeline_queues import acknowledge, is_done, take_receipts
+from retry import DeadLetter, TimerWheel
+
+
+class PipelineWorker(threading.Thread):
+    """
+    Base class of the pipeline's workers, with a lifecycle run by run() on the worker's own thread
+    (inside the child process for process-backed stages):
+
+    setup()               called once before the first item; open connections, sessions, parsers, caches here
+    process(item)         called per item, returns the result to send downstream, or None for nothing
+    process_batch(items)  called per batch read from the input queue; by default process() for every item,
+                          with all results sent downstream in one put_many(). Override it to work on whole
+                          batches, e.g. for one INSERT per batch
+    produce()             for source stages without an input_queue: yields the items to send downstream
+    teardown()            called once after the last item, also when processing failed
+    read_timeout()        how long the next read may wait for input, None (the default) for as long as it takes
+    on_idle()             called when a read timed out, e.g. to flush what a sink buffered
+
+    run() reads the input queue until DONE. An exception ends the instance and sets `failed`. The executor puts DONE as soon as every upstream stage has
+    finished, so reads block without a timeout and the instance stops right after the last item.
+
+    A stage opts into micro-batching with `batch_size:` and optionally `batch_linger:` in its YAML entry:
+    every read then takes up to batch_size items, waiting at most batch_linger seconds for the batch to
+    fill up. Without them process_batch() gets one item at a time. Source stages send what produce()
+    yields in batches of batch_size.
+
+    With `rate_limit:` in the YAML entry the executor hands in a shared rate_limiter.TokenBucket, which
+    wait_for_rate_limit() draws from.
+
+    With `retry:` (a retry.RetryPolicy) an item whose process() raised is tried again later. It waits on a
+    TimerWheel meanwhile, so the instance goes on with the next items instead of sleeping through the
+    backoff, and it only stops at DONE once no retry is left. An item that fails for good is put into the
+    `dead_letter_queue:` as a retry.DeadLetter, or dropped with its traceback printed when the stage has
+    none. Without either, an exception stops the instance as before. Retries apply to process(), a stage
+    overriding process_batch() handles its own failures.
+
+    With `tracing:` configured, an item is processed from its first process() call until its last attempt,
+    and its result carries the item's trace on. See tracing.Tracer.
+
+    Items read from a persistent queue are acknowledged, i.e. deleted from it, once process_batch() has
+    returned: process() results are then downstream, and a retried item is only acknowledged once it
+    succeeded or went to the dead letter queue. A process_batch() that hands items on later, like
+    workers.SinkWorker.BufferedSinkWorker buffering rows, takes their receipts with take_receipts() and
+    acknowledges them itself. Items of a batch that raised are not acknowledged.
+    """
+    def __init__(self, input_queue, output_queue=None, batch_size=1, batch_linger=0, rate_limiter=None,
+                 retry_policy=None, dead_letter_queue=None, **kwargs):
+        super(PipelineWorker, self).__init__(**kwargs)
+        self._input_queue = input_queue
+        temp_queue = output_queue if output_queue is not None else []
+        if type(temp_queue) != list:
+            temp_queue = [temp_queue]
+        self._output_queues = temp_queue
+        self._batch_size = batch_size
+        self._batch_linger = batch_linger
+        self._rate_limiter = rate_limiter
+        self._retry_policy = retry_policy
+        self._dead_letter_queue = dead_letter_queue
+        # (item, number of its next attempt, its trace span, its receipt) waiting for their backoff to pass
+        self._retries = TimerWheel()
+        # Receipts of the batch being processed, acknowledged once process_batch() returns
+        self._receipts = []
+        self.failed = False
+
+    def run(self):
+        try:
+            self.setup()
+            try:
+                if self._input_queue is None:
+                    self._run_source()
+                else:
+                    self._run_consumer()
+            finally:
+                self.teardown()
+        except BaseException:
+            # Seen by the executor, which then does not count the stage as completed
+            self.failed = True
+            raise
+
+    def _run_consumer(self):
+        while True:
+            self._retry_expired()
+            try:
+                vals = self._input_queue.get_many(self._batch_size, linger=self._batch_linger,
+                                                  timeout=self._next_timeout())
+            except Empty:
+                self.on_idle()
+                continue
+            items = [val for val in vals if not is_done(val)]
+            if items:
+                self._receipts = take_receipts(self._input_queue, items)
+                self.process_batch(items)
+                self.acknowledge(self.take_receipts())
+            if len(items) < len(vals):
+                break
+        # Past DONE nothing new comes in, only the retries are left to wait for
+        while self._retries:
+            time.sleep(self._retries.next_expiry() or 0)
+            self._retry_expired()
+
+    def _next_timeout(self):
+        timeout = self.read_timeout()
+        retry_due = self._retries.next_expiry()
+        if retry_due is None:
+            return timeout
+        return retry_due if timeout is None else min(timeout, retry_due)
+
+    def _retry_expired(self):
+        expired = self._retries.expired()
+        if expired:
+            self._process_attempts(expired)
+
+    def _process_attempts(self, attempts):
+        # attempts are (item, attempt, span, receipt), the results go downstream together
+        results = []
+        spans = []
+        handled = []
+        for item, attempt, span, receipt in attempts:
+            retries = len(self._retries)
+            if span is None:
+                result = self._attempt(item, attempt, receipt=receipt)
+            else:
+                tracing.start(span)
+                with tracing.scope([span]):
+                    result = self._attempt(item, attempt, span, receipt)
+            # A retried item is still being processed until its last attempt
+            if len(self._retries) == retries:
+                tracing.finish([span])
+                handled.append(receipt)
+            if result is not None:
+                results.append(result)
+                spans.append(span)
+        if results:
+            with tracing.scope(spans):
+                self.send_downstream(results)
+        # Only once their results are downstream
+        self.acknowledge(handled)
+
+    def _attempt(self, item, attempt, span=None, receipt=None):
+        if self._retry_policy is None and self._dead_letter_queue is None:
+            return self.process(item)
+        try:
+            return self.process(item)
+        except Exception as e:
+            self._failed(item, attempt, span, receipt, e)
+            return None
+
+    def _failed(self, item, attempt, span, receipt, error):
+        if self._retry_policy is not None and self._retry_policy.should_retry(attempt, error):
+            self._retries.schedule(self._retry_policy.delay(attempt), (item, attempt + 1, span, receipt))
+            return
+        if self._dead_letter_queue is None:
+            print(f"{self.name}: giving up on {item!r} after {attempt} attempts")
+            traceback.print_exception(type(error), error, error.__traceback__)
+            return
+        self._dead_letter_queue.put(DeadLetter(type(self).__name__, item, repr(error), attempt,
+                                               datetime.datetime.utcnow()))
+
+    def _run_source(self):
+        batch = []
+        for item in self.produce():
+            batch.append(item)
+            if len(batch) >= self._batch_size:
+                self.send_downstream(batch)
+                batch = []
+        if batch:
+            self.send_downstream(batch)
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def read_timeout(self):
+        return None
+
+    def on_idle(self):
+        pass
+
+    def process(self, item):
+        raise NotImplementedError
+
+    def process_batch(self, items):
+        receipts = self.take_receipts()
+        if len(receipts) != len(items):
+            receipts = [None] * len(items)
+        attempts = zip(items, tracing.spans_for(items), receipts)
+        self._process_attempts([(item, 1, span, receipt) for item, span, receipt in attempts])
+
+    def produce(self):
+        raise NotImplementedError
+
+    def wait_for_rate_limit(self, tokens=1):
+        """
+        Blocks until the stage's rate limiter grants the tokens, returns at once for stages without one
+        """
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire(tokens)
+
+    def take_receipts(self):
+        """
+        Takes the receipts of the batch being processed, one per item and None for items that need none, from
+        process_batch(): the items are then only acknowledged by acknowledge(receipts)
+        """
+        receipts, self._receipts = self._receipts, []
+        return receipts
+
+    def acknowledge(self, receipts):
+        """
+        Acknowledges handled items at the input queue, see take_receipts()
+        """
+        if self._input_queue is not None:
+            acknowledge(self._input_queue, receipts)
+
+    def send_downstream(self, values):
+        """
+        Hands a list of results to every output queue with a single put_many()
+        """
+        for output_queue in self._output_queues:
+            output_queue.put_many(values)
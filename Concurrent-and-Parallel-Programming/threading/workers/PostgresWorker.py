@@ -1,58 +1,146 @@
+import csv
+import io
 import os
 import threading
 
-from queue import Empty
-
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.sql import text
 
+from workers.SinkWorker import BufferedSinkWorker
+
+INSERT_METHODS = ('executemany', 'values', 'copy')
+
 
-class PostgresMasterScheduler(threading.Thread):
-    def __init__(self, input_queue, **kwargs):
-        if 'output_queue' in kwargs:
-            kwargs.pop('output_queue')
-        super(PostgresMasterScheduler, self).__init__(**kwargs)
-        self._input_queue = input_queue
+class PostgresMasterScheduler(BufferedSinkWorker):
+    """
+    Sink stage writing (symbol, price, extracted_time) rows into the prices table. All instances in a process
+    share one pooled engine, and the rows are written per flush in a single transaction, see
+    workers.SinkWorker for when a flush happens. Options under `params:` in the YAML entry:
+
+    insert_method  executemany (default): one INSERT executed for all rows of the flush
+                   values: multi-row INSERT ... VALUES statements
+                   copy: COPY ... FROM STDIN, Postgres only and the fastest for large flushes
+    url            database url, built from the PG_* environment variables by default
+    table          prices by default
+    pool_size      connections kept by the shared engine, size it to the stage's max_instances
+    """
+    def __init__(self, input_queue, url=None, table='prices', insert_method='executemany', pool_size=5, **kwargs):
+        super(PostgresMasterScheduler, self).__init__(input_queue, **kwargs)
+        if insert_method not in INSERT_METHODS:
+            raise ValueError(f"Unknown insert_method '{insert_method}', expected one of {INSERT_METHODS}")
+        self._url = url if url is not None else PostgresWorker.db_url()
+        if insert_method == 'copy' and make_url(self._url).get_backend_name() != 'postgresql':
+            raise ValueError("insert_method copy needs a postgresql url")
+        self._table = table
+        self._insert_method = insert_method
+        self._pool_size = pool_size
+        self._engine = None
         self.start()
 
-    def run(self):
-        while True:
-            try:
-                val = self._input_queue.get(timeout=10)
-            except Empty:
-                print('Timeout reached in postgres scheduler, stopping')
-                break
+    def setup(self):
+        self._engine = PostgresWorker.acquire_engine(self._url, self._pool_size)
 
-            if val == 'DONE':
-                break
+    def write_rows(self, rows):
+        PostgresWorker.insert_many_into_db(self._engine, rows, table=self._table, method=self._insert_method)
 
-            symbol, price, extracted_time = val
-            postgresWorker = PostgresWorker(symbol, price, extracted_time)
-            postgresWorker.insert_into_db()
+    def close(self):
+        PostgresWorker.release_engine(self._url)
 
 
 class PostgresWorker():
-    def __init__(self, symbol, price, extracted_time):
-        self._symbol = symbol
-        self._price = price
-        self._extracted_time = extracted_time
+    # Multi-row VALUES statements are cut into chunks of this many rows, which keeps them under the bound
+    # parameter limit of every backend (999 for SQLite before 3.32)
+    VALUES_CHUNK_ROWS = 300
+
+    _engines = {}
+    _engines_lock = threading.Lock()
 
-        self._PG_USER = os.environ.get('PG_USER')
-        self._PG_PW = os.environ.get('PG_PW')
-        self._PG_HOST = os.environ.get('PG_HOST')
-        self._PG_DB = os.environ.get('PG_DB')
+    @staticmethod
+    def db_url():
+        PG_USER = os.environ.get('PG_USER')
+        PG_PW = os.environ.get('PG_PW')
+        PG_HOST = os.environ.get('PG_HOST')
+        PG_DB = os.environ.get('PG_DB')
 
-        self._engine = create_engine(f'postgresql://{self._PG_USER}:{self._PG_PW}@{self._PG_HOST}/{self._PG_DB}')
+        return f'postgresql://{PG_USER}:{PG_PW}@{PG_HOST}/{PG_DB}'
 
-    def _create_insert_query(self):
-        SQL = """INSERT INTO prices (symbol, price, extracted_time) VALUES 
+    @classmethod
+    def create_db_engine(cls, url=None, pool_size=5):
+        url = url if url is not None else cls.db_url()
+        if make_url(url).get_backend_name() == 'sqlite':
+            return create_engine(url)
+        return create_engine(url, pool_size=pool_size, max_overflow=pool_size, pool_pre_ping=True)
+
+    @classmethod
+    def acquire_engine(cls, url, pool_size=5):
+        """
+        Returns the engine shared by every sink instance of this process writing to url, creating it for the
+        first one. Each acquire_engine() is paired with a release_engine(); the last one disposes the engine.
+        """
+        with cls._engines_lock:
+            engine, users = cls._engines.get(url, (None, 0))
+            if engine is None:
+                engine = cls.create_db_engine(url, pool_size)
+            cls._engines[url] = (engine, users + 1)
+            return engine
+
+    @classmethod
+    def release_engine(cls, url):
+        with cls._engines_lock:
+            engine, users = cls._engines.pop(url)
+            if users > 1:
+                cls._engines[url] = (engine, users - 1)
+                return
+        engine.dispose()
+
+    @staticmethod
+    def _create_insert_query(table='prices'):
+        SQL = f"""INSERT INTO {table} (symbol, price, extracted_time) VALUES
         (:symbol, :price, :extracted_time)"""
         return SQL
 
-    def insert_into_db(self):
-        insert_query = self._create_insert_query()
+    @staticmethod
+    def _create_values_query(table, row_count):
+        placeholders = ', '.join(f'(:symbol_{i}, :price_{i}, :extracted_time_{i})' for i in range(row_count))
+        return f"INSERT INTO {table} (symbol, price, extracted_time) VALUES {placeholders}"
+
+    @classmethod
+    def insert_many_into_db(cls, engine, rows, table='prices', method='executemany'):
+        """
+        Inserts (symbol, price, extracted_time) rows in one transaction with the given insert method
+        """
+        if method == 'copy':
+            cls._copy_into_db(engine, rows, table)
+            return
+        with engine.begin() as conn:
+            if method == 'executemany':
+                params = [{'symbol': symbol, 'price': price, 'extracted_time': str(extracted_time)}
+                          for symbol, price, extracted_time in rows]
+                conn.execute(text(cls._create_insert_query(table)), params)
+                return
+            for start in range(0, len(rows), cls.VALUES_CHUNK_ROWS):
+                chunk = rows[start:start + cls.VALUES_CHUNK_ROWS]
+                params = {}
+                for i, (symbol, price, extracted_time) in enumerate(chunk):
+                    params[f'symbol_{i}'] = symbol
+                    params[f'price_{i}'] = price
+                    params[f'extracted_time_{i}'] = str(extracted_time)
+                conn.execute(text(cls._create_values_query(table, len(chunk))), params)
 
-        with self._engine.connect() as conn:
-            conn.execute(text(insert_query), {'symbol': self._symbol,
-                                              'price': self._price,
-                                              'extracted_time': str(self._extracted_time)})
+    @staticmethod
+    def _copy_into_db(engine, rows, table):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for symbol, price, extracted_time in rows:
+            # An unquoted empty field is NULL in COPY's csv format
+            writer.writerow((symbol, '' if price is None else price, extracted_time))
+        buffer.seek(0)
+        connection = engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.copy_expert(f"COPY {table} (symbol, price, extracted_time) FROM STDIN WITH (FORMAT csv)",
+                                   buffer)
+            connection.commit()
+        finally:
+            connection.close()
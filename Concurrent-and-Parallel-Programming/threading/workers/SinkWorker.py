@@ -0,0 +1,94 @@
+import time
+
+import tracing
+from workers.PipelineWorker import PipelineWorker
+
+# Fields of the (symbol, price, extracted_time) rows the Yahoo stage produces, the default layout of the sinks
+PRICE_COLUMNS = ('symbol', 'price', 'extracted_time')
+
+
+class FlushPolicy():
+    """
+    Decides when a sink writes out the rows it buffered: as soon as `max_rows` rows are waiting, or
+    `max_interval` seconds after the oldest of them arrived, whichever comes first.
+    """
+    def __init__(self, max_rows=1000, max_interval=1.0):
+        if max_rows < 1:
+            raise ValueError("flush_rows must be at least 1")
+        if max_interval <= 0:
+            raise ValueError("flush_interval must be positive")
+        self.max_rows = max_rows
+        self.max_interval = max_interval
+
+    def remaining(self, buffered_since):
+        return max(0.0, buffered_since + self.max_interval - time.monotonic())
+
+    def is_due(self, buffered_rows, buffered_since):
+        return buffered_rows >= self.max_rows or self.remaining(buffered_since) == 0
+
+
+class BufferedSinkWorker(PipelineWorker):
+    """
+    Base class of the sink stages. Rows read from the input queue are collected in a buffer and handed to
+    write_rows() whenever the FlushPolicy says so, and once more after the last row. The YAML entry sets
+    the policy with `flush_rows:` and `flush_interval:` under `params:`. While rows are buffered, reads
+    wait no longer than the time left until they are due, so a slow trickle of rows is still written
+    within flush_interval seconds.
+
+    Subclasses open their connection or file in setup() and implement write_rows(rows) and close().
+    A traced row is processed until write_rows() has written it, and a row from a persistent queue is only
+    acknowledged then.
+    """
+    def __init__(self, input_queue, flush_rows=1000, flush_interval=1.0, **kwargs):
+        if 'output_queue' in kwargs:
+            kwargs.pop('output_queue')
+        super(BufferedSinkWorker, self).__init__(input_queue, **kwargs)
+        self._flush_policy = FlushPolicy(flush_rows, flush_interval)
+        self._buffer = []
+        self._buffered_since = None
+        self._buffered_spans = []
+        self._buffered_receipts = []
+
+    def process_batch(self, rows):
+        if not self._buffer:
+            self._buffered_since = time.monotonic()
+        self._buffer.extend(rows)
+        self._buffered_receipts.extend(self.take_receipts())
+        for span in tracing.spans_for(rows):
+            if span is not None:
+                tracing.claim(span)
+                self._buffered_spans.append(span)
+        if self._flush_policy.is_due(len(self._buffer), self._buffered_since):
+            self.flush()
+
+    def read_timeout(self):
+        if not self._buffer:
+            return None
+        return self._flush_policy.remaining(self._buffered_since)
+
+    def on_idle(self):
+        if self._buffer and self._flush_policy.is_due(len(self._buffer), self._buffered_since):
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        spans, self._buffered_spans = self._buffered_spans, []
+        receipts, self._buffered_receipts = self._buffered_receipts, []
+        self._buffered_since = None
+        self.write_rows(rows)
+        tracing.finish(spans)
+        self.acknowledge(receipts)
+
+    def teardown(self):
+        try:
+            self.flush()
+        finally:
+            self.close()
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def close(self):
+        pass
@@ -0,0 +1,48 @@
+import datetime
+import sqlite3
+
+from workers.SinkWorker import PRICE_COLUMNS, BufferedSinkWorker
+
+
+class SqliteSink(BufferedSinkWorker):
+    """
+    Sink stage writing rows into a local SQLite database, a drop-in for PostgresMasterScheduler that needs no
+    server. The database runs in WAL mode, so the instances' flushes only wait for each other's commits and
+    readers are never blocked. Each flush is one executemany in one transaction. Options under `params:`:
+
+    path       database file, prices.sqlite3 by default
+    table      prices by default, created on first use
+    columns    names of the row fields, symbol, price and extracted_time by default
+    """
+    def __init__(self, input_queue, path='prices.sqlite3', table='prices', columns=PRICE_COLUMNS, **kwargs):
+        super(SqliteSink, self).__init__(input_queue, **kwargs)
+        self._path = path
+        self._table = table
+        self._columns = tuple(columns)
+        self._connection = None
+        self.start()
+
+    def setup(self):
+        # The busy timeout covers the short moments in which another instance holds the write lock
+        self._connection = sqlite3.connect(self._path, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {self._table} ({', '.join(self._columns)})")
+
+    def write_rows(self, rows):
+        placeholders = ', '.join('?' for _ in self._columns)
+        with self._connection:
+            self._connection.executemany(
+                f"INSERT INTO {self._table} ({', '.join(self._columns)}) VALUES ({placeholders})",
+                [tuple(self._to_sqlite(value) for value in row) for row in rows])
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _to_sqlite(value):
+        # sqlite3's implicit datetime adapter is deprecated, store the same ISO text explicitly
+        if isinstance(value, datetime.datetime):
+            return value.isoformat(sep=' ')
+        return value
@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import concurrent.futures
+import pickle
+import sqlite3
+import threading
+import time
+
+# Returned by get() for keys without a fresh entry, so that None can be cached like any other value
+MISSING = object()
+
+
+class TtlCache():
+    """
+    Cache of fetch results, shared by every worker instance of a process that names the same cache. An entry
+    is served for `ttl` seconds after it was fetched; after that the next lookup fetches again. Configured
+    with `cache:` under `params:` of a fetching stage:
+
+    name        instances naming the same cache share it, quotes by default
+    ttl         seconds an entry stays fresh, 300 by default
+    max_bytes   memory tier bound on the pickled size of the entries, least recently used ones are evicted
+                first. 64 MB by default
+    path        optional SQLite file behind the memory tier, so entries survive the process and are shared
+                with process-backed instances and with the next run. Stale entries are purged when it opens
+
+    get_or_fetch() and get_or_fetch_async() coalesce concurrent lookups of the same key: while one caller
+    fetches, the others wait for its result instead of fetching the same thing again.
+    Instances call acquire() in setup() and release() in teardown(); the last release() closes the file.
+    """
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    def __init__(self, name, ttl=300, max_bytes=64 * 1024 * 1024, path=None):
+        if ttl <= 0:
+            raise ValueError(f"Cache {name} needs a positive ttl")
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # key -> (fetched_at, pickled value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._fetching = {}
+        self._fetching_async = {}
+        self._connection = None
+        self._users = 0
+
+    @classmethod
+    def shared(cls, config=None):
+        """
+        Returns this process's cache for a `cache:` entry, creating it on first use
+        """
+        config = dict(config or {})
+        name = config.setdefault('name', 'quotes')
+        with cls._caches_lock:
+            if name not in cls._caches:
+                cls._caches[name] = cls(**config)
+            return cls._caches[name]
+
+    def acquire(self):
+        with self._lock:
+            if self._users == 0 and self.path is not None:
+                self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                self._connection.execute('PRAGMA journal_mode=WAL')
+                with self._connection:
+                    self._connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                                             '(key TEXT PRIMARY KEY, fetched_at REAL, value BLOB)')
+                    self._connection.execute('DELETE FROM cache WHERE fetched_at < ?', (time.time() - self.ttl,))
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0 and self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _store(self, key, fetched_at, blob):
+        # Caller holds the lock
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key)[1])
+        if len(blob) > self.max_bytes:
+            return
+        self._entries[key] = (fetched_at, blob)
+        self._bytes += len(blob)
+        while self._bytes > self.max_bytes:
+            self._bytes -= len(self._entries.popitem(last=False)[1][1])
+
+    def _lookup(self, key):
+        # Caller holds the lock
+        oldest = time.time() - self.ttl
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < oldest:
+            self._bytes -= len(self._entries.pop(key)[1])
+            entry = None
+        if entry is None and self._connection is not None:
+            entry = self._connection.execute('SELECT fetched_at, value FROM cache WHERE key = ? AND fetched_at >= ?',
+                                             (key, oldest)).fetchone()
+            if entry is not None:
+                self._store(key, *entry)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return pickle.loads(entry[1])
+
+    def get(self, key):
+        """
+        Returns the cached value if it was fetched no more than ttl seconds ago, MISSING otherwise
+        """
+        with self._lock:
+            return self._lookup(key)
+
+    def put(self, key, value):
+        fetched_at = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._store(key, fetched_at, blob)
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute('INSERT OR REPLACE INTO cache (key, fetched_at, value) VALUES (?, ?, ?)',
+                                             (key, fetched_at, blob))
+
+    def get_or_fetch(self, key, fetch, cacheable=lambda value: True):
+        """
+        Returns the cached value for key, or calls fetch() for it and caches the result when cacheable(result).
+        Threads asking for a key that is being fetched wait for that fetch and get its result, or its exception.
+        """
+        with self._lock:
+            # The fetch of another thread is either still running or has already stored its result
+            fetching = self._fetching.get(key)
+            leader = fetching is None
+            if leader:
+                value = self._lookup(key)
+                if value is not MISSING:
+                    return value
+                fetching = self._fetching[key] = concurrent.futures.Future()
+        if not leader:
+            return fetching.result()
+        try:
+            value = fetch()
+            if cacheable(value):
+                self.put(key, value)
+        except BaseException as e:
+            fetching.set_exception(e)
+            raise
+        else:
+            fetching.set_result(value)
+        finally:
+            with self._lock:
+                del self._fetching[key]
+        return value
+
+    async def get_or_fetch_async(self, key, fetch, cacheable=lambda value: True):
+        """
+        get_or_fetch() for coroutines: fetch() returns an awaitable, and coroutines asking for a key that is
+        being fetched await the same fetch. The lookup itself does not wait, the disk tier is a local file.
+        """
+        fetching = self._fetching_async.get(key)
+        if fetching is not None:
+            return await asyncio.shield(fetching)
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+        fetching = self._fetching_async[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await fetch()
+            if cacheable(value):
+                self.put(key, value)
+        except asyncio.CancelledError:
+            fetching.cancel()
+            raise
+        except BaseException as e:
+            fetching.set_exception(e)
+            # Marks the exception as retrieved when no other coroutine waited for it
+            fetching.exception()
+            raise
+        else:
+            fetching.set_result(value)
+        finally:
+            del self._fetching_async[key]
+        return value
+
+    def snapshot(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
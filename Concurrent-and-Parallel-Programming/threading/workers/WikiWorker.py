@@ -1,53 +1,134 @@
-import threading
+import hashlib
+import json
+import os
 
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
 
+from workers.HttpClient import HttpClient
+from workers.PipelineWorker import PipelineWorker
 
-class WikiWorkerMasterScheduler(threading.Thread):
-    def __init__(self, output_queue, **kwargs):
-        if 'input_queue' in kwargs:
-            kwargs.pop('input_queue')
 
-        self._input_values = kwargs.pop('input_values')
-
-        temp_queue = output_queue
-        if type(temp_queue) != list:
-            temp_queue = [temp_queue]
-        self._output_queues = temp_queue
-        super(WikiWorkerMasterScheduler, self).__init__(**kwargs)
+class WikiWorkerMasterScheduler(PipelineWorker):
+    """
+    With `page_cache:` under `params:` the Wikipedia pages are kept in that directory and revalidated with
+    their ETag/Last-Modified, so an unchanged page costs a 304 instead of a full download.
+    """
+    def __init__(self, output_queue, input_values, input_queue=None, http_client=None, page_cache=None, **kwargs):
+        super(WikiWorkerMasterScheduler, self).__init__(input_queue, output_queue, **kwargs)
+        self._input_values = input_values
+        self._http_client_config = http_client
+        self._http_client = None
+        self._page_cache = page_cache
         self.start()
 
-    def run(self):
+    def setup(self):
+        self._http_client = HttpClient.shared(self._http_client_config).acquire()
+
+    def teardown(self):
+        self._http_client.release()
+
+    def produce(self):
         for entry in self._input_values:
-            wikiWorker = WikiWorker(entry)
+            wikiWorker = WikiWorker(entry, session=self._http_client, page_cache=self._page_cache)
             symbol_counter = 0
             for symbol in wikiWorker.get_sp_500_companies():
-                for output_queue in self._output_queues:
-                    output_queue.put(symbol)
+                yield symbol
                 symbol_counter += 1
                 if symbol_counter >= 5:
                     break
 
 
 class WikiWorker():
-    def __init__(self, url):
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, url, session=None, page_cache=None):
         self._url = url
+        self._session = session if session is not None else requests
+        self._page_cache = page_cache
 
     @staticmethod
-    def _extract_company_symbols(page_html):
-        soup = BeautifulSoup(page_html, 'lxml')
-        table = soup.find(id='constituents')
-        table_rows = table.find_all('tr')
-        for table_row in table_rows[1:]:
-            symbol = table_row.find('td').text.strip('\n')
-            yield symbol
+    def _extract_company_symbols(chunks):
+        """
+        Yields the symbols of the constituents table while the page is still coming in: the chunks are fed to
+        an incremental parser and a row is emitted as soon as it is closed. Parsing stops at the end of the
+        table. Like before, the header row is skipped and a row's symbol is the text of its first cell.
+        """
+        parser = etree.HTMLPullParser(events=('start', 'end'))
+        table = None
+        row_index = 0
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if table is None:
+                    if event == 'start' and element.get('id') == 'constituents':
+                        table = element
+                    continue
+                if event != 'end':
+                    continue
+                if element is table:
+                    return
+                if element.tag == 'tr':
+                    cell = element.find('.//td')
+                    if row_index > 0 and cell is not None:
+                        yield ''.join(cell.itertext()).strip('\n')
+                    row_index += 1
+                    # Only the end of the table is still of interest, the row's elements can go
+                    element.clear()
 
-    def get_sp_500_companies(self):
-        response = requests.get(self._url)
-        if response.status_code != 200:
-            print("Couldn't get entries")
-            return []
+    def _cache_paths(self):
+        name = os.path.join(self._page_cache, hashlib.sha1(self._url.encode('utf-8')).hexdigest())
+        return name + '.html', name + '.json'
+
+    def _cached_validators(self):
+        page_path, metadata_path = self._cache_paths()
+        if not (os.path.exists(page_path) and os.path.exists(metadata_path)):
+            return None
+        with open(metadata_path) as f:
+            return json.load(f)
 
-        yield from self._extract_company_symbols(response.text)
+    def _read_cached_page(self):
+        with open(self._cache_paths()[0], 'rb') as f:
+            yield from iter(lambda: f.read(self.CHUNK_SIZE), b'')
 
+    def _caching(self, response, chunks):
+        # Passes the chunks on while writing them to the page cache, which only takes the page once it is complete
+        page_path, metadata_path = self._cache_paths()
+        os.makedirs(self._page_cache, exist_ok=True)
+        with open(page_path + '.part', 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(page_path + '.part', page_path)
+        with open(metadata_path, 'w') as f:
+            json.dump({'url': self._url, 'etag': response.headers.get('ETag'),
+                       'last_modified': response.headers.get('Last-Modified')}, f)
+
+    def get_sp_500_companies(self):
+        validators = self._cached_validators() if self._page_cache is not None else None
+        headers = {}
+        if validators is not None:
+            if validators['etag']:
+                headers['If-None-Match'] = validators['etag']
+            if validators['last_modified']:
+                headers['If-Modified-Since'] = validators['last_modified']
+        response = self._session.get(self._url, headers=headers, stream=True)
+        chunks = None
+        try:
+            if response.status_code == 304 and validators is not None:
+                yield from self._extract_company_symbols(self._read_cached_page())
+                return
+            if response.status_code != 200:
+                print("Couldn't get entries")
+                return
+            chunks = response.iter_content(self.CHUNK_SIZE)
+            if self._page_cache is not None:
+                chunks = self._caching(response, chunks)
+            yield from self._extract_company_symbols(chunks)
+        finally:
+            if self._page_cache is not None and chunks is not None:
+                # Parsing stopped at the end of the table, or the caller stopped taking symbols. The rest of
+                # the page is still read so that the cache gets the complete page
+                for _ in chunks:
+                    pass
+            response.close()
@@ -0,0 +1,193 @@
+import asyncio
+import datetime
+import traceback
+
+import aiohttp
+
+import tracing
+from pipeline_queues import acknowledge, is_done, take_receipts
+from retry import DeadLetter
+from workers.HttpClient import HttpClient
+from workers.TtlCache import TtlCache
+from workers.YahooFinanceWorkers import QuoteUnavailable, YahooFinacePriceWorker
+
+
+class YahooFinanceAsyncPriceScheduler():
+    """
+    Coroutine version of YahooFinancePriceScheduler for `executor: asyncio`. Fetching a price is almost all
+    waiting on the network, so one instance keeps up to `concurrency` requests in flight on the shared event
+    loop instead of tying up a thread per request. Symbols are only read from the input queue while fewer
+    than `concurrency` are in flight, so a slow host holds the symbols back in the queue.
+
+    `http_client:` configures it like the threaded scheduler: timeouts, max_connections_per_host (the
+    connector's per-host limit), retries with backoff on connection errors and 429/5xx responses, headers.
+    `rate_limit:` paces every attempt through the shared token bucket. Options under `params:`:
+
+    concurrency   requests in flight per instance, 100 by default
+    base_url      quote page prefix, finance.yahoo.com by default
+    cache         serves symbols fetched within its ttl without a request, see workers.TtlCache
+
+    Prices are sent downstream in batches of up to batch_size, and whenever no request is in flight.
+
+    `retry:` and `dead_letter_queue:` work as for workers.PipelineWorker. A symbol waiting for its next attempt
+    sleeps on the event loop's timers without holding one of the `concurrency` slots.
+
+    A traced symbol is processed from the moment its fetch gets a slot until its last attempt returns, the
+    wait for a slot shows between its dequeue and its processing start. A symbol from a persistent queue is
+    acknowledged once its price has been sent downstream, or it has been given up on.
+
+    A fetch that raises fails the stage: no further symbols are read, and run() raises its exception once
+    the fetches still in flight are done.
+    """
+    def __init__(self, input_queue, output_queue, concurrency=100, base_url=YahooFinacePriceWorker.BASE_URL,
+                 http_client=None, cache=None, rate_limiter=None, batch_size=1, batch_linger=0, retry_policy=None,
+                 dead_letter_queue=None, **kwargs):
+        self._input_queue = input_queue
+        temp_queue = output_queue
+        if type(temp_queue) != list:
+            temp_queue = [temp_queue]
+        self._output_queues = temp_queue
+        self._concurrency = concurrency
+        self._base_url = base_url
+        self._http_client_config = http_client
+        self._cache_config = cache
+        self._cache = None
+        self._rate_limiter = rate_limiter
+        self._batch_size = batch_size
+        self._batch_linger = batch_linger
+        self._retry_policy = retry_policy
+        self._dead_letter_queue = dead_letter_queue
+        self._in_flight = 0
+        self._results = []
+        self._result_spans = []
+        self._result_receipts = []
+
+    async def run(self):
+        # Only the settings of the process's client are used, the requests go through aiohttp
+        client = HttpClient.shared(self._http_client_config)
+        connector = aiohttp.TCPConnector(limit=self._concurrency, limit_per_host=client.max_connections_per_host)
+        timeout = aiohttp.ClientTimeout(sock_connect=client.connect_timeout, sock_read=client.timeout)
+        slots = asyncio.Semaphore(self._concurrency)
+        tasks = set()
+        # Exceptions of fetches that raised, a finished task is forgotten as soon as it is done
+        failures = []
+
+        def task_done(task):
+            tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                failures.append(task.exception())
+
+        if self._cache_config is not None:
+            self._cache = TtlCache.shared(self._cache_config).acquire()
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=client.headers) as session:
+                while True:
+                    symbols = await self._input_queue.get_many(self._batch_size, linger=self._batch_linger)
+                    items = [symbol for symbol in symbols if not is_done(symbol)]
+                    spans = tracing.spans_for(items)
+                    receipts = take_receipts(self._input_queue, items)
+                    for span in spans:
+                        # Still being fetched when the next symbols are read
+                        tracing.claim(span)
+                    for symbol, span, receipt in zip(items, spans, receipts):
+                        await slots.acquire()
+                        if failures:
+                            slots.release()
+                            break
+                        self._in_flight += 1
+                        task = asyncio.create_task(self._fetch(session, client, symbol, slots, span, receipt))
+                        tasks.add(task)
+                        task.add_done_callback(task_done)
+                    if is_done(symbols[-1]) or failures:
+                        break
+                # The fetches still in flight finish before the stage fails, so their prices are not lost
+                while tasks:
+                    await asyncio.wait(set(tasks))
+                if failures:
+                    raise failures[0]
+        finally:
+            if self._cache is not None:
+                self._cache.release()
+
+    async def _fetch(self, session, client, symbol, slots, span=None, receipt=None):
+        try:
+            fetched = await self._fetch_with_retries(session, client, symbol, slots, span)
+            tracing.finish([span])
+            if fetched is not None:
+                self._results.append((symbol,) + fetched)
+                self._result_spans.append(span)
+                self._result_receipts.append(receipt)
+            else:
+                acknowledge(self._input_queue, [receipt])
+        finally:
+            self._in_flight -= 1
+            slots.release()
+        if self._results and (len(self._results) >= self._batch_size or self._in_flight == 0):
+            results, self._results = self._results, []
+            spans, self._result_spans = self._result_spans, []
+            receipts, self._result_receipts = self._result_receipts, []
+            with tracing.scope(spans):
+                for output_queue in self._output_queues:
+                    await output_queue.put_many(results)
+            acknowledge(self._input_queue, receipts)
+
+    async def _fetch_with_retries(self, session, client, symbol, slots, span=None):
+        # Returns (price, extracted_time), or None for a symbol that was given up on
+        attempt = 1
+        while True:
+            tracing.start(span)
+            try:
+                if self._cache is None:
+                    return await self._fetch_price(session, client, symbol)
+                return await self._cache.get_or_fetch_async(symbol, lambda: self._fetch_price(session, client, symbol))
+            except Exception as e:
+                if self._retry_policy is None and self._dead_letter_queue is None:
+                    raise
+                if self._retry_policy is None or not self._retry_policy.should_retry(attempt, e):
+                    await self._give_up(symbol, attempt, e)
+                    return None
+            delay = self._retry_policy.delay(attempt)
+            attempt += 1
+            # The symbol gives its slot to the others while it waits
+            self._in_flight -= 1
+            slots.release()
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                await slots.acquire()
+                self._in_flight += 1
+
+    async def _give_up(self, symbol, attempt, error):
+        if self._dead_letter_queue is None:
+            print(f"Giving up on {symbol!r} after {attempt} attempts")
+            traceback.print_exception(type(error), error, error.__traceback__)
+            return
+        await self._dead_letter_queue.put(DeadLetter(type(self).__name__, symbol, repr(error), attempt,
+                                                     datetime.datetime.utcnow()))
+
+    async def _fetch_price(self, session, client, symbol):
+        return await self._get_price(session, client, symbol), datetime.datetime.utcnow()
+
+    async def _get_price(self, session, client, symbol):
+        url = f'{self._base_url}{symbol}'
+        for attempt in range(client.retries + 1):
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire_async()
+            retries_left = attempt < client.retries
+            delay = client.backoff_factor * 2 ** attempt
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        page = await response.read()
+                        # lxml releases the GIL while parsing, so the page is parsed off the event loop
+                        return await asyncio.get_running_loop().run_in_executor(
+                            None, YahooFinacePriceWorker.extract_price, symbol, page)
+                    if response.status not in client.RETRY_STATUSES or not retries_left:
+                        YahooFinacePriceWorker.check_status(symbol, response.status)
+                    retry_after = response.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = int(retry_after)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not retries_left:
+                    raise QuoteUnavailable(f"Failed to fetch data for {symbol}: {e!r}") from e
+            await asyncio.sleep(delay)
@@ -1,61 +1,123 @@
-import threading
 import datetime
-import random
-import time
-from queue import Empty
 
 import requests
-from lxml import html
+from lxml import etree, html
 
+from workers.HttpClient import HttpClient
+from workers.PipelineWorker import PipelineWorker
+from workers.TtlCache import TtlCache
 
-class YahooFinancePriceScheduler(threading.Thread):
-    def __init__(self, input_queue, output_queue, **kwargs):
-        super(YahooFinancePriceScheduler, self).__init__(**kwargs)
-        self._input_queue = input_queue
-        temp_queue = output_queue
-        if type(temp_queue) != list:
-            temp_queue = [temp_queue]
-        self._output_queues = temp_queue
+
+class QuoteUnavailable(Exception):
+    """
+    The quote page could not be fetched, e.g. Yahoo still answered 5xx after the HTTP client's retries.
+    Worth retrying later, see `retry:` in the pipeline YAML
+    """
+
+
+class PriceNotFound(ValueError):
+    """
+    There is no quote page for the symbol, or it has no price that parses as a number. Fetching the page
+    again gives the same answer
+    """
+
+
+class YahooFinancePriceScheduler(PipelineWorker):
+    """
+    With `cache:` under `params:` (see workers.TtlCache) a symbol fetched within the cache's ttl is served
+    from the cache, with the price and extracted_time of that fetch, without waiting for the rate limit.
+    A symbol whose price cannot be fetched raises QuoteUnavailable, PriceNotFound or the requests exception,
+    for the stage's retry policy and dead letter queue to deal with; failures are not cached.
+    """
+    def __init__(self, input_queue, output_queue, http_client=None, cache=None, **kwargs):
+        super(YahooFinancePriceScheduler, self).__init__(input_queue, output_queue, **kwargs)
+        self._http_client_config = http_client
+        self._http_client = None
+        self._cache_config = cache
+        self._cache = None
         self.start()
 
-    def run(self):
-        while True:
-            try:
-                val = self._input_queue.get(timeout=10)
-            except Empty:
-                print('Yahoo scheduler queue is empty, stopping')
-                break
-            if val == 'DONE':
-                break
+    def setup(self):
+        # Kept-alive connections to finance.yahoo.com, shared with the other instances in this process
+        self._http_client = HttpClient.shared(self._http_client_config).acquire()
+        if self._cache_config is not None:
+            self._cache = TtlCache.shared(self._cache_config).acquire()
+
+    def teardown(self):
+        self._http_client.release()
+        if self._cache is not None:
+            self._cache.release()
+
+    def process(self, symbol):
+        if self._cache is None:
+            price, extracted_time = self._fetch_price(symbol)
+        else:
+            price, extracted_time = self._cache.get_or_fetch(symbol, lambda: self._fetch_price(symbol))
+        return (symbol, price, extracted_time)
+
+    def _fetch_price(self, symbol):
+        # Paces the requests of all instances together, see rate_limit in the pipeline YAML
+        self.wait_for_rate_limit()
+        yahooFinacePriceWorker = YahooFinacePriceWorker(symbol=symbol, session=self._http_client)
+        price = yahooFinacePriceWorker.get_price()
+        return price, datetime.datetime.utcnow()
 
-            yahooFinacePriceWorker = YahooFinacePriceWorker(symbol=val)
-            price = yahooFinacePriceWorker.get_price()
-            for output_queue in self._output_queues:
-                output_values = (val, price, datetime.datetime.utcnow())
-                output_queue.put(output_values)
-            time.sleep(random.random())
+
+# Where the price sits on a quote page. Compiled once rather than on every page
+PRICE_XPATH = etree.XPath('//*[@id="quote-header-info"]/div[3]/div[1]/div/span[1]/text()')
+PRICE_MARKER = b'id="quote-header-info"'
+# Bytes after the start of the quote header that the fast path parses, a larger window only when the price is
+# not within the smaller one. The price comes within the first few KB of the header
+PRICE_WINDOWS = (4 * 1024, 32 * 1024)
+
+_utf8_parser = html.HTMLParser(encoding='utf-8')
 
 
 class YahooFinacePriceWorker():
-    def __init__(self, symbol):
+    BASE_URL = 'https://finance.yahoo.com/quote/'
+
+    def __init__(self, symbol, session=None):
         self._symbol = symbol
-        base_url = 'https://finance.yahoo.com/quote/'
-        self._url = f'{base_url}{self._symbol}'
+        self._session = session if session is not None else requests
+        self._url = f'{self.BASE_URL}{self._symbol}'
 
-    def get_price(self):
-        r = requests.get(self._url)
-        if r.status_code != 200:
-            print(f"Failed to fetch data for {self._symbol}, HTTP status code: {r.status_code}")
-            return None
-        page_contents = html.fromstring(r.text)
+    @staticmethod
+    def find_raw_price(page):
+        """
+        Returns the price text of a quote page given as bytes, or None when the page has none. The fast path
+        finds the quote header with a plain byte search and only parses the PRICE_WINDOWS bytes from there on.
+        Parsing is sequential, so the elements up to the price come out exactly as in the full page. The whole
+        page is only parsed when the fast path misses, e.g. when the header is missing or laid out differently.
+        """
+        marker = page.find(PRICE_MARKER)
+        if marker != -1:
+            start = page.rfind(b'<', 0, marker)
+            for window in PRICE_WINDOWS if start != -1 else ():
+                raw_prices = PRICE_XPATH(etree.fromstring(page[start:start + window], _utf8_parser))
+                if raw_prices:
+                    return raw_prices[0]
+        raw_prices = PRICE_XPATH(html.fromstring(page))
+        return raw_prices[0] if raw_prices else None
+
+    @classmethod
+    def extract_price(cls, symbol, page):
+        raw_price = cls.find_raw_price(page)
+        if raw_price is None:
+            raise PriceNotFound(f"Price element not found for {symbol} using the provided XPath")
         try:
-            raw_price = page_contents.xpath('//*[@id="quote-header-info"]/div[3]/div[1]/div/span[1]/text()')[0]
-            price = float(raw_price.replace(',', ''))
-            return 0
-        except IndexError:
-            print(f"Price element not found for {self._symbol} using the provided XPath.")
-            return 404
+            return float(raw_price.replace(',', ''))
         except ValueError:
-            print(f"Failed to convert price to float for {self._symbol}. Raw price: {raw_price}")
-            return 404
+            raise PriceNotFound(f"Failed to convert price to float for {symbol}. Raw price: {raw_price}") from None
+
+    @staticmethod
+    def check_status(symbol, status_code):
+        if status_code == 404:
+            raise PriceNotFound(f"No quote page for {symbol}")
+        if status_code != 200:
+            raise QuoteUnavailable(f"Failed to fetch data for {symbol}, HTTP status code: {status_code}")
 
+    def get_price(self):
+        r = self._session.get(self._url)
+        self.check_status(self._symbol, r.status_code)
+        # The raw bytes: decoding the whole page first would cost about as much as the fast path saves
+        return self.extract_price(self._symbol, r.content)
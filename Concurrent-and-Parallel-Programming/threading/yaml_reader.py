@@ -1,33 +1,431 @@
+import asyncio
+import concurrent.futures
+import contextvars
 import importlib
+import inspect
+import json
+import os
+import sys
 import threading
-import time
+import traceback
+from queue import Queue as CompletionQueue, Empty, Full
 
 import yaml
-from multiprocessing import Queue
+
+from autoscaler import Autoscaler
+from broker import PipelineBroker, RemoteQueue, connect, parse_address
+from dedup import DedupFilter
+from pipeline_metrics import (AsyncOutputQueueView, AsyncStageQueueView, InstanceStats, OutputQueueView,
+                              PipelineMetrics, StageQueueView, StageStats)
+from pipeline_queues import (DONE, MP_CONTEXT, QUEUE_TYPES, TRANSPORTS, PartitionedQueue, PersistentQueue,
+                             is_done, take_receipts)
+from rate_limiter import TokenBucket
+from retry import RetryPolicy
+from tracing import TraceReader, Tracer, TraceWriter, flush_all
+
+
+# How the instances of a stage are run, selected with the `executor:` key of a worker entry
+EXECUTORS = ('thread', 'process', 'asyncio')
+
+
+def _run_worker_in_process(location, class_name, init_params):
+    """
+    Entry point of a process-backed worker instance. The class is imported and constructed inside
+    the child, so the worker thread it starts runs on its own interpreter and does not share a GIL
+    with the rest of the pipeline.
+    """
+    WorkerClass = getattr(importlib.import_module(location), class_name)
+    try:
+        worker = WorkerClass(**init_params)
+        if isinstance(worker, threading.Thread):
+            worker.join()
+            if getattr(worker, 'failed', False):
+                # An exception on the worker's thread would not change the exit code otherwise
+                sys.exit(1)
+    finally:
+        flush_all()
+
+
+class EventLoopThread(threading.Thread):
+    """
+    Owns the single event loop shared by every asyncio-backed worker instance of a pipeline.
+    """
+    def __init__(self):
+        super(EventLoopThread, self).__init__(name='pipeline-event-loop', daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+        self.loop.close()
+
+
+# Receipts of the items the last AsyncQueue read of the current task handed out, see AsyncQueue.take_receipts
+_async_receipts = contextvars.ContextVar('async_receipts', default=())
+
+
+class _StopFeeder():
+    # Put behind the last item by AsyncQueue.stop() to release the feeder thread from its blocking get()
+    pass
+
+
+class AsyncQueue():
+    """
+    Coroutine front-end of a pipeline queue, shared by all asyncio-backed instances reading or writing it.
+    A single feeder thread moves items from the pipeline queue into an asyncio.Queue on the shared loop,
+    so any number of coroutines can wait in get() while only one thread blocks on the underlying queue.
+    put() tries a non-blocking put first and only hands the call to the queue's own writer thread when
+    the queue is full, so a waiting producer never takes a thread away from the consumers.
+    The feeder hands each item on with its receipt, so prefetching an item does not acknowledge the one
+    before it, see take_receipts().
+    """
+    def __init__(self, queue, loop):
+        self._queue = queue
+        self._loop = loop
+        # Holds a single prefetched item, the rest stays in the pipeline queue for its other consumers
+        self._items = asyncio.Queue(maxsize=1)
+        self._feeder = None
+        self._feeder_lock = threading.Lock()
+        self._writer = None
+
+    def _start_feeder(self):
+        with self._feeder_lock:
+            if self._feeder is None:
+                self._feeder = threading.Thread(target=self._feed, name=f'{self._queue.name}-async-feeder',
+                                                daemon=True)
+                self._feeder.start()
+
+    def _feed(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, _StopFeeder):
+                break
+            (receipt,) = take_receipts(self._queue, [item] if not is_done(item) else [None])
+            asyncio.run_coroutine_threadsafe(self._items.put((item, receipt)), self._loop).result()
+
+    def stop(self):
+        """
+        Called by the executor once every stage has finished
+        """
+        if self._feeder is not None:
+            self._queue.put_sentinel(_StopFeeder())
+            self._feeder.join()
+        if self._writer is not None:
+            self._writer.shutdown()
+
+    async def _next(self, timeout=None):
+        if self._feeder is None:
+            self._start_feeder()
+        try:
+            return await asyncio.wait_for(self._items.get(), timeout)
+        except asyncio.TimeoutError:
+            raise Empty
+
+    async def get(self, timeout=None):
+        item, receipt = await self._next(timeout)
+        _async_receipts.set(() if is_done(item) else (receipt,))
+        return item
+
+    async def get_many(self, max_items, linger=0, timeout=None):
+        entries = [await self._next(timeout)]
+        deadline = self._loop.time() + linger
+        while len(entries) < max_items and not is_done(entries[-1][0]):
+            remaining = deadline - self._loop.time()
+            try:
+                if remaining > 0:
+                    entries.append(await asyncio.wait_for(self._items.get(), remaining))
+                else:
+                    entries.append(self._items.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+        _async_receipts.set(tuple(receipt for item, receipt in entries if not is_done(item)))
+        return [item for item, receipt in entries]
+
+    def take_receipts(self):
+        """
+        Receipts of the items the last read of the calling task handed out, see pipeline_queues.take_receipts
+        """
+        receipts = _async_receipts.get()
+        _async_receipts.set(())
+        return list(receipts)
+
+    def acknowledge(self, receipts):
+        self._queue.acknowledge(receipts)
+
+    async def put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            if self._writer is None:
+                self._writer = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f'{self._queue.name}-async-writer')
+            await self._loop.run_in_executor(self._writer, self._queue.put, item)
+
+    async def put_many(self, items):
+        try:
+            self._queue.put_many(items, block=False)
+        except Full:
+            if self._writer is None:
+                self._writer = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f'{self._queue.name}-async-writer')
+            await self._loop.run_in_executor(self._writer, self._queue.put_many, items)
+
+    def qsize(self):
+        return self._queue.qsize() + self._items.qsize()
+
+
+class AsyncioWorkerHandle():
+    """
+    Gives a worker coroutine scheduled on the shared loop the is_alive()/join() interface of a thread,
+    so the supervisor can treat all executors the same way.
+    """
+    def __init__(self, name, coroutine, loop):
+        self.name = name
+        self._future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+        self._future.add_done_callback(self._report_exception)
+
+    def _report_exception(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f'Exception in asyncio worker {self.name}:')
+            traceback.print_exception(future.exception())
+
+    def is_alive(self):
+        return not self._future.done()
+
+    @property
+    def failed(self):
+        return self._future.done() and not self._future.cancelled() and self._future.exception() is not None
+
+    def join(self, timeout=None):
+        concurrent.futures.wait([self._future], timeout=timeout)
 
 
 class YamlPipelineExecutor(threading.Thread):
     # The constructor takes a pipeline_location parameter, which is the file path of the YAML configuration. 
     # It initializes various dictionaries to keep track of queues, workers, and their relationships.
-    def __init__(self, pipeline_location):
+    # With a node name it only runs the stages of that node, against the queues of the broker, see _initialize_broker.
+    def __init__(self, pipeline_location, progress_interval=1, node=None):
         super(YamlPipelineExecutor, self).__init__()
         self._pipline_location = pipeline_location
+        self._progress_interval = progress_interval
+        self._node = node
+        # Stages that run on other nodes -> their node, how many of its nodes are running them, and the broker
+        # serving them the queues
+        self._remote_stages = {}
+        self._remote_running = {}
+        self._broker = None
+        self._control = None
+        self._broker_address = None
+        self._broker_authkey = None
         self._queues = {}
         self._workers = {}
+        # queue name -> {consuming stage: number of its instances}
         self._queue_consumers = {}
+        # What each consuming stage reads: the queue itself, or its subscription of a topic
+        self._stage_inputs = {}
+        self._queue_producers = {}
         self._downstream_queues = {}
+        self._event_loop_thread = None
+        self._async_queues = {}
+        # Everything needed to start one more instance of a stage: (worker, WorkerClass, executor, init_params)
+        self._stage_specs = {}
+        self._stage_stats = {}
+        self._autoscalers = {}
+        self._metrics = None
+        self._tracer = None
+        self._rate_limiters = {}
+        self._dedup_filters = {}
+        # worker name -> the dedup filter its OutputQueueViews apply
+        self._stage_dedup_filters = {}
+        # Set by the optional top-level `checkpoint:` key, see _load_checkpoint
+        self._checkpoint_path = None
+        self._completed_stages = set()
+        self._failed_stages = set()
+        # Queues that already got their DONE sentinels, and stages whose instances have all exited.
+        # Guarded, like _queue_consumers and _workers, by the scaling lock
+        self._closed_queues = set()
+        self._scaling_stopped = set()
+        self._scaling_lock = threading.RLock()
+        # Stage watchers push the name of a finished stage here, the supervisor blocks on it
+        self._finished_stages = CompletionQueue()
 
     # This method opens and reads the YAML configuration file using the yaml.safe_load method. 
     def _load_pipeline(self):
         with open(self._pipline_location, 'r') as inFile:
             self._yaml_data = yaml.safe_load(inFile)
 
-    #  Iterates over the queues section of the loaded YAML data. For each queue defined, it creates a Queue object (from the multiprocessing module) and maps the queue's name to this object in the _queues dictionary. 
+    #  Iterates over the queues section of the loaded YAML data. For each queue defined, it creates a PipelineQueue and maps the queue's name to this object in the _queues dictionary. 
     # These queues are used for passing messages between different workers.
+    # maxsize, overflow and high_watermark/low_watermark in the queue entry bound the queue and throttle its producers.
+    # type: ring_buffer (with a record schema) exchanges fixed-size records through shared memory instead.
+    # type: topic hands every item to each stage reading the queue, instead of to just one of them.
+    # type: partitioned routes items by a key to sub-queues that are each read by one instance only.
     def _initialize_queues(self):
+        if self._node is not None:
+            self._initialize_remote_queues()
+            return
         for queue in self._yaml_data['queues']:
             queue_name = queue['name']
-            self._queues[queue_name] = Queue()
+            queue_type = queue.get('type', 'fifo')
+            if queue_type not in QUEUE_TYPES:
+                raise ValueError(f"Unknown type '{queue_type}' for queue {queue_name}, expected one of {tuple(QUEUE_TYPES)}")
+            self._queues[queue_name] = QUEUE_TYPES[queue_type].from_config(queue, transport=self._select_transport(queue))
+            if self._metrics is not None:
+                self._metrics.add_queue(self._queues[queue_name])
+            if getattr(self._queues[queue_name], 'resumed', 0):
+                print(f"Queue {queue_name} resumes with {self._queues[queue_name].resumed} items from the last run")
+            for worker in self._yaml_data['workers']:
+                if worker.get('input_queue') != queue_name:
+                    continue
+                if queue_type == 'topic':
+                    self._stage_inputs[worker['name']] = self._queues[queue_name].subscribe(worker['name'])
+                    if self._metrics is not None:
+                        self._metrics.add_queue(self._stage_inputs[worker['name']])
+                else:
+                    self._stage_inputs[worker['name']] = self._queues[queue_name]
+
+    def _initialize_remote_queues(self):
+        """
+        A node reaches every queue through the broker, and each of its stages reads what the broker hands out
+        for that stage: the queue, its subscription of a topic or a consumer of a partitioned queue
+        """
+        print(f"Node {self._node} connecting to the broker on {self._broker_address[0]}:{self._broker_address[1]}")
+        self._control = connect(self._broker_address, self._broker_authkey).control()
+        # Before any instance starts, so that the executor puts a DONE for each of them
+        self._control.node_joined(self._node, {worker['name']: worker.get('instances', 1)
+                                               for worker in self._yaml_data['workers']})
+        for queue in self._yaml_data['queues']:
+            self._queues[queue['name']] = RemoteQueue(self._broker_address, self._broker_authkey, queue['name'])
+        for worker in self._yaml_data['workers']:
+            if worker.get('input_queue') is not None:
+                self._stage_inputs[worker['name']] = RemoteQueue(self._broker_address, self._broker_authkey,
+                                                                 worker['input_queue'], stage=worker['name'])
+
+    def _select_transport(self, queue):
+        """
+        Picks the transport of a queue from the executors of the stages reading and writing it:
+        an in-process queue when all of them live in this process (threads and asyncio workers),
+        a multiprocessing queue as soon as one of them is process-backed.
+        A `transport:` key in the queue entry overrides the choice.
+        """
+        queue_name = queue['name']
+        executors = set()
+        for worker in self._yaml_data['workers']:
+            if worker['name'] in self._remote_stages:
+                # Reaches the queue through the broker, which serves it from this process
+                continue
+            if worker.get('input_queue') == queue_name or queue_name in (worker.get('output_queues') or []) or \
+                    worker.get('dead_letter_queue') == queue_name:
+                executors.add(worker.get('executor', 'thread'))
+        transport = 'process' if 'process' in executors else 'thread'
+
+        requested = queue.get('transport')
+        if requested is None:
+            return transport
+        if requested not in TRANSPORTS:
+            raise ValueError(f"Unknown transport '{requested}' for queue {queue_name}, expected one of {tuple(TRANSPORTS)}")
+        if requested == 'thread' and transport == 'process':
+            raise ValueError(f"Queue {queue_name} is used by a process-backed worker and cannot use the thread transport")
+        return requested
+
+    def _initialize_rate_limiters(self):
+        """
+        The optional top-level `rate_limits:` section names shared token buckets, typically one per host:
+
+            rate_limits:
+              finance.yahoo.com: {rate: 5, burst: 10}
+
+        A worker entry draws from one with `rate_limit: finance.yahoo.com`, or gets a bucket of its own with
+        `rate_limit: {rate: 5, burst: 10}`. All instances of all stages naming the same bucket share it.
+        """
+        for name, rate_limit in (self._yaml_data.get('rate_limits') or {}).items():
+            self._rate_limiters[name] = TokenBucket.from_config(name, rate_limit)
+            if self._metrics is not None:
+                self._metrics.add_rate_limiter(self._rate_limiters[name])
+
+    def _stage_rate_limiter(self, worker):
+        rate_limit = worker.get('rate_limit')
+        if rate_limit is None:
+            return None
+        if isinstance(rate_limit, dict):
+            self._rate_limiters[worker['name']] = TokenBucket.from_config(worker['name'], rate_limit)
+            if self._metrics is not None:
+                self._metrics.add_rate_limiter(self._rate_limiters[worker['name']])
+            return self._rate_limiters[worker['name']]
+        if rate_limit not in self._rate_limiters:
+            raise ValueError(f"Worker {worker['name']} uses rate limit {rate_limit}, which is not in rate_limits")
+        return self._rate_limiters[rate_limit]
+
+    def _initialize_dedup_filters(self):
+        """
+        The optional top-level `dedup_filters:` section names shared filters of already seen items:
+
+            dedup_filters:
+              symbols:
+                type: exact        # or bloom, for runs too large to keep every key
+                capacity: 100000
+                error_rate: 0.001  # bloom only
+
+        A worker entry applies one to everything it writes with `dedup: symbols`, or gets a filter of its own
+        with `dedup: {type: bloom, capacity: 1000000}`. All instances of all stages naming the same filter
+        share it, so an item reaches each output queue once however many instances produced it.
+        """
+        for name, dedup_config in (self._yaml_data.get('dedup_filters') or {}).items():
+            self._dedup_filters[name] = DedupFilter.from_config(name, dedup_config)
+            if self._metrics is not None:
+                self._metrics.add_dedup_filter(self._dedup_filters[name])
+
+    def _stage_dedup_filter(self, worker):
+        dedup = worker.get('dedup')
+        if dedup is None:
+            return None
+        if isinstance(dedup, dict):
+            self._dedup_filters[worker['name']] = DedupFilter.from_config(worker['name'], dedup)
+            if self._metrics is not None:
+                self._metrics.add_dedup_filter(self._dedup_filters[worker['name']])
+            return self._dedup_filters[worker['name']]
+        if dedup not in self._dedup_filters:
+            raise ValueError(f"Worker {worker['name']} uses dedup filter {dedup}, which is not in dedup_filters")
+        return self._dedup_filters[dedup]
+
+    def _stage_retry_policy(self, worker):
+        """
+        The optional top-level `retry_policies:` section names retry policies (see retry.RetryPolicy), which a
+        worker entry picks with `retry: network` or configures inline with `retry: {max_attempts: 5}`.
+        Items that fail for good go to the queue named by the entry's `dead_letter_queue:`, which gets its
+        DONE like the output queues once the stage has finished.
+        """
+        retry = worker.get('retry')
+        if retry is None:
+            return None
+        if isinstance(retry, dict):
+            return RetryPolicy.from_config(worker['name'], retry)
+        retry_policies = self._yaml_data.get('retry_policies') or {}
+        if retry not in retry_policies:
+            raise ValueError(f"Worker {worker['name']} uses retry policy {retry}, which is not in retry_policies")
+        return RetryPolicy.from_config(retry, retry_policies[retry])
+
+    def _stage_http_client(self, worker):
+        """
+        The optional top-level `http_clients:` section configures shared HTTP clients (timeouts, connections
+        per host, retries, see workers.HttpClient), which a worker entry picks with `http_client: yahoo` or
+        configures inline with `http_client: {timeout: 5}`. The worker gets the entry as a plain dict and
+        looks up its process's client by name, so all instances of a process share the connections.
+        """
+        http_client = worker.get('http_client')
+        if http_client is None:
+            return None
+        if isinstance(http_client, dict):
+            return dict(http_client, name=worker['name'])
+        http_clients = self._yaml_data.get('http_clients') or {}
+        if http_client not in http_clients:
+            raise ValueError(f"Worker {worker['name']} uses http client {http_client}, which is not in http_clients")
+        return dict(http_clients[http_client] or {}, name=http_client)
 
     def _initialize_workers(self):
         """
@@ -37,21 +435,47 @@ class YamlPipelineExecutor(threading.Thread):
         Initializes the worker with the appropriate input and output queues, and any input values specified.
         Handles multiple instances of the same worker if specified, creating a list of worker instances for each worker name.
         Maps output queues to workers and keeps track of the number of instances consuming from each input queue.
+        Starts every instance with the executor named by the optional `executor:` key (thread by default).
+        Stages with min_instances/max_instances are resized at runtime by their Autoscaler.
         """
         for worker in self._yaml_data['workers']:
             # Putting it all together, this line of code dynamically imports a module based on the path provided in worker['location'], 
             # then retrieves a class from that module using the class name provided in worker['class']
-            WorkerClass = getattr(importlib.import_module(worker['location']), worker['class'])
+            worker_name = worker['name']
+            remote = worker_name in self._remote_stages
+            # The classes of the stages on other nodes need not even be importable here
+            WorkerClass = None if remote else getattr(importlib.import_module(worker['location']), worker['class'])
             input_queue = worker.get('input_queue')
             output_queues = worker.get('output_queues')
-            worker_name = worker['name']
+            autoscaler = Autoscaler.from_config(worker)
             num_instances = worker.get('instances', 1)
+            if autoscaler is not None:
+                if input_queue is None:
+                    raise ValueError(f"Worker {worker_name} has no input_queue to scale on")
+                num_instances = autoscaler.clamp(worker.get('instances', autoscaler.min_instances))
+                self._autoscalers[worker_name] = autoscaler
+            if worker_name in self._completed_stages:
+                print(f"Worker {worker_name} already finished in the last run, skipping it")
+                num_instances = 0
+                self._scaling_stopped.add(worker_name)
+            executor = worker.get('executor', 'thread')
+            if executor not in EXECUTORS:
+                raise ValueError(f"Unknown executor '{executor}' for worker {worker_name}, expected one of {EXECUTORS}")
 
-            self._downstream_queues[worker_name] = output_queues
+            dead_letter_queue = worker.get('dead_letter_queue')
+            if dead_letter_queue is not None and dead_letter_queue not in self._queues:
+                raise ValueError(f"Worker {worker_name} uses dead letter queue {dead_letter_queue}, "
+                                 f"which is not in queues")
+            self._downstream_queues[worker_name] = (output_queues or []) + \
+                ([dead_letter_queue] if dead_letter_queue is not None else [])
             if input_queue is not None:
-                self._queue_consumers[input_queue] = num_instances
+                # The instances on nodes are added as their nodes join, see _remote_node_joined
+                self._queue_consumers.setdefault(input_queue, {})[worker_name] = num_instances if not remote else 0
+            # A queue only reaches end-of-stream once every stage writing into it has finished
+            for output_queue in self._downstream_queues[worker_name]:
+                self._queue_producers[output_queue] = self._queue_producers.get(output_queue, 0) + 1
             init_params = {
-                'input_queue': self._queues[input_queue] if input_queue is not None else None,
+                'input_queue': self._stage_inputs[worker_name] if input_queue is not None else None,
                 'output_queue': [self._queues[output_queue] for output_queue in output_queues] \
                     if output_queues is not None else None
             }
@@ -59,10 +483,136 @@ class YamlPipelineExecutor(threading.Thread):
             input_values = worker.get('input_values')
             if input_values is not None:
                 init_params['input_values'] = input_values
+            # Stages built on workers.PipelineWorker opt into micro-batching here: up to batch_size items
+            # per read, waiting at most batch_linger seconds for a batch to fill up
+            for batch_option in ('batch_size', 'batch_linger'):
+                if batch_option in worker:
+                    init_params[batch_option] = worker[batch_option]
+            rate_limiter = self._stage_rate_limiter(worker)
+            if rate_limiter is not None:
+                init_params['rate_limiter'] = rate_limiter
+            http_client = self._stage_http_client(worker)
+            if http_client is not None:
+                init_params['http_client'] = http_client
+            self._stage_dedup_filters[worker_name] = self._stage_dedup_filter(worker)
+            retry_policy = self._stage_retry_policy(worker)
+            if retry_policy is not None:
+                init_params['retry_policy'] = retry_policy
+            if dead_letter_queue is not None:
+                init_params['dead_letter_queue'] = self._queues[dead_letter_queue]
+            # Options of the worker class itself, e.g. the flush policy of a sink, are passed on as keyword
+            # arguments from the `params:` mapping of the entry
+            init_params.update(worker.get('params') or {})
 
+            # The autoscaler measures the service time on the stats, other stages only keep them for `metrics:`
+            self._stage_stats[worker_name] = None
+            if self._metrics is not None or autoscaler is not None:
+                self._stage_stats[worker_name] = StageStats(worker_name)
+            if self._metrics is not None:
+                self._metrics.add_stage(self._stage_stats[worker_name],
+                                        self._stage_inputs[worker_name].name if input_queue is not None else None)
+            self._stage_specs[worker_name] = (worker, WorkerClass, executor, init_params)
             self._workers[worker_name] = []
-            for i in range(num_instances):
-                self._workers[worker_name].append(WorkerClass(**init_params))
+            for i in range(num_instances if not remote else 0):
+                self._add_instance(worker_name)
+
+    def _add_instance(self, worker_name):
+        worker, WorkerClass, executor, init_params = self._stage_specs[worker_name]
+        index = len(self._workers[worker_name])
+        instance_name = f'{worker_name}-{index}'
+        if 'input_values' in init_params and worker.get('instances', 1) > 1:
+            # Each instance of a source stage works through its own share of the input values
+            init_params = dict(init_params, input_values=init_params['input_values'][index::worker['instances']])
+        self._workers[worker_name].append(
+            self._start_worker(worker, WorkerClass, executor, init_params, instance_name))
+
+    def _start_worker(self, worker, WorkerClass, executor, init_params, instance_name):
+        """
+        Starts one instance of a stage and returns a handle exposing is_alive() and join().
+        Threads start themselves in their constructor, processes construct the worker in a spawned child,
+        and asyncio workers define `async def run(self)`, which is scheduled on the shared loop with
+        AsyncQueue wrappers in place of the plain queues.
+        Every instance reads its input through its own StageQueueView and writes through OutputQueueViews,
+        which feed the stage's StageStats and the instance's InstanceStats, apply the stage's dedup filter
+        and, with `tracing:` configured, carry the traces of sampled items.
+        """
+        stats = self._stage_stats[worker['name']]
+        dedup_filter = self._stage_dedup_filters[worker['name']]
+        instance_stats = None
+        if self._metrics is not None:
+            instance_stats = InstanceStats(instance_name)
+            self._metrics.add_instance(worker['name'], instance_stats)
+        trace_reader, trace_writers = self._trace_views(worker, instance_name, init_params)
+        params = dict(init_params)
+        if init_params['input_queue'] is not None:
+            input_queue = init_params['input_queue']
+            # An instance reading a partitioned queue gets a share of its partitions, see PartitionedQueue,
+            # on a node through a consumer of its own on the broker
+            if isinstance(input_queue, (PartitionedQueue, RemoteQueue)):
+                input_queue = input_queue.consumer()
+            params['input_queue'] = StageQueueView(input_queue, stats, instance_stats, trace_reader)
+        if init_params['output_queue'] is not None:
+            params['output_queue'] = [OutputQueueView(queue, stats, dedup_filter, trace_writer)
+                                      for queue, trace_writer in zip(init_params['output_queue'], trace_writers)]
+
+        if executor == 'process':
+            # Spawned rather than forked: the other stages' threads are already running at this point,
+            # and a forked child could inherit one of their locks in a held state
+            process = MP_CONTEXT.Process(target=_run_worker_in_process, name=instance_name,
+                                         args=(worker['location'], worker['class'], params))
+            process.start()
+            return process
+
+        if executor == 'asyncio':
+            if not inspect.iscoroutinefunction(getattr(WorkerClass, 'run', None)):
+                # A blocking run() would stall every coroutine on the loop, such a worker keeps its own thread
+                print(f"Worker {worker['name']}: {worker['class']}.run is not a coroutine function, "
+                      f"running the instance on its own thread instead of the event loop")
+                return WorkerClass(**params)
+            if self._event_loop_thread is None:
+                self._event_loop_thread = EventLoopThread()
+            async_params = dict(init_params)
+            if init_params['input_queue'] is not None:
+                async_params['input_queue'] = AsyncStageQueueView(
+                    self._async_queue(init_params['input_queue'], reading=True), stats, instance_stats, trace_reader)
+            if init_params['output_queue'] is not None:
+                async_params['output_queue'] = [
+                    AsyncOutputQueueView(self._async_queue(queue), stats, dedup_filter, trace_writer)
+                    for queue, trace_writer in zip(init_params['output_queue'], trace_writers)]
+            if 'dead_letter_queue' in init_params:
+                async_params['dead_letter_queue'] = self._async_queue(init_params['dead_letter_queue'])
+            return AsyncioWorkerHandle(instance_name, WorkerClass(**async_params).run(),
+                                       self._event_loop_thread.loop)
+
+        return WorkerClass(**params)
+
+    def _trace_views(self, worker, instance_name, init_params):
+        """
+        The TraceReader of an instance's input queue and the TraceWriters of its output queues, None without
+        tracing. Ring buffers only take records of their schema, nothing is traced into them.
+        """
+        output_queues = init_params['output_queue'] or []
+        if self._tracer is None:
+            return None, [None] * len(output_queues)
+        trace_reader = None
+        if init_params['input_queue'] is not None:
+            trace_reader = TraceReader(self._tracer, worker['name'], instance_name, worker['input_queue'])
+        starts_traces = init_params['input_queue'] is None
+        trace_writers = [TraceWriter(self._tracer, starts_traces) if getattr(queue, 'schema', None) is None else None
+                         for queue in output_queues]
+        return trace_reader, trace_writers
+
+    def _async_queue(self, queue, reading=False):
+        name = queue.name
+        if reading and isinstance(queue, PartitionedQueue):
+            # The asyncio instances reading a partitioned queue share one member and its partitions
+            name = f'{queue.name}.consumer'
+            if name not in self._async_queues:
+                self._async_queues[name] = AsyncQueue(queue.consumer(leave_on_done=False),
+                                                      self._event_loop_thread.loop)
+        if name not in self._async_queues:
+            self._async_queues[name] = AsyncQueue(queue, self._event_loop_thread.loop)
+        return self._async_queues[name]
 
     def _join_workers(self):
         """
@@ -72,64 +622,320 @@ class YamlPipelineExecutor(threading.Thread):
             for worker_thread in self._workers[worker_name]:
                 worker_thread.join()
 
+    def _watch_stage(self, worker_name):
+        """
+        Blocks on join() of every instance of one stage and reports the stage to the supervisor
+        as soon as its last instance exits. join() wakes up on thread exit, so no polling is involved.
+        The autoscaler may append instances meanwhile, the stage is only finished once none is left
+        and it is stopped from adding more.
+        """
+        joined = 0
+        while True:
+            with self._scaling_lock:
+                if joined == len(self._workers[worker_name]):
+                    self._scaling_stopped.add(worker_name)
+                    break
+                worker_thread = self._workers[worker_name][joined]
+            worker_thread.join()
+            joined += 1
+            # A crashed worker process would otherwise go unnoticed, the thread ones print their traceback.
+            # Threads and coroutines that raised flag themselves as failed, see PipelineWorker.run
+            exitcode = getattr(worker_thread, 'exitcode', None)
+            if exitcode:
+                print(f"Worker process {worker_thread.name} of stage {worker_name} exited with code {exitcode}")
+                self._failed_stages.add(worker_name)
+            elif getattr(worker_thread, 'failed', False):
+                print(f"Worker {worker_thread.name} of stage {worker_name} failed")
+                self._failed_stages.add(worker_name)
+        self._finished_stages.put(worker_name)
+
+    def _start_stage_watchers(self):
+        for worker_name in self._workers:
+            if worker_name in self._remote_stages:
+                # Their node reports them through the broker, see _remote_stage_finished
+                continue
+            watcher = threading.Thread(target=self._watch_stage, args=(worker_name,),
+                                       name=f'{worker_name}-watcher', daemon=True)
+            watcher.start()
+
+    def _initialize_broker(self):
+        """
+        The optional top-level `broker:` section spreads the stages of a pipeline over several machines:
+
+            broker:
+              address: scraper-1:50000   # where the nodes connect, the executor listens there too
+              listen: 0.0.0.0:50000      # where the executor listens instead, optional
+              authkey: change-me         # or PIPELINE_BROKER_AUTHKEY in the environment
+
+        A worker entry with `node: fetchers` is not run by the executor but by the nodes started with
+        PIPELINE_NODE=fetchers python main.py, on any number of machines with the same pipeline file and worker
+        classes (PIPELINE_BROKER_ADDRESS overrides the address there). The executor serves the queues to the
+        nodes with a PipelineBroker. Each node registers its instances when it joins, so each gets a DONE, and
+        the executor closes the queues downstream of a stage once every node that joined reported it finished;
+        a node joining later is turned away. A node runs its stages like the executor runs the others, with
+        RemoteQueues in place of the queues. Rate limits, dedup filters, caches, metrics and traces are per node,
+        and stages on nodes are not autoscaled. A node that dies leaves its stages unfinished, and the executor
+        waiting for them.
+        """
+        broker_config = self._yaml_data.get('broker')
+        if self._node is not None:
+            self._yaml_data['workers'] = [worker for worker in self._yaml_data['workers']
+                                          if worker.get('node') == self._node]
+            if not self._yaml_data['workers']:
+                raise ValueError(f"No worker runs on node {self._node}")
+            remote_workers = self._yaml_data['workers']
+        else:
+            remote_workers = [worker for worker in self._yaml_data['workers'] if worker.get('node') is not None]
+            self._remote_stages = {worker['name']: worker['node'] for worker in remote_workers}
+        if not remote_workers:
+            return
+        if broker_config is None:
+            raise ValueError(f"Workers {[worker['name'] for worker in remote_workers]} run on other nodes, "
+                             f"which needs a broker section")
+        for worker in remote_workers:
+            if Autoscaler.from_config(worker) is not None:
+                raise ValueError(f"Worker {worker['name']} runs on node {worker['node']} and cannot be autoscaled")
+        self._broker_address = parse_address(os.environ.get('PIPELINE_BROKER_ADDRESS', broker_config['address']))
+        authkey = os.environ.get('PIPELINE_BROKER_AUTHKEY', broker_config.get('authkey'))
+        if authkey is None:
+            raise ValueError("The broker needs an authkey, in its section or in PIPELINE_BROKER_AUTHKEY")
+        self._broker_authkey = authkey.encode('utf-8')
+
+    def _start_broker(self):
+        listen = parse_address(self._yaml_data['broker'].get('listen', self._yaml_data['broker']['address']))
+        self._broker = PipelineBroker(listen, self._broker_authkey, self._queues.__getitem__,
+                                      self._serve_stage_input, self._remote_stage_finished, self._remote_node_joined)
+        print(f"Broker listening on {listen[0]}:{self._broker.address[1]} for nodes "
+              f"{sorted(set(self._remote_stages.values()))}")
+
+    def _serve_stage_input(self, worker_name):
+        stage_input = self._stage_inputs[worker_name]
+        return stage_input.consumer() if isinstance(stage_input, PartitionedQueue) else stage_input
+
+    def _remote_node_joined(self, node, instances):
+        # Called on a thread of the broker. Like an instance the autoscaler adds, the instances of a node
+        # joining after their input queue was closed bring their own DONE
+        with self._scaling_lock:
+            for worker_name in instances:
+                if self._remote_stages.get(worker_name) != node:
+                    raise ValueError(f"Worker {worker_name} does not run on node {node}")
+                if worker_name in self._scaling_stopped:
+                    raise ValueError(f"Worker {worker_name} has already finished, node {node} joined too late")
+            for worker_name, number_of_instances in instances.items():
+                self._remote_running[worker_name] = self._remote_running.get(worker_name, 0) + 1
+                input_queue = self._stage_specs[worker_name][0].get('input_queue')
+                if input_queue is None:
+                    continue
+                self._queue_consumers[input_queue][worker_name] += number_of_instances
+                if input_queue in self._closed_queues:
+                    for i in range(number_of_instances):
+                        self._stage_inputs[worker_name].put_sentinel(DONE)
+        print(f"Node {node} joined with {instances}")
+
+    def _remote_stage_finished(self, worker_name, failed):
+        # Called on a thread of the broker. The stage has finished once every node that joined has
+        with self._scaling_lock:
+            if failed:
+                self._failed_stages.add(worker_name)
+            self._remote_running[worker_name] -= 1
+            if self._remote_running[worker_name] > 0:
+                return
+            self._scaling_stopped.add(worker_name)
+        self._finished_stages.put(worker_name)
+
+    def _node_path(self, path):
+        # A node's own file next to the executor's, so that nodes on the same machine do not share it
+        if path is None or self._node is None:
+            return path
+        root, extension = os.path.splitext(path)
+        return f'{root}.{self._node}{extension}'
+
+    def _load_checkpoint(self):
+        """
+        With `checkpoint: <file>` in the YAML, the executor records there every stage that finished and whose
+        output is safe on disk, i.e. all its output queues are persistent (or it has none). When a run dies,
+        the next one skips those stages and resumes the others from what their persistent input queues still
+        hold, instead of starting from scratch. A run that finishes without failures removes the file.
+        """
+        self._checkpoint_path = self._yaml_data.get('checkpoint')
+        if self._checkpoint_path is not None and os.path.exists(self._checkpoint_path):
+            with open(self._checkpoint_path, 'r') as inFile:
+                self._completed_stages = set(json.load(inFile)['completed_stages'])
+            print(f"Resuming from checkpoint {self._checkpoint_path}, completed stages: {sorted(self._completed_stages)}")
+
+    def _checkpoint_stage(self, worker_name):
+        if worker_name in self._failed_stages or worker_name in self._completed_stages:
+            # What the instances of a failed stage still held claimed is handed out again on the next run
+            return
+        input_queue = self._stage_inputs.get(worker_name)
+        if isinstance(input_queue, PersistentQueue):
+            # Every instance has exited normally, so whatever they still held claimed was processed
+            input_queue.acknowledge_claimed()
+        output_queues = self._downstream_queues[worker_name] or []
+        if self._checkpoint_path is None or self._upstream_failed(worker_name) or \
+                not all(isinstance(self._queues[queue_name], PersistentQueue) for queue_name in output_queues):
+            return
+        self._completed_stages.add(worker_name)
+        temp_path = f'{self._checkpoint_path}.tmp'
+        with open(temp_path, 'w') as outFile:
+            json.dump({'completed_stages': sorted(self._completed_stages)}, outFile)
+        os.replace(temp_path, self._checkpoint_path)
+
+    def _upstream_failed(self, worker_name):
+        # A stage fed by a failed one gets the rest of its items from the next run, so it is not complete either
+        input_queue = self._stage_specs[worker_name][0].get('input_queue')
+        if input_queue is None:
+            return False
+        producers = [producer for producer, queues in self._downstream_queues.items() if input_queue in (queues or [])]
+        return any(producer in self._failed_stages or self._upstream_failed(producer) for producer in producers)
+
+    def _close_downstream_queues(self, worker_name):
+        """
+        Called once a stage has finished. Every output queue whose producers are now all done
+        gets one DONE per consuming instance so that the downstream stage stops right away.
+        """
+        if self._downstream_queues[worker_name] is None:
+            return
+        for output_queue in self._downstream_queues[worker_name]:
+            self._queue_producers[output_queue] -= 1
+            if self._queue_producers[output_queue] > 0:
+                continue
+            # Under the scaling lock, so the autoscaler cannot add a consumer that misses its DONE
+            with self._scaling_lock:
+                self._closed_queues.add(output_queue)
+                for consumer_name, number_of_consumers in self._queue_consumers.get(output_queue, {}).items():
+                    for i in range(number_of_consumers):
+                        self._stage_inputs[consumer_name].put_sentinel(DONE)
+
+    def _autoscale(self):
+        """
+        Resizes every autoscaled stage that is still running to the instance count its Autoscaler asks for.
+        New instances read the same input queue; an instance is retired by putting one DONE behind the
+        items already queued, so whichever instance reads it stops after the backlog before it is drained.
+        Once the input queue got its DONEs the stage can still grow to work off the rest of the backlog,
+        each new instance then brings its own DONE, but it no longer shrinks: its instances are about to stop.
+        """
+        with self._scaling_lock:
+            for worker_name, autoscaler in self._autoscalers.items():
+                if worker_name in self._scaling_stopped:
+                    continue
+                input_queue = self._stage_specs[worker_name][0]['input_queue']
+                stage_input = self._stage_inputs[worker_name]
+                instances = self._queue_consumers[input_queue][worker_name]
+                stats = self._stage_stats[worker_name].snapshot()
+                desired = autoscaler.desired_instances(instances, stage_input.qsize(),
+                                                       stats['items_processed'], stats['busy_seconds'])
+                closed = input_queue in self._closed_queues
+                if closed:
+                    desired = max(desired, instances)
+                if desired == instances:
+                    continue
+                for i in range(desired - instances):
+                    self._add_instance(worker_name)
+                    if closed:
+                        stage_input.put_sentinel(DONE)
+                for i in range(instances - desired):
+                    stage_input.put_sentinel(DONE)
+                self._queue_consumers[input_queue][worker_name] = desired
+                print(f"Autoscaler: {worker_name} {instances} -> {desired} instances")
+
     def process_pipeline(self):
         """
         This method is the main entry point for setting up and starting the pipeline process. 
-        It loads the pipeline configuration, initializes queues, and workers, 
-        but does not start the worker threads
+        It loads the pipeline configuration, initializes queues, and workers (which start themselves),
+        and attaches a watcher to every stage so that the supervisor learns about finished stages.
         """
         self._load_pipeline()
         print("yaml data\n",self._yaml_data)
+        # Optional `broker:` section and `node:` keys of the workers, see _initialize_broker
+        self._initialize_broker()
+        if self._node is None:
+            self._load_checkpoint()
+        # Optional `metrics:` section, see PipelineMetrics. A node keeps its own snapshot, without the endpoint
+        metrics_config = self._yaml_data.get('metrics')
+        if metrics_config is not None and self._node is not None:
+            metrics_config = dict(metrics_config, port=None,
+                                  snapshot_path=self._node_path(metrics_config.get('snapshot_path')))
+        self._metrics = PipelineMetrics.from_config(metrics_config)
+        # Optional `tracing:` section, see tracing.Tracer
+        tracing_config = self._yaml_data.get('tracing')
+        if tracing_config is not None:
+            tracing_config = dict(tracing_config, path=self._node_path(tracing_config['path']))
+        self._tracer = Tracer.from_config(tracing_config)
+        if self._tracer is not None:
+            print(f"Tracing {self._tracer.sample_rate:.0%} of the items to {self._tracer.path}")
         #  This allows for inter-thread communication.
         self._initialize_queues()
         print("Initialized queues:\n", list(self._queues.keys()))
+        self._initialize_rate_limiters()
+        self._initialize_dedup_filters()
         self._initialize_workers()
         for worker_name, worker_instances in self._workers.items():
-            print(f"Worker {worker_name} has {len(worker_instances)} instances initialized.")
-        # for the process_pipeline() method in the YamlPipelineExecutor class to wait for all worker threads 
-        # to complete before proceeding further. Here's why:
-        self._join_workers()
+            if worker_name in self._remote_stages:
+                print(f"Worker {worker_name} runs on node {self._remote_stages[worker_name]}.")
+            else:
+                print(f"Worker {worker_name} has {len(worker_instances)} instances initialized.")
+        if self._remote_stages:
+            self._start_broker()
+        self._start_stage_watchers()
+        if self._metrics is not None:
+            self._metrics.start()
+            if self._metrics.port is not None:
+                print(f"Serving metrics on http://{self._metrics.host}:{self._metrics.port}/metrics")
 
     def log_progress(self):
         active_workers = sum(1 for workers in self._workers.values() for worker in workers if worker.is_alive())
         queue_sizes = {queue_name: queue.qsize() for queue_name, queue in self._queues.items()}
-        print(f"Active Workers: {active_workers}, Queue Sizes: {queue_sizes}")
+        dropped = {queue_name: queue.dropped for queue_name, queue in self._queues.items() if queue.dropped}
+        with self._scaling_lock:
+            remote = sorted(worker_name for worker_name in self._remote_stages
+                            if worker_name not in self._scaling_stopped)
+        print(f"Active Workers: {active_workers}, Queue Sizes: {queue_sizes}" +
+              (f", Dropped: {dropped}" if dropped else "") +
+              (f", Waiting for stages on nodes: {remote}" if remote else ""))
 
     def run(self):
+        """
+        Event-driven supervisor: sleeps until a stage watcher reports a finished stage, then
+        immediately signals end-of-stream downstream. Progress is only logged while nothing happens,
+        so latency at a stage boundary no longer depends on a poll interval.
+        """
         self.process_pipeline()
 
-        while True:
-            total_workers_alive = 0
-            worker_stats = []
-            to_del = []
-            self.log_progress()
-            for worker_name in self._workers:
-                total_worker_threads_alive = 0
-                for worker_thread in self._workers[worker_name]:
-                    if worker_thread.is_alive():
-                        total_worker_threads_alive += 1
-                total_workers_alive += total_worker_threads_alive
-                if total_worker_threads_alive == 0:
-                    if self._downstream_queues[worker_name] is not None:
-                        for output_queue in self._downstream_queues[worker_name]:
-                            number_of_consumers = self._queue_consumers[output_queue]
-                            for i in range(number_of_consumers):
-                                self._queues[output_queue].put('DONE')
-
-                    to_del.append(worker_name)
-
-                worker_stats.append([worker_name, total_worker_threads_alive])
-            print(worker_stats)
-            if total_workers_alive == 0:
-                break
-
-            queue_stats = []
-            for queue in self._queues:
-                queue_stats.append([queue, self._queues[queue].qsize()])
-            
-            print(queue_stats)
+        running_stages = set(self._workers)
+        while running_stages:
+            try:
+                worker_name = self._finished_stages.get(timeout=self._progress_interval)
+            except Empty:
+                self._autoscale()
+                self.log_progress()
+                continue
 
-            for worker_name in to_del:
-                del self._workers[worker_name]
+            print(f"Stage {worker_name} finished")
+            running_stages.discard(worker_name)
+            if self._node is not None:
+                # The executor closes the queues downstream of the stages of a node. It may stop the broker
+                # once the last one is reported, so that one waits until the node no longer needs the queues
+                if running_stages:
+                    self._control.stage_finished(worker_name, worker_name in self._failed_stages)
+                continue
+            self._checkpoint_stage(worker_name)
+            self._close_downstream_queues(worker_name)
 
-            time.sleep(1)
+        self._join_workers()
+        for async_queue in self._async_queues.values():
+            async_queue.stop()
+        if self._event_loop_thread is not None:
+            self._event_loop_thread.stop()
+        flush_all()
+        self.log_progress()
+        if self._metrics is not None:
+            self._metrics.stop()
+        if self._node is not None:
+            self._control.stage_finished(worker_name, worker_name in self._failed_stages)
+        if self._broker is not None:
+            self._broker.stop()
+        for queue in self._queues.values():
+            queue.cleanup()
+        if self._checkpoint_path is not None and not self._failed_stages and os.path.exists(self._checkpoint_path):
+            os.remove(self._checkpoint_path)